@@ -36,6 +36,7 @@ setup(
         "transformers==4.33.2",
         "bs4",
         "lxml",
+        "cssselect",
         "colorlog",
         "toml",
         "argparse",
@@ -43,5 +44,9 @@ setup(
         "google-generativeai",
         "requests_toolbelt",
         "ujson",
+        "zstandard",
     ],
+    extras_require={
+        "analytics": ["pyarrow>=14"],
+    },
 )
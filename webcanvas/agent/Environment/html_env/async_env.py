@@ -5,14 +5,13 @@ from playwright.async_api import Error as PlaywrightError
 from playwright.sync_api import ViewportSize
 from urllib.parse import urlparse, urljoin
 from beartype import beartype
-from difflib import SequenceMatcher
 
-from PIL import Image
-from io import BytesIO
+import os
 import asyncio
-import base64
 from .actions import Action, ActionTypes
 from .build_tree import HTMLTree
+from .screenshot import Screenshot, ScreenshotCapturer
+from .page_actions import register_page_actions, run_page_action, element_target, resolve_element
 from .utils import stringfy_value
 
 from webcanvas.agent.Prompt import *
@@ -20,7 +19,8 @@ from webcanvas.logs import logger
 import importlib.resources as resources
 
 from playwright.async_api import Browser as PlaywrightBrowser
-from webcanvas.agent.Environment.html_env.context import BrowserContextConfig, BrowserContext, BrowserSession
+from webcanvas.agent.Environment.html_env.context import BrowserContextConfig, BrowserContext, BrowserSession, BROWSER_ARGS
+from webcanvas.agent.Environment.html_env.context_pool import BrowserContextPool
 
 class ActionExecutionError(Exception):
     """Custom action execution exception class"""
@@ -52,8 +52,28 @@ class AsyncHTMLEnvironment:
         locale: str = "en-US",
         use_vimium_effect=True,
         hide_unexpanded_elements=True,
-        proxy_server=None
+        proxy_server=None,
+        screenshot_format: str = "png",
+        screenshot_quality: int = 80,
+        screenshot_width: int = 1080,
+        context_config: BrowserContextConfig = None,
+        har_mode: str = "",
+        har_path: str = "",
+        har_not_found: str = "abort",
+        context_pool: Union[BrowserContextPool, None] = None
     ):
+        """
+        :param har_mode: "record" to save the traffic of the task to har_path, "replay" to serve it back from
+            har_path, "" to use the live web
+        :param har_not_found: What to do with requests missing from the archive in replay mode, "abort" to run
+            offline or "fallback" to send them to the network
+        :param context_pool: Pool to take a pre-warmed context of a shared browser from, instead of launching a
+            browser. The HAR modes route the context of a single task and do not use the pool
+        """
+        if har_mode not in ["", "record", "replay"]:
+            raise ValueError(f"Unknown har_mode {har_mode}, expected \"record\", \"replay\" or \"\"")
+        if har_mode and not har_path:
+            raise ValueError(f"har_path is required in har_mode {har_mode}")
         self.use_vimium_effect = use_vimium_effect
         self.mode = mode
         self.headless = headless
@@ -68,8 +88,14 @@ class AsyncHTMLEnvironment:
         self.context = None
         self.browser = None
         self.proxy = {"server": proxy_server} if proxy_server else None
-        self.config = BrowserContextConfig()
-        self.browser_context = BrowserContext()
+        self.config = context_config if context_config is not None else BrowserContextConfig()
+        self.browser_context = BrowserContext(config=self.config)
+        self.har_mode = har_mode
+        self.context_pool = context_pool if not har_mode else None
+        self.pooled_context = None
+        self.har_path = har_path
+        self.har_not_found = har_not_found
+        self.screenshot_capturer = ScreenshotCapturer(screenshot_format, screenshot_quality, screenshot_width)
     
     async def get_browser(self) -> PlaywrightBrowser:
         if self.browser is None:
@@ -82,7 +108,7 @@ class AsyncHTMLEnvironment:
 
         browser = await self.get_browser()
         self.browser_context.browser = browser
-        context = await self.browser_context._get_context(browser)
+        context = await self.browser_context._get_context(browser, self.context)
         self._page_event_handler = None
 
         # Get or create a page to use
@@ -114,6 +140,21 @@ class AsyncHTMLEnvironment:
         self.page = page
     
     async def setup(self, start_url: str) -> PlaywrightBrowser:
+        if self.context_pool is not None:
+            # A pre-warmed context of the shared browser, already scripted and with a page open
+            self.pooled_context = await self.context_pool.acquire()
+            self.browser = self.context_pool.browser
+            self.context = self.pooled_context.context
+            await self._setup_context()
+            self.page = self.pooled_context.page
+            if start_url:
+                await self.page.goto(start_url, timeout=20000)
+                await self.update_html_content()
+            else:
+                self.html_content = await self.page.content()
+            await self._initialize_session()
+            return self.browser
+
         self.playwright = await async_playwright().start()
         self.browser = await self.playwright.chromium.launch(
             # channel='chrome', # use personal chrome
@@ -121,33 +162,21 @@ class AsyncHTMLEnvironment:
             headless=self.headless,
             slow_mo=self.slow_mo,
             proxy=self.proxy,
-            args=[
-                '--no-sandbox',
-                '--disable-blink-features=AutomationControlled',
-                '--disable-infobars',
-                '--disable-background-timer-throttling',
-                '--disable-popup-blocking',
-                '--disable-backgrounding-occluded-windows',
-                '--disable-renderer-backgrounding',
-                '--disable-window-activation',
-                '--disable-focus-on-load',
-                '--no-first-run',
-                '--no-default-browser-check',
-                '--no-startup-window',
-                '--window-position=0,0',
-                # disable web security
-                '--disable-web-security',
-				'--disable-site-isolation-trials',
-				'--disable-features=IsolateOrigins,site-per-process',
-            ]
+            args=BROWSER_ARGS
         )
+        har_options = {}
+        if self.har_mode == "record":
+            os.makedirs(os.path.dirname(self.har_path) or ".", exist_ok=True)
+            # The archive is written when the context is closed
+            har_options = {"record_har_path": self.har_path, "record_har_mode": "full"}
         self.context = await self.browser.new_context(
             viewport=self.viewport_size,
             device_scale_factor=1,
             locale=self.locale,
             proxy=self.proxy,
+            **har_options,
         )
-        self.context.on("page", self.page_on_handler)
+        await self._setup_context()
         if start_url:
             self.page = await self.context.new_page()
             await self.page.wait_for_load_state()
@@ -162,6 +191,17 @@ class AsyncHTMLEnvironment:
         # self.last_page = self.page
         return self.browser
 
+    async def _setup_context(self):
+        """Attach the page handler, action library, request blocking and HAR replay of this task to the context"""
+        self.context.on("page", self.page_on_handler)
+        await register_page_actions(self.context)
+        await self.browser_context.install_request_blocking(self.context)
+        if self.har_mode == "replay":
+            if os.path.isfile(self.har_path):
+                await self.context.route_from_har(self.har_path, not_found=self.har_not_found)
+            else:
+                logger.error(f"HAR archive {self.har_path} not found, the task runs on the live web")
+
     async def update_html_content(self):
         await self.page.wait_for_load_state("load")
         await self.page.wait_for_timeout(2000)
@@ -177,7 +217,9 @@ class AsyncHTMLEnvironment:
             logger.error('Error evaluating JavaScript: %s', e)
             raise
         # logger.info("successfully execute js code")
-        return self.tree._build_dom_tree(eval_page)
+        dom_tree = self.tree._build_dom_tree(eval_page)
+        self.browser_context.snapshot_id = self.tree.snapshot_id
+        return dom_tree
 
     async def _get_obs(self) -> Union[str, Tuple[str, str]]:
         logger.info("_get_obs")
@@ -197,7 +239,7 @@ class AsyncHTMLEnvironment:
 
         if self.mode in ["d_v", "dom_v_desc", "vision_to_dom"]:
             is_valid, message = is_valid_base64(observation_VforD)
-            logger.info("Successfully fetch html content with observation_VforD:", message)
+            logger.info(f"Successfully fetch html content with observation_VforD: {message}")
 
         return (observation, observation_VforD) if self.mode in ["d_v", "dom_v_desc", "vision_to_dom"] else observation
 
@@ -251,8 +293,12 @@ class AsyncHTMLEnvironment:
                 f"selector:{selector},label_name:{label},element_id: {element_id},error ({e}) in fill_search action.")
         try:
             value = stringfy_value(action['fill_text'])
-            await self.page.locator(selector).fill(value)
-            await self.page.locator(selector).press("Enter")
+            element_handle = await resolve_element(
+                self.page, element_target(self.tree.snapshot_id, action["element_id"], selector))
+            if element_handle is None:
+                raise ActionExecutionError("fill_search", f"No element matches selector {selector}", selector)
+            await element_handle.fill(value)
+            await element_handle.press("Enter")
             await self.update_html_content()
         except:
             try:
@@ -298,36 +344,10 @@ class AsyncHTMLEnvironment:
             logger.error(
                 f"selector:{selector},label_name:{label},element_id: {element_id},error ({e}) in select_option action.")
         try:
-            selector = rf"{selector}"
-            optgroup_values = await self.page.evaluate(f'''(selector) => {{
-                var values = [];
-                var selectElement = document.querySelector(selector);
-                var options = selectElement.querySelectorAll('option');
-                for (var option of options) {{
-                    values.push(option.innerText);
-                }}
-                var optgroups = selectElement.querySelectorAll('optgroup');
-                for (var optgroup of optgroups) {{
-                    var options = optgroup.querySelectorAll('option');
-                    for (var option of options) {{
-                        values.push(option.innerText);
-                    }}   
-                }}
-                return values;
-            }}''', selector)
-            best_option = [-1, "", -1]
-            for i, option in enumerate(optgroup_values):
-                similarity = SequenceMatcher(
-                    None, option, action['fill_text']).ratio()
-                if similarity > best_option[2]:
-                    best_option = [i, option, similarity]
-            await self.page.evaluate(f'''(selector) => {{
-                var option = document.querySelector(selector); 
-                if (option) {{
-                    option.selected = true; 
-                    option.parentElement.dispatchEvent(new Event('change'));
-                }}
-            }}''', selector)
+            selection = await run_page_action(
+                self.page, "selectOption", element_target(self.tree.snapshot_id, action["element_id"], rf"{selector}"),
+                action['fill_text'])
+            logger.info(f"Selected option {selection['text']} of {len(selection['options'])} options")
             await self.update_html_content()
         except Exception as e:
             raise e
@@ -343,34 +363,20 @@ class AsyncHTMLEnvironment:
         except Exception as e:
             logger.error(
                 f"selector:{selector},label_name:{label},element_id: {element_id},error ({e}) in hover action.")
+        target = element_target(self.tree.snapshot_id, action["element_id"], selector)
         try:
-            await self.page.hover(selector)
+            element_handle = await resolve_element(self.page, target)
+            if element_handle is None:
+                raise ActionExecutionError("hover", f"No element matches selector {selector}", selector)
+            await element_handle.hover()
             await self.update_html_content()
         except:
-            hover = '''() => {
-                        var element = document.querySelector('%s');
-                        if (element) {
-                            element.dispatchEvent(new Event('mouseover', { bubbles: true }));
-                        }
-                    }
-                ''' % selector
-            await self.page.evaluate(hover)
+            await run_page_action(self.page, "hover", target)
             await self.update_html_content()
 
     async def scroll_down(self):
         try:
-            total_height = await self.page.evaluate("document.body.scrollHeight")
-            viewport_height = await self.page.evaluate("window.innerHeight")
-            if total_height < viewport_height:
-                await self.page.evaluate("window.scrollBy(0, 500)")
-                await self.update_html_content()
-            current_scroll = await self.page.evaluate("window.pageYOffset")
-            remaining_height = total_height - current_scroll - viewport_height
-            if remaining_height <= viewport_height:
-                await self.page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-            else:
-                scroll_amount = current_scroll + viewport_height * 0.75
-                await self.page.evaluate(f"window.scrollTo(0, {scroll_amount})")
+            await run_page_action(self.page, "scrollDown")
             await self.update_html_content()
         except:
             await self.page.mouse.wheel(0, 100)
@@ -378,14 +384,7 @@ class AsyncHTMLEnvironment:
 
     async def scroll_up(self):
         try:
-            viewport_height = await self.page.evaluate("window.innerHeight")
-            current_scroll = await self.page.evaluate("window.pageYOffset")
-            if current_scroll > 0:
-                if current_scroll < viewport_height:
-                    scroll_amount = 0
-                else:
-                    scroll_amount = current_scroll - viewport_height / 2
-                await self.page.evaluate(f"window.scrollTo(0, {scroll_amount})")
+            await run_page_action(self.page, "scrollUp")
             await self.update_html_content()
         except:
             await self.page.mouse.wheel(0, -100)
@@ -509,38 +508,27 @@ class AsyncHTMLEnvironment:
         return self.page, selector
 
     async def close(self):
+        if self.pooled_context is not None:
+            # The context goes back to the pool, which owns the browser
+            self.context.remove_listener("page", self.page_on_handler)
+            await self.browser_context.uninstall_request_blocking(self.context)
+            await self.context_pool.release(self.pooled_context)
+            self.pooled_context = None
+            return
         await self.context.close()
         await self.browser.close()
         await self.playwright.stop()
 
-    @staticmethod
-    def encode_and_resize(image):
-        img_res = 1080
-        w, h = image.size
-        img_res_h = int(img_res * h / w)
-        image = image.resize((img_res, img_res_h))
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        encoded_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return encoded_image
-
-    async def capture(self) -> Image:
+    async def capture(self) -> Screenshot:
         if not self.page:
             raise ValueError("Page not initialized or loaded.")
-        screenshot_bytes = ""
         for i in range(6):
             try:
-                screenshot_bytes = await self.page.screenshot()
-                break
-            except:
-                logger.info(
-                    "Capture screenshot_bytes failed for", i+1, "times")
+                return await self.screenshot_capturer.capture(self.page)
+            except Exception as e:
+                logger.info(f"Capture screenshot failed for {i + 1} times: {e}")
                 await asyncio.sleep(1)
-        screenshot = Image.open(BytesIO(screenshot_bytes)).convert("RGB")
-        encoded_screenshot = self.encode_and_resize(screenshot)
-        is_valid, message = is_valid_base64(
-            encoded_screenshot)
-        return encoded_screenshot
+        return Screenshot()
 
     @staticmethod
     async def is_valid_element(page: Page, selector: str):
@@ -571,14 +559,16 @@ class AsyncHTMLEnvironment:
                             f"Max retries {retries} reached, giving up.")
                         raise
 
-    async def get_obs(self) -> str:
-        """Get the current state of the browser"""
+    async def get_obs(self) -> Union[str, Tuple[str, Screenshot]]:
+        """Get the current state of the browser, with a screenshot of it in the vision modes"""
         await self.browser_context._wait_for_page_and_frames_load()
         session = self.browser_context.session
         session.cached_state = await self._update_state()
         logger.info("-- Successfully fetch html content")
         if self.config.cookies_file:
             asyncio.create_task(self.browser_context.save_cookies())
+        if self.mode in ["d_v", "dom_v_desc", "vision_to_dom"]:
+            return session.cached_state, await self.capture()
         return session.cached_state
 
     async def _update_state(self) -> str:
@@ -314,6 +314,7 @@
         if (node.nodeType === Node.TEXT_NODE) {
             const textNodeData = processTextNode(node);
             if (textNodeData) {
+                registerElement(textNodeData.index, node.parentElement);
                 DOM_HASH_MAP[textNodeData.index] = textNodeData;
                 return textNodeData.index;
             }
@@ -353,6 +354,7 @@
             nodeData.children.push(...children);
         }
 
+        registerElement(nodeData.index, node);
         DOM_HASH_MAP[nodeData.index] = nodeData;
         return nodeData.index;
     }
@@ -377,8 +379,29 @@
         }
     }
 
+    // Elements of this snapshot by index, held weakly so the page can still free removed nodes.
+    // Actions resolve their target here in one call instead of re-running its selector
+    const SNAPSHOT_ID = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+    const ELEMENTS = new Map();
+
+    function registerElement(index, element) {
+        if (element) {
+            ELEMENTS.set(index, typeof WeakRef === 'function' ? new WeakRef(element) : element);
+        }
+    }
+
     const DOM_HASH_MAP = {};
     const ID = { current: -1 };
     const root = buildDomTree(document.body);
-    return {root, map: DOM_HASH_MAP};
+    window.__webcanvasElements = {
+        snapshotId: SNAPSHOT_ID,
+        // The element of a node of the snapshot, null when the snapshot was replaced or the element removed
+        get(snapshotId, index) {
+            if (snapshotId !== SNAPSHOT_ID) return null;
+            const ref = ELEMENTS.get(index);
+            const element = ref && (typeof ref.deref === 'function' ? ref.deref() : ref);
+            return element && element.isConnected ? element : null;
+        },
+    };
+    return {root, map: DOM_HASH_MAP, snapshotId: SNAPSHOT_ID};
 }
\ No newline at end of file
@@ -21,6 +21,8 @@ class HTMLTree:
         self.nodeDict = [0] * 100000
         self.element_value = {}
         self.invisible_elements=[]
+        # Id the page tagged the elements of the last snapshot with, see buildDomTree.js
+        self.snapshot_id: str | None = None
     
     def fetch_html_content(self, html_content) -> str:
         """
@@ -213,6 +215,7 @@ class HTMLTree:
         js_root_id = eval_page.get('root')
         if js_node_map is None or js_root_id is None:
             return ""
+        self.snapshot_id = eval_page.get('snapshotId')
 
         # Parse the node
         for id, node_data in js_node_map.items():
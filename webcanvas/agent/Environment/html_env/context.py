@@ -11,10 +11,13 @@ import os
 import re
 import time
 import uuid
+import weakref
 from dataclasses import dataclass, field
 from typing import Optional, TypedDict
+from urllib.parse import urlparse
 
 from webcanvas.agent.Environment.html_env.utils import ElementNode
+from webcanvas.agent.Environment.html_env.page_actions import run_page_action, element_target, resolve_element
 from playwright.async_api import Browser as PlaywrightBrowser
 from playwright.async_api import (
     BrowserContext as PlaywrightBrowserContext,
@@ -35,6 +38,127 @@ class TabInfo(BaseModel):
 	url: str
 	title: str
 
+# Hosts of analytics, ad, social widget, live chat and push notification services, that pages do not need to be used.
+# A request is a tracker request when its host is one of these or a subdomain of one
+TRACKER_HOSTS = frozenset({
+    # Analytics and tracking
+    'google-analytics.com',
+    'googletagmanager.com',
+    'analytics.google.com',
+    'segment.io',
+    'cdn.segment.com',
+    'mixpanel.com',
+    'amplitude.com',
+    'fullstory.com',
+    'clarity.ms',
+    'nr-data.net',
+    'scorecardresearch.com',
+    'quantserve.com',
+    'chartbeat.com',
+    # Ad-related
+    'doubleclick.net',
+    'googlesyndication.com',
+    'googleadservices.com',
+    'amazon-adsystem.com',
+    'adnxs.com',
+    'adsrvr.org',
+    'criteo.com',
+    'criteo.net',
+    'taboola.com',
+    'outbrain.com',
+    'moatads.com',
+    # Social media widgets
+    'connect.facebook.net',
+    'platform.twitter.com',
+    'platform.linkedin.com',
+    # Live chat and support
+    'livechatinc.com',
+    'zdassets.com',
+    'widget.intercom.io',
+    'intercomcdn.com',
+    'client.crisp.chat',
+    'hotjar.com',
+    'hotjar.io',
+    # Push notifications
+    'onesignal.com',
+    'pushwoosh.com',
+})
+
+
+def is_tracker_url(url: str) -> bool:
+    """Whether the host of a URL is a TRACKER_HOSTS host or one of its subdomains"""
+    host = urlparse(url).hostname or ''
+    labels = host.split('.')
+    return any('.'.join(labels[i:]) in TRACKER_HOSTS for i in range(len(labels) - 1))
+
+
+# Browser launch arguments shared by the environment and the context pool
+BROWSER_ARGS = [
+    '--no-sandbox',
+    '--disable-blink-features=AutomationControlled',
+    '--disable-infobars',
+    '--disable-background-timer-throttling',
+    '--disable-popup-blocking',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--disable-window-activation',
+    '--disable-focus-on-load',
+    '--no-first-run',
+    '--no-default-browser-check',
+    '--no-startup-window',
+    '--window-position=0,0',
+    # disable web security
+    '--disable-web-security',
+    '--disable-site-isolation-trials',
+    '--disable-features=IsolateOrigins,site-per-process',
+]
+
+ANTI_DETECTION_SCRIPT = """
+// Webdriver property
+Object.defineProperty(navigator, 'webdriver', {
+    get: () => undefined
+});
+
+// Languages
+Object.defineProperty(navigator, 'languages', {
+    get: () => ['en-US']
+});
+
+// Plugins
+Object.defineProperty(navigator, 'plugins', {
+    get: () => [1, 2, 3, 4, 5]
+});
+
+// Chrome runtime
+window.chrome = { runtime: {} };
+
+// Permissions
+const originalQuery = window.navigator.permissions.query;
+window.navigator.permissions.query = (parameters) => (
+    parameters.name === 'notifications' ?
+        Promise.resolve({ state: Notification.permission }) :
+        originalQuery(parameters)
+);
+(function () {
+    const originalAttachShadow = Element.prototype.attachShadow;
+    Element.prototype.attachShadow = function attachShadow(options) {
+        return originalAttachShadow.call(this, { ...options, mode: "open" });
+    };
+})();
+"""
+
+# Contexts the anti-detection script was added to, so a reused context is not scripted twice
+_scripted_contexts = weakref.WeakSet()
+
+
+async def add_anti_detection_script(context: PlaywrightBrowserContext):
+    """Expose anti-detection scripts to every page of the context, once per context"""
+    if context in _scripted_contexts:
+        return
+    await context.add_init_script(ANTI_DETECTION_SCRIPT)
+    _scripted_contexts.add(context)
+
+
 class BrowserContextWindowSize(TypedDict):
     width: int
     height: int
@@ -101,6 +225,14 @@ class BrowserContextConfig:
 
         include_dynamic_attributes: bool = True
             Include dynamic attributes in the CSS selector. If you want to reuse the css_selectors, it might be better to set this to False.
+
+        block_trackers: False
+            Abort the requests to analytics, ad, social widget, live chat and push notification hosts (TRACKER_HOSTS).
+
+        block_resource_types: []
+            Resource types to abort the requests of, for example ['image', 'font', 'media']. Top-level page navigations are never blocked.
+            Blocking trackers or resource types routes every request of the context, which disables the HTTP cache of
+            Chromium for it, so a pooled context warmed up at context_warm_url does not keep its cached resources.
     """
 
     cookies_file: str | None = None
@@ -127,6 +259,9 @@ class BrowserContextConfig:
     allowed_domains: list[str] | None = None
     include_dynamic_attributes: bool = True
 
+    block_trackers: bool = False
+    block_resource_types: list[str] = field(default_factory=list)
+
     _force_keep_context_alive: bool = False
 
 
@@ -136,6 +271,41 @@ class BrowserSession:
     cached_state: str | None
 
 
+@dataclass
+class RequestBlockingStats:
+    """Requests aborted by the request blocking of a context, and the responses it let through"""
+
+    blocked_requests: int = 0
+    blocked_by_reason: dict = field(default_factory=dict)
+    allowed_responses: int = 0
+    allowed_bytes: int = 0
+
+    def record_blocked(self, reason: str):
+        self.blocked_requests += 1
+        self.blocked_by_reason[reason] = self.blocked_by_reason.get(reason, 0) + 1
+
+    def record_response(self, response):
+        self.allowed_responses += 1
+        content_length = response.headers.get('content-length')
+        if content_length and content_length.isdigit():
+            self.allowed_bytes += int(content_length)
+
+    def merge(self, other: 'RequestBlockingStats'):
+        self.blocked_requests += other.blocked_requests
+        for reason, count in other.blocked_by_reason.items():
+            self.blocked_by_reason[reason] = self.blocked_by_reason.get(reason, 0) + count
+        self.allowed_responses += other.allowed_responses
+        self.allowed_bytes += other.allowed_bytes
+
+    def as_dict(self) -> dict:
+        return {
+            'blocked_requests': self.blocked_requests,
+            'blocked_by_reason': dict(self.blocked_by_reason),
+            'allowed_responses': self.allowed_responses,
+            'allowed_bytes': self.allowed_bytes,
+        }
+
+
 class BrowserContext:
     def __init__(
         self,
@@ -153,6 +323,9 @@ class BrowserContext:
 
         # Initialize these as None - they'll be set up when needed
         self.session: BrowserSession | None = None
+        self.request_blocking_stats = RequestBlockingStats()
+        # Snapshot the element nodes passed to the actions come from
+        self.snapshot_id: str | None = None
 
     async def __aenter__(self):
         """Async context manager enter"""
@@ -203,47 +376,55 @@ class BrowserContext:
         """Get the current page"""
         return await self._get_current_page(self.session)
 
-    async def _get_context(self, browser: PlaywrightBrowser):
+    async def _get_context(self, browser: PlaywrightBrowser, context: PlaywrightBrowserContext | None = None):
         """get browser context with anti-detection measures and loads cookies if available."""
-        context = browser.contexts[0]
-        # Expose anti-detection scripts
-        await context.add_init_script(
-            """
-            // Webdriver property
-            Object.defineProperty(navigator, 'webdriver', {
-                get: () => undefined
-            });
-
-            // Languages
-            Object.defineProperty(navigator, 'languages', {
-                get: () => ['en-US']
-            });
-
-            // Plugins
-            Object.defineProperty(navigator, 'plugins', {
-                get: () => [1, 2, 3, 4, 5]
-            });
-
-            // Chrome runtime
-            window.chrome = { runtime: {} };
-
-            // Permissions
-            const originalQuery = window.navigator.permissions.query;
-            window.navigator.permissions.query = (parameters) => (
-                parameters.name === 'notifications' ?
-                    Promise.resolve({ state: Notification.permission }) :
-                    originalQuery(parameters)
-            );
-            (function () {
-                const originalAttachShadow = Element.prototype.attachShadow;
-                Element.prototype.attachShadow = function attachShadow(options) {
-                    return originalAttachShadow.call(this, { ...options, mode: "open" });
-                };
-            })();
-            """
+        context = context if context is not None else browser.contexts[0]
+        await add_anti_detection_script(context)
+        return context
+
+    async def install_request_blocking(self, context: PlaywrightBrowserContext):
+        """Abort the tracker requests and the blocked resource types of every page of the context, if enabled"""
+        if not self.config.block_trackers and not self.config.block_resource_types:
+            return
+        blocked_resource_types = set(self.config.block_resource_types)
+
+        def block_reason(request) -> str | None:
+            try:
+                # Never block the page the agent navigates to
+                if request.is_navigation_request() and request.frame.parent_frame is None:
+                    return None
+            except Exception:
+                pass
+            if request.resource_type in blocked_resource_types:
+                return request.resource_type
+            if self.config.block_trackers and is_tracker_url(request.url):
+                return 'tracker'
+            return None
+
+        async def handle_route(route):
+            reason = block_reason(route.request)
+            if reason is None:
+                await route.fallback()
+                return
+            self.request_blocking_stats.record_blocked(reason)
+            await route.abort('blockedbyclient')
+
+        await context.route('**/*', handle_route)
+        context.on('response', self.request_blocking_stats.record_response)
+        self._request_blocking_route = handle_route
+        logger.debug(
+            f'Request blocking installed: trackers={self.config.block_trackers}, '
+            f'resource types={sorted(blocked_resource_types)}'
         )
 
-        return context
+    async def uninstall_request_blocking(self, context: PlaywrightBrowserContext):
+        """Remove the request blocking of this BrowserContext from a context that outlives it"""
+        handle_route = getattr(self, '_request_blocking_route', None)
+        if handle_route is None:
+            return
+        await context.unroute('**/*', handle_route)
+        context.remove_listener('response', self.request_blocking_stats.record_response)
+        self._request_blocking_route = None
 
     async def _wait_for_stable_network(self):
         page = await self.get_current_page()
@@ -559,6 +740,17 @@ class BrowserContext:
     async def get_locate_element(self, element: ElementNode, tree: dict) -> Optional[ElementHandle]:
         current_frame = await self.get_current_page()
 
+        # Elements tagged by the last snapshot resolve in a single call, iframe content included
+        if self.snapshot_id is not None:
+            try:
+                element_handle = await resolve_element(
+                    current_frame, element_target(self.snapshot_id, element.get("nodeId")))
+                if element_handle:
+                    await element_handle.scroll_into_view_if_needed()
+                    return element_handle
+            except Exception as e:
+                logger.debug(f'Failed to resolve the tagged element, fall back to its selector: {str(e)}')
+
         # Start with the target element and collect all parents
         parents: list[ElementNode] = []
         current = element
@@ -763,12 +955,8 @@ class BrowserContext:
 
     async def get_scroll_info(self, page: Page) -> tuple[int, int]:
         """Get scroll position information for the current page."""
-        scroll_y = await page.evaluate('window.scrollY')
-        viewport_height = await page.evaluate('window.innerHeight')
-        total_height = await page.evaluate('document.documentElement.scrollHeight')
-        pixels_above = scroll_y
-        pixels_below = total_height - (scroll_y + viewport_height)
-        return pixels_above, pixels_below
+        scroll_info = await run_page_action(page, 'scrollInfo')
+        return scroll_info['pixelsAbove'], scroll_info['pixelsBelow']
 
     async def reset_context(self):
         """Reset the browser session
@@ -0,0 +1,215 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+from playwright.async_api import async_playwright, Page
+from playwright.async_api import Browser as PlaywrightBrowser
+from playwright.async_api import BrowserContext as PlaywrightBrowserContext
+
+from webcanvas.agent.Environment.html_env.context import BROWSER_ARGS, add_anti_detection_script
+from webcanvas.agent.Environment.html_env.page_actions import register_page_actions
+from webcanvas.logs import logger
+
+JS_HEAP_SIZE_SCRIPT = "() => performance.memory ? performance.memory.usedJSHeapSize : 0"
+
+
+@dataclass(eq=False)
+class PooledContext:
+    context: PlaywrightBrowserContext
+    page: Page
+    uses: int = 0
+    # Origins the frames of the context navigated to, whose storage is cleared when the context is reused
+    origins: set = field(default_factory=set)
+
+    def record_navigation(self, request):
+        if request.is_navigation_request():
+            url = urlparse(request.url)
+            if url.scheme in ("http", "https") and url.netloc:
+                self.origins.add(f"{url.scheme}://{url.netloc}")
+
+
+class BrowserContextPool:
+    """
+    Browser contexts created ahead of demand on one shared browser, with the anti-detection script and the action
+    library added and a page open at warm_url, so a task starts without launching a browser or creating a context.
+    A released context is reused until it served max_uses tasks or the JS heap of its page grew over max_js_heap_mb,
+    then it is closed and replaced in the background. Before a context is reused, its cookies and permissions and the
+    storage of every origin it visited (localStorage, IndexedDB, service workers, Cache Storage) are cleared, and its
+    page is replaced by a new tab, so no login, cart or preference of a task carries over into the next one.
+    Idle contexts that stop answering are dropped by a periodic health check.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_uses: int = 1,
+        max_js_heap_mb: float = 512,
+        health_check_interval: float = 30,
+        health_check_timeout: float = 5,
+        warm_url: str = "about:blank",
+        headless: bool = True,
+        slow_mo: int = 0,
+        proxy_server=None,
+        viewport_size: dict = None,
+        locale: str = "en-US",
+    ):
+        """
+        :param max_uses: Tasks served by a context before it is recycled. 1 gives every task a fresh context
+        :param warm_url: Page the contexts are opened at, to warm up DNS, TLS and the HTTP cache of a start site
+        """
+        self.size = size
+        self.max_uses = max_uses
+        self.max_js_heap_mb = max_js_heap_mb
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.warm_url = warm_url
+        self.headless = headless
+        self.slow_mo = slow_mo
+        self.proxy = {"server": proxy_server} if proxy_server else None
+        self.viewport_size = viewport_size or {"width": 1280, "height": 720}
+        self.locale = locale
+        self.playwright = None
+        self.browser: PlaywrightBrowser | None = None
+        self.idle = deque()
+        self.creating = 0
+        self.closed = False
+        self.background_tasks = set()
+        self.health_check_task = None
+
+    async def start(self):
+        await self._get_browser()
+        await asyncio.gather(*[self._add_context() for _ in range(self.size)])
+        self.health_check_task = asyncio.create_task(self._health_check_loop())
+        logger.info(f"Browser context pool started with {len(self.idle)} contexts")
+        return self
+
+    async def _get_browser(self) -> PlaywrightBrowser:
+        if self.browser is None or not self.browser.is_connected():
+            if self.playwright is None:
+                self.playwright = await async_playwright().start()
+            self.browser = await self.playwright.chromium.launch(
+                headless=self.headless, slow_mo=self.slow_mo, proxy=self.proxy, args=BROWSER_ARGS)
+        return self.browser
+
+    async def _create_context(self) -> PooledContext:
+        browser = await self._get_browser()
+        context = await browser.new_context(
+            viewport=self.viewport_size, device_scale_factor=1, locale=self.locale, proxy=self.proxy)
+        await add_anti_detection_script(context)
+        await register_page_actions(context)
+        page = await context.new_page()
+        pooled = PooledContext(context=context, page=page)
+        context.on("request", pooled.record_navigation)
+        if self.warm_url and self.warm_url != "about:blank":
+            try:
+                await page.goto(self.warm_url, timeout=20000)
+            except Exception as e:
+                logger.warning(f"Failed to warm up a pooled context at {self.warm_url}: {e}")
+        return pooled
+
+    async def _add_context(self):
+        self.creating += 1
+        try:
+            self.idle.append(await self._create_context())
+        except Exception as e:
+            logger.error(f"Failed to create a pooled context: {e}")
+        finally:
+            self.creating -= 1
+
+    def _refill(self):
+        """Create contexts in the background until the pool is full again"""
+        for _ in range(self.size - len(self.idle) - self.creating):
+            task = asyncio.create_task(self._add_context())
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def _is_healthy(self, pooled: PooledContext) -> bool:
+        try:
+            await asyncio.wait_for(pooled.page.evaluate("1"), timeout=self.health_check_timeout)
+            return True
+        except Exception:
+            return False
+
+    async def _discard(self, pooled: PooledContext):
+        try:
+            await asyncio.wait_for(pooled.context.close(), timeout=self.health_check_timeout)
+        except Exception as e:
+            logger.debug(f"Failed to close a pooled context: {e}")
+
+    async def acquire(self) -> PooledContext:
+        """A ready context, created on the spot when the pool is empty"""
+        while self.idle:
+            pooled = self.idle.popleft()
+            if await self._is_healthy(pooled):
+                self._refill()
+                return pooled
+            await self._discard(pooled)
+        self._refill()
+        return await self._create_context()
+
+    async def release(self, pooled: PooledContext):
+        """Return a context after a task, recycling it when it is worn out"""
+        pooled.uses += 1
+        if not self.closed and pooled.uses < self.max_uses and await self._reset(pooled):
+            self.idle.append(pooled)
+        else:
+            await self._discard(pooled)
+        if not self.closed:
+            self._refill()
+
+    async def _reset(self, pooled: PooledContext) -> bool:
+        """Clear the state of the task from a context, False when it should be recycled instead"""
+        try:
+            js_heap_size = await asyncio.wait_for(
+                pooled.page.evaluate(JS_HEAP_SIZE_SCRIPT), timeout=self.health_check_timeout)
+            if js_heap_size > self.max_js_heap_mb * 1024 * 1024:
+                logger.info(f"Recycle a pooled context using {js_heap_size / 1024 / 1024:.0f} MB of JS heap")
+                return False
+            await self._clear_origin_storage(pooled)
+            # A new tab drops the sessionStorage of the task
+            page = await pooled.context.new_page()
+            for old_page in pooled.context.pages:
+                if old_page != page:
+                    await old_page.close()
+            pooled.page = page
+            await pooled.context.clear_cookies()
+            await pooled.context.clear_permissions()
+            await pooled.page.goto(self.warm_url or "about:blank", timeout=20000)
+            return True
+        except Exception as e:
+            logger.debug(f"Failed to reset a pooled context: {e}")
+            return False
+
+    @staticmethod
+    async def _clear_origin_storage(pooled: PooledContext):
+        cdp_session = await pooled.context.new_cdp_session(pooled.page)
+        try:
+            for origin in pooled.origins:
+                await cdp_session.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        finally:
+            await cdp_session.detach()
+        pooled.origins.clear()
+
+    async def _health_check_loop(self):
+        while not self.closed:
+            await asyncio.sleep(self.health_check_interval)
+            for pooled in list(self.idle):
+                if not await self._is_healthy(pooled) and pooled in self.idle:
+                    logger.info("Drop a hung pooled context")
+                    self.idle.remove(pooled)
+                    await self._discard(pooled)
+            self._refill()
+
+    async def close(self):
+        self.closed = True
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+        for task in list(self.background_tasks):
+            task.cancel()
+        while self.idle:
+            await self._discard(self.idle.popleft())
+        if self.browser is not None:
+            await self.browser.close()
+        if self.playwright is not None:
+            await self.playwright.stop()
@@ -0,0 +1,141 @@
+(() => {
+    if (window.__webcanvasActions) {
+        return;
+    }
+
+    function scrollInfo() {
+        const scrollY = window.scrollY;
+        const viewportHeight = window.innerHeight;
+        const totalHeight = document.documentElement.scrollHeight;
+        return {
+            scrollY: scrollY,
+            viewportHeight: viewportHeight,
+            totalHeight: totalHeight,
+            pixelsAbove: scrollY,
+            pixelsBelow: totalHeight - (scrollY + viewportHeight),
+        };
+    }
+
+    // Matched characters of the longest common substrings of a and b, as counted by Python's difflib.SequenceMatcher
+    function matchingCharacters(a, b) {
+        if (!a.length || !b.length) {
+            return 0;
+        }
+        let bestLength = 0, bestA = 0, bestB = 0;
+        let previous = new Array(b.length + 1).fill(0);
+        for (let i = 1; i <= a.length; i++) {
+            const current = new Array(b.length + 1).fill(0);
+            for (let j = 1; j <= b.length; j++) {
+                if (a[i - 1] === b[j - 1]) {
+                    current[j] = previous[j - 1] + 1;
+                    if (current[j] > bestLength) {
+                        bestLength = current[j];
+                        bestA = i - bestLength;
+                        bestB = j - bestLength;
+                    }
+                }
+            }
+            previous = current;
+        }
+        if (!bestLength) {
+            return 0;
+        }
+        return bestLength
+            + matchingCharacters(a.slice(0, bestA), b.slice(0, bestB))
+            + matchingCharacters(a.slice(bestA + bestLength), b.slice(bestB + bestLength));
+    }
+
+    function similarity(a, b) {
+        const total = a.length + b.length;
+        return total ? 2 * matchingCharacters(a, b) / total : 1;
+    }
+
+    // The element of a target {snapshotId, nodeId, selector}, tagged by the last snapshot or found by its selector
+    function resolveElement(target) {
+        if (typeof target === 'string') {
+            target = { selector: target };
+        }
+        const registry = window.__webcanvasElements;
+        const element = registry && target.snapshotId ? registry.get(target.snapshotId, target.nodeId) : null;
+        if (element || !target.selector) {
+            return element;
+        }
+        try {
+            return document.querySelector(target.selector);
+        } catch (e) {
+            return null;
+        }
+    }
+
+    function queryElement(target) {
+        const element = resolveElement(target);
+        if (!element) {
+            throw new Error(`No element matches ${JSON.stringify(target)}`);
+        }
+        return element;
+    }
+
+    window.__webcanvasActions = {
+        scrollInfo: scrollInfo,
+        resolveElement: resolveElement,
+
+        scrollDown() {
+            const totalHeight = document.body.scrollHeight;
+            const viewportHeight = window.innerHeight;
+            if (totalHeight < viewportHeight) {
+                window.scrollBy(0, 500);
+            }
+            const currentScroll = window.pageYOffset;
+            const remainingHeight = totalHeight - currentScroll - viewportHeight;
+            if (remainingHeight <= viewportHeight) {
+                window.scrollTo(0, document.body.scrollHeight);
+            } else {
+                window.scrollTo(0, currentScroll + viewportHeight * 0.75);
+            }
+            return scrollInfo();
+        },
+
+        scrollUp() {
+            const viewportHeight = window.innerHeight;
+            const currentScroll = window.pageYOffset;
+            if (currentScroll > 0) {
+                window.scrollTo(0, currentScroll < viewportHeight ? 0 : currentScroll - viewportHeight / 2);
+            }
+            return scrollInfo();
+        },
+
+        // Select the option of a select element whose text is the most similar to text
+        selectOption(target, text) {
+            const selectElement = queryElement(target);
+            const options = Array.from(selectElement.querySelectorAll('option'));
+            let best = null;
+            let bestSimilarity = -1;
+            for (const option of options) {
+                const optionSimilarity = similarity(option.innerText, text);
+                if (optionSimilarity > bestSimilarity) {
+                    best = option;
+                    bestSimilarity = optionSimilarity;
+                }
+            }
+            if (best) {
+                best.selected = true;
+                selectElement.dispatchEvent(new Event('input', { bubbles: true }));
+                selectElement.dispatchEvent(new Event('change', { bubbles: true }));
+            }
+            return {
+                options: options.map(option => option.innerText),
+                selectedIndex: selectElement.selectedIndex,
+                value: selectElement.value,
+                text: best ? best.innerText : null,
+                similarity: bestSimilarity,
+            };
+        },
+
+        hover(target) {
+            const element = queryElement(target);
+            element.dispatchEvent(new MouseEvent('mouseover', { bubbles: true }));
+            element.dispatchEvent(new MouseEvent('mouseenter', { bubbles: false }));
+            return scrollInfo();
+        },
+    };
+})();
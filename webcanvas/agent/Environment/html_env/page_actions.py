@@ -0,0 +1,68 @@
+import weakref
+import importlib.resources as resources
+
+from playwright.async_api import Page, ElementHandle
+from playwright.async_api import BrowserContext as PlaywrightBrowserContext
+
+PAGE_ACTIONS_SCRIPT = resources.read_text('webcanvas.agent.Environment.html_env', 'pageActions.js')
+
+# Run an action of the library in one round trip, or report that the document was loaded before it was registered
+RUN_ACTION_SCRIPT = '''([name, args]) => {
+    if (!window.__webcanvasActions) {
+        return {missing: true};
+    }
+    return {result: window.__webcanvasActions[name](...args)};
+}'''
+
+# Resolve an element tagged by the last snapshot, or by its selector, without the action library
+RESOLVE_ELEMENT_SCRIPT = '''(target) => {
+    const registry = window.__webcanvasElements;
+    const element = registry && target.snapshotId ? registry.get(target.snapshotId, target.nodeId) : null;
+    if (element || !target.selector) {
+        return element;
+    }
+    try {
+        return document.querySelector(target.selector);
+    } catch (e) {
+        return null;
+    }
+}'''
+
+# Contexts the action library was registered in
+_registered_contexts = weakref.WeakSet()
+
+
+async def register_page_actions(context: PlaywrightBrowserContext):
+    """Install the in-page action library in every document of the context, once per context"""
+    if context in _registered_contexts:
+        return
+    await context.add_init_script(PAGE_ACTIONS_SCRIPT)
+    _registered_contexts.add(context)
+
+
+async def run_page_action(page: Page, name: str, *args):
+    """
+    Measure and act in the page in a single call to the in-page action library.
+    :param name: scrollInfo, scrollDown, scrollUp, selectOption or hover
+    :return: The scroll or selection state after the action
+    """
+    response = await page.evaluate(RUN_ACTION_SCRIPT, [name, list(args)])
+    if response.get("missing"):
+        # Documents loaded before the library was registered, e.g. pages opened before the context was set up
+        await page.evaluate(PAGE_ACTIONS_SCRIPT)
+        response = await page.evaluate(RUN_ACTION_SCRIPT, [name, list(args)])
+    return response["result"]
+
+
+def element_target(snapshot_id: str, node_id: int, selector: str = None) -> dict:
+    """An element of a snapshot for the in-page actions, with its selector as a fallback for when it is gone"""
+    return {"snapshotId": snapshot_id, "nodeId": node_id, "selector": selector}
+
+
+async def resolve_element(page: Page, target: dict) -> ElementHandle | None:
+    """The element of a target in a single call, None when it is neither tagged nor matched by its selector"""
+    handle = await page.evaluate_handle(RESOLVE_ELEMENT_SCRIPT, target)
+    element_handle = handle.as_element()
+    if element_handle is None:
+        await handle.dispose()
+    return element_handle
@@ -0,0 +1,94 @@
+import base64
+from weakref import WeakKeyDictionary
+
+from playwright.async_api import Page
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class Screenshot(str):
+    """
+    A screenshot as the base64 string prompts and archives use, encoded once by the browser.
+    The raw image bytes are only decoded when they are asked for, e.g. to write the image to disk.
+    """
+
+    def __new__(cls, base64_image: str = "", mime_type: str = "image/png", width: int = 0, height: int = 0):
+        screenshot = super().__new__(cls, base64_image)
+        screenshot.mime_type = mime_type
+        screenshot.width = width
+        screenshot.height = height
+        screenshot._raw_bytes = None
+        return screenshot
+
+    @classmethod
+    def from_bytes(cls, raw_bytes: bytes, mime_type: str = "image/png", width: int = 0, height: int = 0):
+        screenshot = cls(base64.b64encode(raw_bytes).decode("ascii"), mime_type, width, height)
+        screenshot._raw_bytes = raw_bytes
+        return screenshot
+
+    @property
+    def raw_bytes(self) -> bytes:
+        if self._raw_bytes is None:
+            self._raw_bytes = base64.b64decode(str(self))
+        return self._raw_bytes
+
+    @property
+    def extension(self) -> str:
+        return self.mime_type.split("/")[-1]
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self}"
+
+
+class ScreenshotCapturer:
+    """
+    Capture screenshots through the Chrome DevTools Protocol, scaled to the target width and encoded in the target
+    format by the browser, so no image is decoded or re-encoded in Python.
+    Browsers without CDP fall back to Playwright screenshots at the viewport size.
+    """
+
+    def __init__(self, image_format: str = "png", quality: int = 80, width: int = 1080):
+        if image_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported screenshot format {image_format}, expected one of {list(MIME_TYPES)}")
+        self.image_format = image_format
+        self.quality = quality
+        self.width = width
+        # One CDP session per page, None for pages of browsers without CDP
+        self.cdp_sessions = WeakKeyDictionary()
+
+    async def _get_cdp_session(self, page: Page):
+        if page not in self.cdp_sessions:
+            try:
+                self.cdp_sessions[page] = await page.context.new_cdp_session(page)
+            except Exception:
+                self.cdp_sessions[page] = None
+        return self.cdp_sessions[page]
+
+    async def capture(self, page: Page) -> Screenshot:
+        cdp_session = await self._get_cdp_session(page)
+        if cdp_session is None:
+            return await self._capture_with_playwright(page)
+        metrics = await cdp_session.send("Page.getLayoutMetrics")
+        viewport = metrics.get("cssVisualViewport") or metrics["visualViewport"]
+        scale = self.width / viewport["clientWidth"] if self.width else 1
+        params = {
+            "format": self.image_format,
+            "clip": {"x": viewport["pageX"], "y": viewport["pageY"], "width": viewport["clientWidth"],
+                     "height": viewport["clientHeight"], "scale": scale},
+        }
+        if self.image_format != "png":
+            params["quality"] = self.quality
+        result = await cdp_session.send("Page.captureScreenshot", params)
+        return Screenshot(result["data"], MIME_TYPES[self.image_format],
+                          round(viewport["clientWidth"] * scale), round(viewport["clientHeight"] * scale))
+
+    async def _capture_with_playwright(self, page: Page) -> Screenshot:
+        # Playwright screenshots are PNG or JPEG only
+        if self.image_format == "jpeg":
+            raw_bytes = await page.screenshot(type="jpeg", quality=self.quality)
+        else:
+            raw_bytes = await page.screenshot(type="png")
+        viewport = page.viewport_size or {}
+        return Screenshot.from_bytes(raw_bytes, "image/jpeg" if self.image_format == "jpeg" else "image/png",
+                                     viewport.get("width", 0), viewport.get("height", 0))
@@ -2,4 +2,5 @@ from .openai import *
 from .llm_instance import *
 from .token_cal import *
 from .claude import *
-from .token_calculation import *
\ No newline at end of file
+from .token_calculation import *
+from .vision_cache import *
@@ -7,6 +7,7 @@ from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import concurrent
 from webcanvas.logs import logger
+from .token_cal import fit_messages_to_context
 
 
 class ClaudeGenerator:
@@ -19,10 +20,13 @@ class ClaudeGenerator:
         )
         self.pool = concurrent.futures.ThreadPoolExecutor(
             max_workers=multiprocessing.cpu_count() * 2)
+        self.usage = None
 
     async def request(self, messages: list = None, max_tokens: int = 500, temperature: float = 0.7) -> tuple[str, str]:
+        self.usage = None
         loop = asyncio.get_event_loop()
         try:
+            messages = await asyncio.to_thread(fit_messages_to_context, messages, self.model, max_tokens)
             response = await loop.run_in_executor(self.pool, partial(self.chat, messages, max_tokens, temperature))
             return await response, ""
         except Exception as e:
@@ -40,5 +44,14 @@ class ClaudeGenerator:
             'messages': messages,
         }
         response = await self.client.messages.create(**data)
+        if response.usage is not None:
+            # input_tokens excludes the tokens written to and read from the prompt cache
+            cache_creation_input_tokens = getattr(response.usage, "cache_creation_input_tokens", None) or 0
+            cache_read_input_tokens = getattr(response.usage, "cache_read_input_tokens", None) or 0
+            self.usage = {
+                "input_tokens": response.usage.input_tokens + cache_creation_input_tokens + cache_read_input_tokens,
+                "output_tokens": response.usage.output_tokens,
+                "cached_input_tokens": cache_read_input_tokens,
+            }
         return response.content[0].text
 
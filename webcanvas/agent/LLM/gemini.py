@@ -6,17 +6,21 @@ import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
 from sanic.log import logger
 import google.generativeai as genai
+from .token_cal import remove_cache_breakpoints, fit_messages_to_context
 
 
 class GeminiGenerator:
     def __init__(self, model=None):
         self.model = model
         self.pool = ThreadPoolExecutor(max_workers=os.cpu_count() * 2)
+        self.usage = None
 
     async def request(self, messages: list = None, max_tokens: int = 500, temperature: float = 0.7) -> tuple[str, str]:
+        self.usage = None
         genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
         loop = asyncio.get_event_loop()
         try:
+            messages = await asyncio.to_thread(fit_messages_to_context, messages, self.model, max_tokens)
             response = await loop.run_in_executor(self.pool, partial(self.chat, messages, max_tokens, temperature))
             return response, ""
         except Exception as e:
@@ -24,6 +28,7 @@ class GeminiGenerator:
             return "", str(e)
 
     def chat(self, messages, max_tokens=500, temperature=0.7):
+        messages = remove_cache_breakpoints(messages)
         chat_history = []
         for message in messages:
             chat_history.append({"role": "user", "parts": [{"text": message.get("content")}]})
@@ -34,4 +39,11 @@ class GeminiGenerator:
         response = chat.send_message(latest_user_message, generation_config=genai.types.GenerationConfig(
             max_output_tokens=max_tokens,
             temperature=temperature))
+        usage_metadata = getattr(response, "usage_metadata", None)
+        if usage_metadata is not None:
+            self.usage = {
+                "input_tokens": usage_metadata.prompt_token_count,
+                "output_tokens": usage_metadata.candidates_token_count,
+                "cached_input_tokens": getattr(usage_metadata, "cached_content_token_count", None) or 0,
+            }
         return response.text
@@ -4,7 +4,12 @@ from .gemini import GeminiGenerator
 from .togetherai import TogetherAIGenerator
 
 
-def create_llm_instance(model, json_mode=False, all_json_models=None):
+def create_llm_instance(model, json_mode=False, all_json_models=None, base_url=None):
+    if base_url:
+        # Every model is served through the OpenAI-compatible endpoint, e.g. the offline stand-in
+        if json_mode:
+            return GPTGeneratorWithJSON(model, base_url=base_url)
+        return GPTGenerator(model, base_url=base_url)
     if "gpt" in model or "o1" in model:
         if json_mode:
             if model in all_json_models:
@@ -7,19 +7,25 @@ import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
 from sanic.log import logger
 from webcanvas.agent.Utils import *
-from .token_cal import truncate_messages_based_on_estimated_tokens
+from .token_cal import fit_messages_to_context, remove_cache_breakpoints
 from .token_calculation import calculation_of_token, save_token_count_to_file
 
 
 class GPTGenerator:
-    def __init__(self, model=None):
+    def __init__(self, model=None, base_url=None):
         self.model = model
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        if base_url:
+            # OpenAI-compatible endpoints such as the offline stand-in (stand_in.py) may not require an API key
+            self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY", "EMPTY"), base_url=base_url)
+        else:
+            self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.usage = None
 
     async def request(self, messages: list = None, max_tokens: int = 500, temperature: float = 0.7) -> tuple[str, str]:
+        self.usage = None
         try:
-            if "gpt-3.5" in self.model:
-                messages = truncate_messages_based_on_estimated_tokens(messages, max_tokens=16385)
+            messages = remove_cache_breakpoints(messages)
+            messages = await asyncio.to_thread(fit_messages_to_context, messages, self.model, max_tokens)
             if "o1" in self.model:
                 messages = [
                     {**msg, "role": "user"} if msg["role"] == "system" else msg
@@ -36,8 +42,13 @@ class GPTGenerator:
                 if choice.finish_reason == 'length':
                     logger.warning("Response may be truncated due to length. Be cautious when parsing JSON.")
                 openai_response = choice.message.content
-                # output_token_count = future_answer_result.usage.completion_tokens
-                # input_token_count = future_answer_result.usage.prompt_tokens
+                if future_answer_result.usage is not None:
+                    prompt_tokens_details = getattr(future_answer_result.usage, "prompt_tokens_details", None)
+                    self.usage = {
+                        "input_tokens": future_answer_result.usage.prompt_tokens,
+                        "output_tokens": future_answer_result.usage.completion_tokens,
+                        "cached_input_tokens": getattr(prompt_tokens_details, "cached_tokens", None) or 0,
+                    }
                 return openai_response, ""
         except Exception as e:
             logger.error(f"Error in GPTGenerator.request: {e}")
@@ -69,22 +80,22 @@ class JSONModeMixin(GPTGenerator):
     A mixin to add JSON mode support to GPTGenerator classes.
     """
 
-    def __init__(self, model=None):
-        super().__init__(model=model)  # Ensure initialization from base class
+    def __init__(self, model=None, base_url=None):
+        super().__init__(model=model, base_url=base_url)  # Ensure initialization from base class
         self.response_format = {"type": "json_object"}  # Set response format to JSON object
 
     @staticmethod
     def prepare_messages_for_json_mode(messages):
         # Ensure there's a system message instructing the model to generate JSON
-        if not any("json" in message.get('content', '').lower() for message in messages):
+        if not any("json" in str(message.get('content', '')).lower() for message in messages):
             messages.insert(0, {"role": "system", "content": "You are a helpful assistant designed to output json."})
         return messages
 
     async def request(self, messages: list = None, max_tokens: int = 500, temperature: float = 0.7) -> tuple[str, str]:
-        messages = self.prepare_messages_for_json_mode(messages)  # Prepare messages for JSON mode
+        messages = self.prepare_messages_for_json_mode(remove_cache_breakpoints(messages))  # Prepare messages for JSON mode
         return await super().request(messages, max_tokens, temperature)
 
 
 class GPTGeneratorWithJSON(JSONModeMixin):
-    def __init__(self, model=None):
-        super().__init__(model=model if model is not None else "gpt-4-turbo")
+    def __init__(self, model=None, base_url=None):
+        super().__init__(model=model if model is not None else "gpt-4-turbo", base_url=base_url)
@@ -0,0 +1,212 @@
+"""
+An offline, OpenAI-compatible stand-in for LLM providers.
+
+Point `[model] base_url` in setting.toml (or OPENAI_BASE_URL) at this server to run the harness
+end to end without live providers. It serves `/v1/chat/completions` in one of three modes:
+
+- replay: answer with the response recorded for the same prompt, keyed by the prompt hash
+- record: forward requests to an upstream OpenAI-compatible endpoint and save the responses for replay
+- script: answer with the first scripted response whose regex matches the last message of the prompt
+
+Every response is delayed by a latency drawn from a configurable, seeded distribution, so the harness
+overhead (steps/sec, observation cost, evaluator cost) can be measured under repeatable LLM timing.
+
+Usage:
+    python -m webcanvas.agent.LLM.stand_in --mode script --script ./stand_in_script.json --latency uniform:0.5,1.5
+"""
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+
+import json5
+from sanic import Sanic
+from sanic.log import logger
+from sanic.response import json as json_response
+
+from .token_calculation import calculation_of_token
+
+
+def prompt_hash(messages: list) -> str:
+    """
+    Hash the messages of a request, so the same prompt maps to the same recording regardless of the model name.
+    """
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class LatencySampler:
+    """
+    Draw response latencies in seconds from a distribution described as "name:arg1,arg2".
+    Supported: fixed:s, uniform:low,high, normal:mean,std, lognormal:mu,sigma.
+    """
+
+    def __init__(self, spec: str = "fixed:0", seed: int = None):
+        name, _, args = spec.partition(":")
+        self.name = name
+        self.args = [float(arg) for arg in args.split(",") if arg]
+        self.random = random.Random(seed)
+        if self.name not in ["fixed", "uniform", "normal", "lognormal"]:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.name == "fixed":
+            latency = self.args[0] if self.args else 0
+        elif self.name == "uniform":
+            latency = self.random.uniform(*self.args)
+        elif self.name == "normal":
+            latency = self.random.gauss(*self.args)
+        else:
+            latency = self.random.lognormvariate(*self.args)
+        return max(latency, 0)
+
+
+class RecordingStore:
+    """
+    Responses recorded per prompt hash, persisted as one JSON object per line.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.recordings = {}
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        recording = json.loads(line)
+                        self.recordings[recording["prompt_hash"]] = recording
+
+    def get(self, key: str):
+        return self.recordings.get(key)
+
+    def add(self, key: str, content: str, usage: dict):
+        recording = {"prompt_hash": key, "content": content, "usage": usage}
+        self.recordings[key] = recording
+        with open(self.file_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(recording, ensure_ascii=False) + "\n")
+
+
+class ScriptedResponder:
+    """
+    Scripted responses read from a json file:
+    {"rules": [{"pattern": "<regex>", "response": "<text>"}, ...], "default": "<text>"}
+    A rule matches when its pattern is found in the text of the last message of the prompt.
+    """
+
+    def __init__(self, file_path: str):
+        with open(file_path, "r", encoding="utf-8") as file:
+            script = json5.load(file)
+        self.rules = [(re.compile(rule["pattern"], re.S), rule["response"]) for rule in script.get("rules", [])]
+        self.default = script.get("default")
+
+    def respond(self, messages: list):
+        content = messages[-1].get("content", "") if messages else ""
+        if isinstance(content, list):
+            content = "".join(item.get("text", "") for item in content)
+        for pattern, response in self.rules:
+            if pattern.search(content):
+                return response
+        return self.default
+
+
+def completion_response(model: str, content: str, usage: dict) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": usage
+    }
+
+
+def error_response(message: str, status: int):
+    return json_response({"error": {"message": message, "type": "invalid_request_error"}}, status=status)
+
+
+def estimate_usage(messages: list, content: str, model: str) -> dict:
+    prompt_tokens = calculation_of_token(messages, model=model)
+    completion_tokens = calculation_of_token(content, model=model)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def create_app(mode: str, recordings_path: str = None, script_path: str = None, upstream_base_url: str = None,
+               latency: str = "fixed:0", seed: int = None) -> Sanic:
+    app = Sanic("webcanvas_llm_stand_in")
+    app.ctx.mode = mode
+    app.ctx.latency = LatencySampler(latency, seed)
+    app.ctx.recordings = RecordingStore(recordings_path) if recordings_path else None
+    app.ctx.responder = ScriptedResponder(script_path) if script_path else None
+    app.ctx.upstream = None
+    if mode in ["replay", "record"] and app.ctx.recordings is None:
+        raise ValueError(f"--recordings is required in {mode} mode.")
+    if mode == "script" and app.ctx.responder is None:
+        raise ValueError("--script is required in script mode.")
+    if mode == "record":
+        from openai import AsyncOpenAI
+        app.ctx.upstream = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=upstream_base_url)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request):
+        body = request.json
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        key = prompt_hash(messages)
+        started = time.perf_counter()
+
+        if app.ctx.mode == "record":
+            data = {k: v for k, v in body.items() if k != "stream"}
+            upstream_response = await app.ctx.upstream.chat.completions.create(**data)
+            content = upstream_response.choices[0].message.content
+            usage = upstream_response.usage.model_dump() if upstream_response.usage else estimate_usage(
+                messages, content, model)
+            app.ctx.recordings.add(key, content, usage)
+            return json_response(completion_response(model, content, usage))
+
+        if app.ctx.mode == "replay":
+            recording = app.ctx.recordings.get(key)
+            if recording is None:
+                logger.warning(f"No recording found for prompt {key}")
+                return error_response(f"No recording found for prompt {key}", 404)
+            content, usage = recording["content"], recording["usage"]
+        else:
+            content = app.ctx.responder.respond(messages)
+            if content is None:
+                return error_response("No scripted response matches the prompt", 404)
+            usage = estimate_usage(messages, content, model)
+
+        # The simulated latency excludes the time already spent preparing the response
+        await asyncio.sleep(max(app.ctx.latency.sample() - (time.perf_counter() - started), 0))
+        return json_response(completion_response(model, content, usage))
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run an offline OpenAI-compatible stand-in for LLM providers.")
+    parser.add_argument("--mode", choices=["replay", "record", "script"], default="replay")
+    parser.add_argument("--recordings", type=str, default=None, help="JSONL file of recorded responses.")
+    parser.add_argument("--script", type=str, default=None, help="JSON file of scripted responses.")
+    parser.add_argument("--upstream_base_url", type=str, default=None,
+                        help="OpenAI-compatible endpoint to forward requests to in record mode.")
+    parser.add_argument("--latency", type=str, default="fixed:0",
+                        help="Latency distribution in seconds, e.g. fixed:1, uniform:0.5,1.5, normal:1,0.2, lognormal:0,0.5.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+
+    args = parser.parse_args()
+
+    app = create_app(mode=args.mode, recordings_path=args.recordings, script_path=args.script,
+                     upstream_base_url=args.upstream_base_url, latency=args.latency, seed=args.seed)
+    app.run(host=args.host, port=args.port, single_process=True, access_log=False)
@@ -1,9 +1,11 @@
 import os
 import sys
+import asyncio
 import openai
 from openai import AsyncOpenAI
 from sanic.log import logger
 from webcanvas.agent.Utils import *
+from .token_cal import remove_cache_breakpoints, fit_messages_to_context
 import requests
 from sanic.log import logger
 
@@ -15,10 +17,13 @@ class TogetherAIGenerator:
             api_key=os.environ.get("TOGETHER_API_KEY"),
             base_url="https://api.together.xyz/v1"
         )
+        self.usage = None
 
     async def request(self, messages: list = None, max_tokens: int = 500, temperature: float = 0.7
                       ) -> tuple[str, str]:
+        self.usage = None
         try:
+            messages = await asyncio.to_thread(fit_messages_to_context, messages, self.model, max_tokens)
             openai_response = await self.chat(messages, max_tokens, temperature)
             return openai_response, ""
         except Exception as e:
@@ -30,10 +35,16 @@ class TogetherAIGenerator:
             'model': self.model,
             'max_tokens': max_tokens,
             'temperature': temperature,
-            'messages': messages,
+            'messages': remove_cache_breakpoints(messages),
         }
 
         response = await self.client.chat.completions.create(**data)
+        if response.usage is not None:
+            self.usage = {
+                "input_tokens": response.usage.prompt_tokens,
+                "output_tokens": response.usage.completion_tokens,
+                "cached_input_tokens": 0,
+            }
         try:
             message_content = response.choices[0].message.content
             return message_content
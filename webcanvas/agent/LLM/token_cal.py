@@ -1,9 +1,168 @@
+import re
 import json
 
+from .token_calculation import calculation_of_token, calculation_of_images_token, get_encoding
+from webcanvas.logs import logger
+
+
+# Context window of each model family in tokens, matched by the longest prefix of the model name
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-vision-preview": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "o1": 128000,
+    "claude": 200000,
+    "gemini-pro": 32760,
+    "gemini-1.0-pro": 32760,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro": 2097152,
+    "gemini-2.0": 1048576,
+    # Models served through TogetherAI
+    "meta-llama/Meta-Llama-3.1-": 128000,
+    "meta-llama/Llama-3.2-": 128000,
+    "meta-llama/Llama-3.3-": 128000,
+    "meta-llama/Meta-Llama-3-": 8192,
+    "meta-llama/Llama-3-": 8192,
+    "Qwen/Qwen2.5-": 32768,
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": 32768,
+    "mistralai/Mistral-7B-Instruct-v0.3": 32768,
+}
+# Tokens kept free for the message framing that tiktoken does not count
+CONTEXT_WINDOW_MARGIN = 256
+
+OBSERVATION_MARKERS = [
+    "Here is the accessibility tree that you should refer to for this task:\n",
+    "Here is the current accessibility tree that you should refer to:\n",
+    "Here is the accessibility tree that you should refer to:\n",
+]
+OBSERVATION_LINE_PATTERN = re.compile(r"^( *)\[\d+\] (\S+)")
+
+
+# Models without a registered context window that were already warned about
+_unknown_models = set()
+
+
+def get_context_window(model):
+    """Get the context window of a model from the registry, None when the model is not registered."""
+    matches = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not matches:
+        return None
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def _message_chars(messages):
+    chars = 0
+    for message in messages:
+        content = message.get('content') or ""
+        if isinstance(content, list):
+            chars += sum(len(item.get('text', "")) for item in content if item.get('type') == 'text')
+        else:
+            chars += len(content)
+    return chars
+
+
+def _find_observation(messages):
+    """Find the (message index, content item index or None, marker end) of the accessibility tree in the messages."""
+    for message_idx in range(len(messages) - 1, -1, -1):
+        content = messages[message_idx].get('content') or ""
+        items = enumerate(content) if isinstance(content, list) else [(None, {'type': 'text', 'text': content})]
+        for item_idx, item in items:
+            if item.get('type') != 'text':
+                continue
+            for marker in OBSERVATION_MARKERS:
+                position = item['text'].find(marker)
+                if position != -1:
+                    return message_idx, item_idx, position + len(marker)
+    return None
+
+
+def _replace_text(messages, message_idx, item_idx, text):
+    messages = [dict(message) for message in messages]
+    if item_idx is None:
+        messages[message_idx]['content'] = text
+    else:
+        content = [dict(item) for item in messages[message_idx]['content']]
+        content[item_idx]['text'] = text
+        messages[message_idx]['content'] = content
+    return messages
+
+
+def prune_observation(observation, excess_tokens, encoding):
+    """
+    Remove entries of an accessibility tree until it is excess_tokens shorter.
+    An entry is a tree line with the continuation lines of its text, and is removed as a whole. Static text is removed
+    before interactive elements, and deeper entries before shallower ones, so the structure and the actionable
+    elements of the page are kept as long as possible. Lines before the tree, e.g. the tab name, are always kept.
+    """
+    lines = observation.splitlines(keepends=True)
+    entries = []
+    for idx, line in enumerate(lines):
+        match = OBSERVATION_LINE_PATTERN.match(line)
+        if match is not None:
+            depth = len(match.group(1)) // 2
+            entries.append(((1 if match.group(2) == "statictext" else 0, depth, idx), [idx]))
+        elif entries:
+            entries[-1][1].append(idx)
+    removed = set()
+    for _, entry_lines in sorted(entries, reverse=True):
+        if excess_tokens <= 0:
+            break
+        excess_tokens -= len(encoding.encode("".join(lines[idx] for idx in entry_lines)))
+        removed.update(entry_lines)
+    return "".join(line for idx, line in enumerate(lines) if idx not in removed), excess_tokens
+
+
+def fit_messages_to_context(messages, model, max_tokens=500):
+    """
+    Make the messages fit the context window of the model, leaving max_tokens for the response.
+    A cheap character count skips tokenization for prompts that clearly fit. Oversized prompts are shrunk by
+    pruning the accessibility tree observation line by line by priority, and are only cut from the tail
+    as a last resort when there is no observation or pruning it is not enough.
+    Prompts of models without a registered context window are sent unchanged.
+    """
+    context_window = get_context_window(model)
+    if context_window is None:
+        if model not in _unknown_models:
+            _unknown_models.add(model)
+            logger.warning(f"No context window registered for {model}, its prompts are not fitted to the context.")
+        return messages
+    budget = context_window - max_tokens - CONTEXT_WINDOW_MARGIN
+    # A token is at least one character, so prompts with fewer characters than the budget always fit
+    if _message_chars(messages) + calculation_of_images_token(messages, model=model) <= budget:
+        return messages
+    tokens = calculation_of_token(messages, model=model) + calculation_of_images_token(messages, model=model)
+    if tokens <= budget:
+        return messages
+    excess_tokens = tokens - budget
+    logger.warning(f"Prompt of {tokens} tokens exceeds the context window of {model}, pruning the observation.")
+    location = _find_observation(messages)
+    if location is not None:
+        message_idx, item_idx, observation_start = location
+        content = messages[message_idx]['content']
+        text = content if item_idx is None else content[item_idx]['text']
+        observation, excess_tokens = prune_observation(text[observation_start:], excess_tokens, get_encoding(model))
+        messages = _replace_text(messages, message_idx, item_idx, text[:observation_start] + observation)
+        if excess_tokens <= 0:
+            return messages
+    # The tail truncation works on estimated tokens, so scale its limit by the share of the prompt that has to go
+    estimated_limit = estimate_tokens_of_chars(_message_chars(messages)) * budget / (budget + excess_tokens)
+    return truncate_messages_based_on_estimated_tokens(messages, max_tokens=estimated_limit)
+
 
 def estimate_tokens(text):
     """Estimate the number of tokens for a given text."""
-    return len(text) / 4.8
+    return estimate_tokens_of_chars(len(text))
+
+
+def estimate_tokens_of_chars(chars):
+    """Estimate the number of tokens for a given number of characters."""
+    return chars / 4.8
 
 
 def truncate_text(text, max_length):
@@ -45,6 +204,22 @@ def process_content(content, remaining_tokens):
         return content, tokens
 
 
+def remove_cache_breakpoints(messages):
+    """
+    Remove the cache breakpoints marked by PromptAssembler for providers that cache prompt prefixes automatically.
+    Content made up of text parts only is joined back into a single string, which every chat API accepts.
+    """
+    cleaned_messages = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            content = [{key: value for key, value in item.items() if key != 'cache_control'} for item in content]
+            if all(item.get('type') == 'text' for item in content):
+                content = "".join(item['text'] for item in content)
+        cleaned_messages.append({**message, 'content': content})
+    return cleaned_messages
+
+
 def truncate_messages_based_on_estimated_tokens(messages, max_tokens):
     """Truncate a list of messages based on an estimated token limit, using available tokens as fully as possible."""
     current_tokens = 0
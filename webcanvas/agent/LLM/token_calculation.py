@@ -1,6 +1,27 @@
+import io
 import json
+import math
+import base64
+import struct
+import asyncio
+from functools import lru_cache
 
 import tiktoken
+from webcanvas.logs import logger
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model='gpt-3.5-turbo'):
+    """
+    Get the tiktoken encoding of a model. The lookup is cached, so each model is resolved only once.
+    :param model: Model to use for tokenization
+    :return: tiktoken encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"Encoding of model {model} not found. Using default encoding cl100k_base.")
+        return tiktoken.get_encoding("cl100k_base")
 
 
 def calculation_of_token(messages, model='gpt-3.5-turbo', max_tokens=4096):
@@ -11,12 +32,7 @@ def calculation_of_token(messages, model='gpt-3.5-turbo', max_tokens=4096):
     :param max_tokens: Maximum number of tokens allowed
     :return: Number of tokens in the messages
     """
-    # Load encoding for the model
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: Model not found. Using default encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
 
     truncated_messages = []
     current_tokens = 0
@@ -69,6 +85,132 @@ def calculation_of_token(messages, model='gpt-3.5-turbo', max_tokens=4096):
     return current_tokens
 
 
+def get_image_size(image_base64):
+    """
+    Get the width and height of a base64 encoded image.
+    PNG images are read from the IHDR header, and JPEG and WebP screenshots from the headers at the start of the
+    image, without decoding the whole image.
+    :param image_base64: Base64 encoded image, optionally as a data URL
+    :return: (width, height)
+    """
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.split(",", 1)[1]
+    header = base64.b64decode(image_base64[:32])
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", header[16:24])
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(image_base64[:4096]))) as image:
+            return image.size
+    except Exception:
+        with Image.open(io.BytesIO(base64.b64decode(image_base64))) as image:
+            return image.size
+
+
+def _openai_image_token(width, height, model):
+    # High detail: fit into 2048 x 2048, scale the shortest side down to 768, then count 512px tiles
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    if "gpt-4o-mini" in model:
+        return 2833 + 5667 * tiles
+    return 85 + 170 * tiles
+
+
+def _claude_image_token(width, height):
+    # Images whose long edge exceeds 1568px are scaled down before being tokenized
+    scale = min(1, 1568 / max(width, height))
+    return math.ceil(width * scale * height * scale / 750)
+
+
+def _gemini_image_token(width, height):
+    # Small images cost a flat 258 tokens, larger ones are cropped into 768px tiles of 258 tokens each
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+
+def calculation_of_image_token(image_base64, model='gpt-4-turbo'):
+    """
+    Estimate the number of input tokens an image costs, following the tiling rules of the provider of the model.
+    :param image_base64: Base64 encoded image, optionally as a data URL
+    :param model: Model that receives the image
+    :return: Estimated number of image tokens
+    """
+    width, height = get_image_size(image_base64)
+    if "claude" in model:
+        return _claude_image_token(width, height)
+    elif "gemini" in model:
+        return _gemini_image_token(width, height)
+    return _openai_image_token(width, height, model)
+
+
+def calculation_of_images_token(messages, model='gpt-4-turbo'):
+    """
+    Estimate the number of tokens of all images in the messages.
+    :param messages: List of messages to calculate image tokens for
+    :param model: Model that receives the messages
+    :return: Estimated number of image tokens in the messages
+    """
+    image_tokens = 0
+    if isinstance(messages, str):
+        return image_tokens
+    for message in messages:
+        content = message.get('content', None)
+        if not isinstance(content, list):
+            continue
+        for element in content:
+            if element.get('type') == 'image_url':
+                image_tokens += calculation_of_image_token(element['image_url']['url'], model=model)
+    return image_tokens
+
+
+async def get_token_count(llm, request, response) -> list:
+    """
+    Get the input, output, image and cached input token counts of the last request sent by an LLM generator.
+    The usage reported by the provider is used when available, otherwise the tokens are
+    counted locally with tiktoken in a worker thread so the event loop is not blocked.
+    Image tokens are always estimated. Image and cached input tokens are already included in the input token count.
+    :param llm: LLM generator that sent the request
+    :param request: Messages of the request
+    :param response: Text of the response
+    :return: [input_token_count, output_token_count, image_token_count, cached_input_token_count]
+    """
+    image_token_count = calculation_of_images_token(request, model=llm.model)
+    usage = getattr(llm, "usage", None)
+    if usage:
+        return [usage["input_tokens"], usage["output_tokens"], image_token_count, usage.get("cached_input_tokens", 0)]
+    input_token_count = await asyncio.to_thread(calculation_of_token, request, model=llm.model)
+    output_token_count = await asyncio.to_thread(calculation_of_token, response, model=llm.model)
+    return [input_token_count + image_token_count, output_token_count, image_token_count, 0]
+
+
+def add_token_count(token_count, other_token_count) -> list:
+    """
+    Add up two token counts element-wise.
+    :param token_count: [input_token_count, output_token_count, image_token_count, cached_input_token_count]
+    :param other_token_count: [input_token_count, output_token_count, image_token_count, cached_input_token_count]
+    :return: Sum of the token counts
+    """
+    return [count + other_count for count, other_count in zip(token_count, other_token_count)]
+
+
+def input_token_cost(input_token_count, cached_input_token_count, model, token_pricing):
+    """
+    Calculate the cost of input tokens, charging cached input tokens at the discounted price of the model if it is configured.
+    :param input_token_count: Number of input tokens, including the cached ones
+    :param cached_input_token_count: Number of input tokens served from the provider prompt cache
+    :param model: Model the tokens were sent to
+    :param token_pricing: Pricing information for models
+    :return: Cost of the input tokens
+    """
+    input_price = token_pricing[f"{model}_input_price"]
+    cached_input_price = token_pricing.get(f"{model}_cached_input_price", input_price)
+    return (input_token_count - cached_input_token_count) * input_price + cached_input_token_count * cached_input_price
+
+
 def save_token_count_to_file(filename, step_tokens, task_name, global_reward_text_model, planning_text_model, token_pricing):
     """
     Save token count to a file in JSON format.
@@ -78,6 +220,7 @@ def save_token_count_to_file(filename, step_tokens, task_name, global_reward_tex
     :param global_reward_text_model: Model used for reward modeling
     :param planning_text_model: Model used for planning
     :param token_pricing: Pricing information for models
+    :return: The accumulated token counts and costs of the run
     """
 
     try:
@@ -89,8 +232,15 @@ def save_token_count_to_file(filename, step_tokens, task_name, global_reward_tex
                 "total_planning_output_tokens": 0,
                 "total_reward_input_tokens": 0,
                 "total_reward_output_tokens": 0,
+                "total_planning_image_tokens": 0,
+                "total_reward_image_tokens": 0,
+                "total_planning_cached_input_tokens": 0,
+                "total_reward_cached_input_tokens": 0,
                 "total_input_tokens": 0,
                 "total_output_tokens": 0,
+                "total_image_tokens": 0,
+                "total_cached_input_tokens": 0,
+                "cached_input_token_hit_rate": 0,
                 "total_tokens": 0,
                 }
 
@@ -104,8 +254,15 @@ def save_token_count_to_file(filename, step_tokens, task_name, global_reward_tex
     data["total_planning_output_tokens"] += step_tokens["steps_planning_output_token_counts"]
     data["total_reward_input_tokens"] += step_tokens["steps_reward_input_token_counts"]
     data["total_reward_output_tokens"] += step_tokens["steps_reward_output_token_counts"]
+    data["total_planning_image_tokens"] = data.get("total_planning_image_tokens", 0) + step_tokens["steps_planning_image_token_counts"]
+    data["total_reward_image_tokens"] = data.get("total_reward_image_tokens", 0) + step_tokens["steps_reward_image_token_counts"]
     data["total_input_tokens"] += step_tokens["steps_input_token_counts"]
     data["total_output_tokens"] += step_tokens["steps_output_token_counts"]
+    data["total_image_tokens"] = data.get("total_image_tokens", 0) + step_tokens["steps_image_token_counts"]
+    data["total_planning_cached_input_tokens"] = data.get("total_planning_cached_input_tokens", 0) + step_tokens["steps_planning_cached_input_token_counts"]
+    data["total_reward_cached_input_tokens"] = data.get("total_reward_cached_input_tokens", 0) + step_tokens["steps_reward_cached_input_token_counts"]
+    data["total_cached_input_tokens"] = data.get("total_cached_input_tokens", 0) + step_tokens["steps_cached_input_token_counts"]
+    data["cached_input_token_hit_rate"] = data["total_cached_input_tokens"] / data["total_input_tokens"] if data["total_input_tokens"] else 0
     data["total_tokens"] += step_tokens["steps_token_counts"]
 
     # if "total_planning_input_token_cost" not in data:
@@ -117,7 +274,9 @@ def save_token_count_to_file(filename, step_tokens, task_name, global_reward_tex
             data["total_planning_input_token_cost"] = 0
         if "total_planning_output_token_cost" not in data:
             data["total_planning_output_token_cost"] = 0
-        data["total_planning_input_token_cost"] += step_tokens["steps_planning_input_token_counts"] * token_pricing[f"{planning_text_model}_input_price"]
+        data["total_planning_input_token_cost"] += input_token_cost(
+            step_tokens["steps_planning_input_token_counts"], step_tokens["steps_planning_cached_input_token_counts"],
+            planning_text_model, token_pricing)
         data["total_planning_output_token_cost"] += step_tokens["steps_planning_output_token_counts"] * token_pricing[f"{planning_text_model}_output_price"]
 
     if global_reward_text_model in token_pricing["pricing_models"]:
@@ -125,19 +284,17 @@ def save_token_count_to_file(filename, step_tokens, task_name, global_reward_tex
             data["total_reward_input_token_cost"] = 0
         if "total_reward_output_token_cost" not in data:
             data["total_reward_output_token_cost"] = 0
-        data["total_reward_input_token_cost"] += step_tokens["steps_reward_input_token_counts"] * token_pricing[f"{global_reward_text_model}_input_price"]
+        data["total_reward_input_token_cost"] += input_token_cost(
+            step_tokens["steps_reward_input_token_counts"], step_tokens["steps_reward_cached_input_token_counts"],
+            global_reward_text_model, token_pricing)
         data["total_reward_output_token_cost"] += step_tokens["steps_reward_output_token_counts"] * token_pricing[f"{global_reward_text_model}_output_price"]
 
     if planning_text_model in token_pricing["pricing_models"] and global_reward_text_model in token_pricing["pricing_models"]:
-        if "total_input_token_cost" not in data:
-            data["total_input_token_cost"] = 0
-        if "total_output_token_cost" not in data:
-            data["total_output_token_cost"] = 0
-        if "total_token_cost" not in data:
-            data["total_token_cost"] = 0
-        data["total_input_token_cost"] += data["total_planning_input_token_cost"] + data["total_reward_input_token_cost"]
-        data["total_output_token_cost"] += data["total_planning_output_token_cost"] + data["total_reward_output_token_cost"]
-        data["total_token_cost"] += data["total_input_token_cost"] + data["total_output_token_cost"]
+        # The totals are derived from the running planning and reward costs, so they are recomputed rather than accumulated
+        data["total_input_token_cost"] = data["total_planning_input_token_cost"] + data["total_reward_input_token_cost"]
+        data["total_output_token_cost"] = data["total_planning_output_token_cost"] + data["total_reward_output_token_cost"]
+        data["total_token_cost"] = data["total_input_token_cost"] + data["total_output_token_cost"]
 
     with open(filename, 'w') as file:
         json.dump(data, file, indent=4)
+    return data
@@ -0,0 +1,117 @@
+import io
+import json
+import base64
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+from webcanvas.logs import logger
+
+
+def perceptual_hash(screenshot: str, hash_size: int = 16) -> int:
+    """
+    Difference hash (dHash) of a base64 encoded screenshot: the sign of the brightness gradient between neighbouring
+    cells of a (hash_size + 1) x hash_size grayscale thumbnail, as a hash_size * hash_size bit integer.
+    Screenshots of a visually unchanged page have the same hash, re-encoding noise included.
+    """
+    from PIL import Image
+    raw_bytes = getattr(screenshot, "raw_bytes", None) or base64.b64decode(screenshot)
+    with Image.open(io.BytesIO(raw_bytes)) as image:
+        # JPEG screenshots are decoded at a reduced scale, other formats ignore the draft
+        image.draft("L", ((hash_size + 1) * 8, hash_size * 8))
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def prompt_digest(messages: list) -> str:
+    """Digest of a request without its images, so requests differing only by screenshot share a digest"""
+    def strip_images(content):
+        if isinstance(content, list):
+            return [strip_images(element) for element in content]
+        if isinstance(content, dict):
+            if content.get("type") == "image_url":
+                return {"type": "image_url"}
+            return {key: strip_images(value) for key, value in content.items() if key != "cache_control"}
+        return content
+    return hashlib.sha256(json.dumps(strip_images(messages), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class VisionResponseCache:
+    """
+    Responses of vision requests keyed by (perceptual hash of the screenshot, request without the screenshot).
+    A step whose action left the page visually unchanged sends the same request as the previous step, and is served
+    the previous response instead of a new vision request and its image tokens.
+    """
+    _shared = {}
+
+    def __init__(self, max_entries: int = 256, hash_size: int = 16, max_distance: int = 0):
+        """
+        :param max_distance: Hamming distance up to which two screenshot hashes count as the same page
+        """
+        self.max_entries = max_entries
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, config: dict) -> "VisionResponseCache":
+        """The cache shared by every step of a run for the [vision_cache] settings, None when disabled"""
+        if not config.get("enabled", True):
+            return None
+        settings = (config.get("max_entries", 256), config.get("hash_size", 16), config.get("max_distance", 0))
+        if settings not in cls._shared:
+            cls._shared[settings] = cls(*settings)
+        return cls._shared[settings]
+
+    async def screenshot_hash(self, screenshot: str):
+        """Hash a screenshot in a worker thread, once per screenshot. None when it cannot be decoded"""
+        cached = getattr(screenshot, "perceptual_hash", None)
+        if cached is not None:
+            return cached
+        try:
+            value = await asyncio.to_thread(perceptual_hash, screenshot, self.hash_size)
+        except Exception as e:
+            logger.warning(f"Failed to hash the screenshot, it is not cached: {e}")
+            return None
+        try:
+            screenshot.perceptual_hash = value
+        except AttributeError:
+            # Plain str screenshots cannot carry the hash
+            pass
+        return value
+
+    async def get(self, screenshot: str, messages: list):
+        """The cached response to the request for this screenshot, None on a miss"""
+        value = await self.screenshot_hash(screenshot)
+        if value is None:
+            return None
+        key = (value, prompt_digest(messages))
+        response = self.entries.get(key)
+        if response is None and self.max_distance > 0:
+            response = next((cached for (value, digest), cached in self.entries.items() if digest == key[1] and
+                             bin(value ^ key[0]).count("1") <= self.max_distance), None)
+        if response is None:
+            self.misses += 1
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        logger.info(f"Vision response cache hit ({self.hits} hits, {self.misses} misses)")
+        return response
+
+    async def put(self, screenshot: str, messages: list, response):
+        value = await self.screenshot_hash(screenshot)
+        if value is None:
+            return
+        key = (value, prompt_digest(messages))
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
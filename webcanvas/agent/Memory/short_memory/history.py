@@ -1,17 +1,102 @@
 import json5
 
 
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for budgeting the history, about 4 characters per token."""
+    return len(text) // 4 + 1
+
+
+class TraceHistory(list):
+    """
+    The previous trace of a task, appended to step by step.
+    The rendered line of every finished step is cached, so a step only renders what was appended since the last one.
+    With a token budget, older steps are compressed into windowed summaries of their actions, with consecutive
+    repeated actions deduplicated, and the oldest summaries are dropped if the budget is still exceeded.
+    The trace is append-only; the cache is rebuilt if it is shortened.
+    """
+
+    def __init__(self, iterable=(), max_tokens: int = None, summary_window: int = 5):
+        super().__init__(iterable)
+        self.max_tokens = max_tokens
+        self.summary_window = summary_window
+        self._lines = {"planning": [], "reward": []}
+        self._summaries = {}
+
+    def _planning_line(self, idx: int) -> str:
+        # The reflection on a step is given by the global reward of the next step
+        return f'Step{idx+1}:\"Thought: {self[idx]["thought"]}, Action: {self[idx]["action"]}, Reflection: {self[idx+1]["reflection"]}\";\n'
+
+    def _reward_line(self, idx: int) -> str:
+        return f'Step{idx + 1}:\"Thought: {self[idx]["thought"]}, Action: {self[idx]["action"]}, Reflection:{self[idx]["reflection"]}\";\n'
+
+    def _step_lines(self, kind: str, count: int) -> list:
+        lines = self._lines[kind]
+        if len(lines) > count:
+            self._lines = {"planning": [], "reward": []}
+            self._summaries = {}
+            lines = self._lines[kind]
+        render = self._planning_line if kind == "planning" else self._reward_line
+        for idx in range(len(lines), count):
+            text = render(idx)
+            lines.append((text, estimate_tokens(text)))
+        return lines[:count]
+
+    def _summary(self, start: int, end: int) -> tuple:
+        if (start, end) not in self._summaries:
+            actions = []
+            for step in self[start:end]:
+                if actions and actions[-1][0] == step["action"]:
+                    actions[-1][1] += 1
+                else:
+                    actions.append([step["action"], 1])
+            actions_text = "; ".join(action if count == 1 else f"{action} (x{count})" for action, count in actions)
+            text = f'Step{start + 1}-Step{end}:\"Actions: {actions_text}\";\n'
+            self._summaries[(start, end)] = (text, estimate_tokens(text))
+        return self._summaries[(start, end)]
+
+    def _fit(self, lines: list, budget: int) -> str:
+        if self.max_tokens is None or sum(tokens for _, tokens in lines) <= budget:
+            return "".join(text for text, _ in lines)
+        # Keep as many recent steps in full as possible, summarizing the older ones window by window
+        for kept in range(len(lines), -1, -1):
+            older = len(lines) - kept
+            summaries = [self._summary(start, min(start + self.summary_window, older))
+                         for start in range(0, older, self.summary_window)]
+            recent_tokens = sum(tokens for _, tokens in lines[older:])
+            dropped = 0
+            while summaries and recent_tokens + sum(tokens for _, tokens in summaries) > budget:
+                summaries.pop(0)
+                dropped += 1
+            if recent_tokens + sum(tokens for _, tokens in summaries) <= budget or kept == 0:
+                omitted = "(Earlier steps are omitted.)\n" if dropped else ""
+                return omitted + "".join(text for text, _ in summaries) + "".join(text for text, _ in lines[older:])
+        return ""
+
+    def stringfy_for_planning(self, reflection: str = "") -> str:
+        current_trace = self[-1]
+        last_step = f'Specifically in the last step, you gave the following Thought: {current_trace["thought"]}\n You performed the following Action: {current_trace["action"]}\n You had the following Reflection: {reflection}\";\n'
+        if len(self) <= 2:
+            return last_step
+        budget = None if self.max_tokens is None else self.max_tokens - estimate_tokens(last_step)
+        return "[" + self._fit(self._step_lines("planning", len(self) - 1), budget) + "]" + last_step
+
+    def stringfy_for_reward(self) -> str:
+        return "[" + self._fit(self._step_lines("reward", len(self)), self.max_tokens) + "]"
+
+
 class HistoryMemory:
     def __init__(self, previous_trace: list = [], reflection: str = "") -> None:
         self.previous_trace = previous_trace
         self.reflection = reflection
 
     def stringfy_thought_and_action(self) -> str:
+        if isinstance(self.previous_trace, TraceHistory):
+            return self.previous_trace.stringfy_for_planning(self.reflection)
         input_list = None
         str_output = ""
-        try:
+        if isinstance(self.previous_trace, str):
             input_list = json5.loads(self.previous_trace, encoding="utf-8")
-        except:
+        else:
             input_list = self.previous_trace
         if len(input_list) > 2:
             str_output = "["
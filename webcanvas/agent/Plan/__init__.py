@@ -1,2 +1,3 @@
 from .action import *
-from .planning import *
\ No newline at end of file
+from .planning import *
+from .searchbar import *
\ No newline at end of file
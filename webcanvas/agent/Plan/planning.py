@@ -5,6 +5,7 @@ from webcanvas.agent.Prompt import *
 from webcanvas.agent.LLM import *
 from webcanvas.agent.Plan.action import *
 from webcanvas.agent.Plan.action import ResponseError
+from webcanvas.agent.Plan.searchbar import SearchbarClassifier
 from webcanvas.logs import logger
 
 
@@ -28,28 +29,36 @@ class DomMode(InteractionMode):
             f"\033[32mDOM_based_planning_request:\n{planning_request}\033[0m\n")
         logger.info(f"planning_text_model: {self.text_model.model}")
         planning_response, error_message = await self.text_model.request(planning_request)
-        # if "gpt" in self.text_model.model:
-        #     output_token_count = future_answer_result.usage.completion_tokens
-        #     input_token_count = future_answer_result.usage.prompt_tokens
-        input_token_count = calculation_of_token(planning_request, model=self.text_model.model)
-        output_token_count = calculation_of_token(planning_response, model=self.text_model.model)
-        planning_token_count = [input_token_count, output_token_count]
+        planning_token_count = await get_token_count(self.text_model, planning_request, planning_response)
 
         return planning_response, error_message, None, None, planning_token_count
 
 
 class DomVDescMode(InteractionMode):
-    def __init__(self, text_model=None, visual_model=None):
+    def __init__(self, text_model=None, visual_model=None, vision_cache: VisionResponseCache = None):
         super().__init__(text_model, visual_model)
+        self.vision_cache = vision_cache
 
     async def execute(self, status_description, user_request, previous_trace, observation, feedback, observation_VforD):
         if observation_VforD != "":
             vision_desc_request = VisionDisc2PromptConstructor().construct(
                 user_request, observation_VforD)  # vision description request with user_request
             # vision_desc_request = VisionDisc1PromptConstructor().construct(observation_VforD)
-            vision_desc_response, error_message = await self.visual_model.request(vision_desc_request)
+            vision_desc_response = None
+            if self.vision_cache is not None:
+                # The page looks the same as in an earlier step, reuse its description
+                vision_desc_response = await self.vision_cache.get(observation_VforD, vision_desc_request)
+            if vision_desc_response is not None:
+                planning_token_count = [0, 0, 0, 0]
+            else:
+                vision_desc_response, error_message = await self.visual_model.request(vision_desc_request)
+                planning_token_count = await get_token_count(
+                    self.visual_model, vision_desc_request, vision_desc_response)
+                if self.vision_cache is not None and vision_desc_response and not error_message:
+                    await self.vision_cache.put(observation_VforD, vision_desc_request, vision_desc_response)
         else:
             vision_desc_response = ""
+            planning_token_count = [0, 0, 0, 0]
         print(f"\033[36mvision_disc_response:\n{vision_desc_response}")  # blue
         planning_request = ObservationVisionDiscPromptConstructor().construct(
             user_request, previous_trace, observation, feedback, status_description, vision_desc_response)
@@ -57,7 +66,9 @@ class DomVDescMode(InteractionMode):
             f"\033[35mplanning_request:\n{print_limited_json(planning_request, limit=10000)}")
         print("\033[0m")
         planning_response, error_message = await self.text_model.request(planning_request)
-        return planning_response, error_message, None, None
+        planning_token_count = add_token_count(
+            planning_token_count, await get_token_count(self.text_model, planning_request, planning_response))
+        return planning_response, error_message, None, None, planning_token_count
 
 
 class VisionToDomMode(InteractionMode):
@@ -67,9 +78,12 @@ class VisionToDomMode(InteractionMode):
     async def execute(self, status_description, user_request, previous_trace, observation, feedback, observation_VforD):
         vision_act_request = ObservationVisionActPromptConstructor().construct(
             user_request, previous_trace, observation_VforD, feedback, status_description)
+        planning_token_count = [0, 0, 0, 0]
         max_retries = 3
         for attempt in range(max_retries):
             vision_act_response, error_message = await self.visual_model.request(vision_act_request)
+            planning_token_count = add_token_count(
+                planning_token_count, await get_token_count(self.visual_model, vision_act_request, vision_act_response))
             # Blue output
             print(f"\033[36mvision_act_response:\n{vision_act_response}")
             print("\033[0m")  # Reset color
@@ -112,6 +126,8 @@ class VisionToDomMode(InteractionMode):
 
                 # Send the request and wait for the response
                 planning_response_dom, error_message = await self.text_model.request(planning_request)
+                planning_token_count = add_token_count(
+                    planning_token_count, await get_token_count(self.text_model, planning_request, planning_response_dom))
                 print(
                     f"\033[34mVisionToDomplanning_response:\n{planning_response_dom}")
                 print("\033[0m")
@@ -135,7 +151,7 @@ class VisionToDomMode(InteractionMode):
         if attempt == max_retries - 1:
             print("Max retries of vision_act reached. Unable to proceed.")
 
-        return planning_response, error_message, planning_response_thought, planning_response_get
+        return planning_response, error_message, planning_response_thought, planning_response_get, planning_token_count
 
 
 class DVMode(InteractionMode):
@@ -150,7 +166,8 @@ class DVMode(InteractionMode):
             f"\033[32mplanning_request:\n{print_limited_json(planning_request, limit=1000)}")
         print("\033[0m")
         planning_response, error_message = await self.visual_model.request(planning_request)
-        return planning_response, error_message, None, None
+        planning_token_count = await get_token_count(self.visual_model, planning_request, planning_response)
+        return planning_response, error_message, None, None, planning_token_count
 
 
 class VisionMode(InteractionMode):
@@ -164,7 +181,8 @@ class VisionMode(InteractionMode):
         print("\033[0m")
         logger.info("\033[32m%s\033[0m", planning_request)
         planning_response, error_message = await self.visual_model.request(planning_request)
-        return planning_response, error_message, None, None
+        planning_token_count = await get_token_count(self.visual_model, planning_request, planning_response)
+        return planning_response, error_message, None, None, planning_token_count
 
 
 class Planning:
@@ -179,21 +197,25 @@ class Planning:
         feedback,
         mode,
         observation_VforD,
-        status_description
+        status_description,
+        tree=None,
+        current_url=""
     ):
 
-        gpt35 = GPTGenerator(model="gpt-3.5-turbo")
-        gpt4v = GPTGenerator(model="gpt-4-turbo")
+        base_url = config["model"].get("base_url")
+        gpt35 = GPTGenerator(model="gpt-3.5-turbo", base_url=base_url)
+        gpt4v = GPTGenerator(model="gpt-4-turbo", base_url=base_url)
 
         all_json_models = config["model"]["json_models"]
         is_json_response = config["model"]["json_model_response"]
 
         llm_planning_text = create_llm_instance(
-            text_model_name, is_json_response, all_json_models)
+            text_model_name, is_json_response, all_json_models, base_url)
 
         modes = {
             "dom": DomMode(text_model=llm_planning_text),
-            "dom_v_desc": DomVDescMode(visual_model=gpt4v, text_model=llm_planning_text),
+            "dom_v_desc": DomVDescMode(visual_model=gpt4v, text_model=llm_planning_text,
+                                       vision_cache=VisionResponseCache.shared(config.get("vision_cache", {}))),
             "vision_to_dom": VisionToDomMode(visual_model=gpt4v, text_model=llm_planning_text),
             "d_v": DVMode(visual_model=gpt4v),
             "vision": VisionMode(visual_model=gpt4v)
@@ -218,14 +240,21 @@ class Planning:
                 raise
 
         if planning_response_action.get('action') == "fill_form":
-            JudgeSearchbarRequest = JudgeSearchbarPromptConstructor().construct(
-                input_element=observation, planning_response_action=planning_response_action)
-            try:
-                Judge_response, error_message = await gpt35.request(JudgeSearchbarRequest)
-                if Judge_response.lower() == "yes":
-                    planning_response_action['action'] = "fill_search"
-            except:
-                planning_response_action['action'] = "fill_form"
+            # Ask the LLM judge only when the element attributes do not tell whether it is a search bar
+            is_searchbar = SearchbarClassifier.classify(
+                tree, planning_response_action.get('element_id'), current_url) if tree is not None else None
+            if is_searchbar is None:
+                JudgeSearchbarRequest = JudgeSearchbarPromptConstructor().construct(
+                    input_element=observation, planning_response_action=planning_response_action)
+                try:
+                    Judge_response, error_message = await gpt35.request(JudgeSearchbarRequest)
+                    is_searchbar = Judge_response.lower() == "yes"
+                    if tree is not None:
+                        SearchbarClassifier.remember(
+                            tree, planning_response_action.get('element_id'), current_url, is_searchbar)
+                except:
+                    is_searchbar = False
+            planning_response_action['action'] = "fill_search" if is_searchbar else "fill_form"
 
         # The description should include both the thought (returned by LLM) and the action (parsed from the planning response)
         planning_response_action["description"] = {
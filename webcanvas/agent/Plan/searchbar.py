@@ -0,0 +1,107 @@
+import re
+from urllib.parse import urlparse
+
+
+class SearchbarClassifier:
+    """
+    Decide whether the target element of a fill_form action is a search bar from its attributes in the DOM tree,
+    so the LLM judge is only asked when the element is ambiguous.
+    Verdicts are cached per (netloc, selector) for the whole run.
+    """
+    SEARCH_PATTERN = re.compile(r"search|query|keyword|^q$|^s$|find|lookup|搜索|搜尋|検索", re.I)
+    NON_SEARCH_TYPES = {"password", "email", "tel", "number", "date", "datetime-local", "month", "week", "time",
+                        "checkbox", "radio", "file", "hidden", "submit", "button", "color", "range"}
+    TEXT_INPUT_TYPES = {"", "text", "search"}
+    MAX_ANCESTOR_DEPTH = 6
+
+    cache: dict = {}
+
+    @classmethod
+    def classify(cls, tree, element_id, current_url: str = ""):
+        """
+        :param tree: HTMLTree the observation was built from
+        :param element_id: Observation id of the element to fill
+        :param current_url: URL of the current page
+        :return: True for a search bar, False for another form field, None when unsure
+        """
+        try:
+            node = tree.elementNodes[tree.nodeDict[int(element_id)]]
+        except Exception:
+            return None
+        key = cls._cache_key(node, current_url)
+        if key in cls.cache:
+            return cls.cache[key]
+        is_searchbar = cls._classify_node(tree, node)
+        if is_searchbar is not None:
+            cls.cache[key] = is_searchbar
+        return is_searchbar
+
+    @classmethod
+    def remember(cls, tree, element_id, current_url: str, is_searchbar: bool) -> None:
+        """Cache a verdict obtained elsewhere, e.g. from the LLM judge."""
+        try:
+            node = tree.elementNodes[tree.nodeDict[int(element_id)]]
+        except Exception:
+            return
+        cls.cache[cls._cache_key(node, current_url)] = is_searchbar
+
+    @staticmethod
+    def _cache_key(node, current_url: str) -> tuple:
+        return urlparse(current_url).netloc, node.get("selector", "")
+
+    @staticmethod
+    def _attributes(node) -> dict:
+        return {str(k).lower(): str(v).strip().lower() for k, v in (node.get("attributes") or {}).items()}
+
+    @classmethod
+    def _classify_node(cls, tree, node):
+        tag_name = str(node.get("tagName", "")).lower()
+        attributes = cls._attributes(node)
+        role = attributes.get("role", "")
+        input_type = attributes.get("type", "")
+
+        if role in ("search", "searchbox") or input_type == "search" or attributes.get("enterkeyhint") == "search":
+            return True
+        if tag_name == "input" and input_type in cls.NON_SEARCH_TYPES:
+            return False
+        if tag_name not in ("input", "textarea") and role not in ("textbox", "combobox"):
+            return None
+
+        for name in ("name", "id", "placeholder", "aria-label", "title", "class", "autocomplete"):
+            if cls.SEARCH_PATTERN.search(attributes.get(name, "")):
+                return True
+
+        form = None
+        ancestor = node
+        for _ in range(cls.MAX_ANCESTOR_DEPTH):
+            parent_id = ancestor.get("parentId")
+            if not isinstance(parent_id, int) or parent_id < 0:
+                break
+            ancestor = tree.elementNodes[parent_id]
+            ancestor_attributes = cls._attributes(ancestor)
+            if ancestor_attributes.get("role") == "search" or str(ancestor.get("tagName", "")).lower() == "search":
+                return True
+            if str(ancestor.get("tagName", "")).lower() == "form":
+                form = ancestor
+                break
+
+        if form is None:
+            return None
+        form_attributes = cls._attributes(form)
+        if any(cls.SEARCH_PATTERN.search(form_attributes.get(name, "")) for name in ("action", "id", "name", "class")):
+            return True
+        # Login, sign-up and checkout forms have several text fields or a password field
+        text_fields = 0
+        stack = [child_id for child_id in form.get("childIds", []) if isinstance(child_id, int)]
+        while stack:
+            child = tree.elementNodes[stack.pop()]
+            child_tag_name = str(child.get("tagName", "")).lower()
+            child_type = cls._attributes(child).get("type", "")
+            if child_tag_name == "input" and child_type == "password":
+                return False
+            if child_tag_name == "textarea" or (child_tag_name == "input" and child_type in cls.TEXT_INPUT_TYPES):
+                text_fields += 1
+            stack.extend(child_id for child_id in child.get("childIds", []) if isinstance(child_id, int))
+        if text_fields >= 3:
+            return False
+        return None
@@ -1,4 +1,5 @@
 from .prompt_constructor import *
+from .prompt_assembler import *
 from .base_prompts import *
 from .dom_vision_prompts import *
 from .vision_prompts import *
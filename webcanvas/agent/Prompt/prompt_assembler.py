@@ -0,0 +1,57 @@
+from functools import lru_cache
+
+from jinja2 import Template
+
+from ..Utils.utils import image_data_url
+
+
+@lru_cache(maxsize=None)
+def compile_template(source: str) -> Template:
+    """
+    Compile a Jinja template once and reuse it for every later render of the same source.
+    :param source: Template source string
+    :return: Compiled template
+    """
+    return Template(source)
+
+
+class PromptAssembler:
+    """
+    Assemble a prompt from sections ordered from the most stable to the least stable content.
+    Providers cache prompts by prefix, so keeping the content that is identical across the steps of a task
+    (system prompt, task) in front of the content that changes every step (history, observation)
+    lets the repeated prefix be served from the provider cache.
+    A cache breakpoint is marked on the last section of every non-volatile level for providers that
+    need explicit breakpoints (Anthropic). Other generators remove the marks before sending the request.
+    """
+    STABLE = 0  # Identical for every step of a task, e.g. the task and reference guide
+    GROWING = 1  # Only appended to between steps, e.g. the previous trace
+    VOLATILE = 2  # Changes every step, e.g. the status description, feedback and observation
+
+    def __init__(self, prompt_system: str):
+        self.prompt_system = prompt_system
+        self.sections = []
+
+    def add_text(self, text: str, stability: int = VOLATILE):
+        self.sections.append(
+            (stability, {"type": "text", "text": text}))
+        return self
+
+    def add_image(self, base64_image: str, stability: int = VOLATILE):
+        self.sections.append(
+            (stability, {"type": "image_url", "image_url": {"url": image_data_url(base64_image)}}))
+        return self
+
+    def build(self) -> list:
+        # sorted() is stable, so sections of the same level keep the order they were added in
+        sections = sorted(self.sections, key=lambda section: section[0])
+        prompt_elements = []
+        for idx, (stability, element) in enumerate(sections):
+            element = dict(element)
+            is_last_of_level = idx == len(sections) - 1 or sections[idx + 1][0] != stability
+            if stability != self.VOLATILE and is_last_of_level:
+                element["cache_control"] = {"type": "ephemeral"}
+            prompt_elements.append(element)
+        messages = [{"role": "system", "content": self.prompt_system},
+                    {"role": "user", "content": prompt_elements}]
+        return messages
@@ -1,4 +1,4 @@
-from ..Utils.utils import is_valid_base64
+from ..Utils.utils import is_valid_base64, image_data_url
 import json5
 
 from .vision_to_dom_prompts import VisionToDomPrompts
@@ -6,10 +6,10 @@ from .dom_vision_disc_prompts import DomVisionDiscPrompts
 from .base_prompts import BasePrompts
 from .dom_vision_prompts import DomVisionPrompts
 from .vision_prompts import VisionPrompts
-from jinja2 import Template
+from .prompt_assembler import PromptAssembler, compile_template
 
 
-from webcanvas.agent.Memory.short_memory.history import HistoryMemory
+from webcanvas.agent.Memory.short_memory.history import HistoryMemory, TraceHistory
 
 
 class BasePromptConstructor:
@@ -31,24 +31,27 @@ class PlanningPromptConstructor(BasePromptConstructor):
             feedback: str = "",
             status_description: str = ""
     ) -> list:
-        self.prompt_user = Template(self.prompt_user).render(
-            user_request=user_request)
+        assembler = PromptAssembler(self.prompt_system)
+        assembler.add_text(compile_template(self.prompt_user).render(
+            user_request=user_request), PromptAssembler.STABLE)
         if len(previous_trace) > 0:
-            self.prompt_user += HistoryMemory(
-                previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt()
+            assembler.add_text(HistoryMemory(
+                previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt(),
+                PromptAssembler.GROWING)
             if status_description != "":
-                self.prompt_user += \
-                    f"Task completion description is {status_description}"
+                assembler.add_text(
+                    f"Task completion description is {status_description}")
             if feedback != "":
-                self.prompt_user += f"Here are some other things you need to know:\n {feedback}\n"
-            self.prompt_user += f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}"
-        messages = [{"role": "system", "content": self.prompt_system}, {
-            "role": "user", "content": self.prompt_user}]
-        return messages
+                assembler.add_text(f"Here are some other things you need to know:\n {feedback}\n")
+            assembler.add_text(f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}")
+        return assembler.build()
 
     # Previous thought, action and reflection are converted to formatted strings
     def stringfy_thought_and_action(self, input_list: list) -> str:
-        input_list = json5.loads(input_list, encoding="utf-8")
+        if isinstance(input_list, TraceHistory):
+            return input_list.stringfy_for_reward()
+        if isinstance(input_list, str):
+            input_list = json5.loads(input_list, encoding="utf-8")
         str_output = "["
         for idx, i in enumerate(input_list):
             str_output += f'Step{idx + 1}:\"Thought: {i["thought"]}, Action: {i["action"]}, Reflection:{i["reflection"]}\";\n'
@@ -67,11 +70,11 @@ class VisionDisc2PromptConstructor(BasePromptConstructor):
             user_request: str,
             base64_image: str
     ) -> list:
-        rendered_prompt = Template(self.prompt_user).render(
+        rendered_prompt = compile_template(self.prompt_user).render(
             user_request=user_request)
         prompt_elements = [{"type": "text", "text": rendered_prompt},
                            {"type": "text", "text": "current web page screenshot is:"},
-                           {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]
+                           {"type": "image_url", "image_url": {"url": image_data_url(base64_image)}}]
 
         # Construct the final message payload
         messages = [{"role": "system", "content": self.prompt_system},
@@ -89,7 +92,7 @@ class VisionDisc1PromptConstructor(BasePromptConstructor):
             base64_image: str
     ) -> list:
         prompt_elements = [{"type": "text", "text": "current web page screenshot is:"},
-                           {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]
+                           {"type": "image_url", "image_url": {"url": image_data_url(base64_image)}}]
 
         # Construct the final message payload
         messages = [{"role": "system", "content": self.prompt_system},
@@ -112,23 +115,23 @@ class ObservationVisionDiscPromptConstructor(BasePromptConstructor):
             status_description: str = "",
             vision_disc_response: str = ""
     ) -> list:
-        self.prompt_user = Template(self.prompt_user).render(
-            user_request=user_request)
+        assembler = PromptAssembler(self.prompt_system)
+        assembler.add_text(compile_template(self.prompt_user).render(
+            user_request=user_request), PromptAssembler.STABLE)
         if len(previous_trace) > 0:
-            self.prompt_user += HistoryMemory(
-                previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt()
+            assembler.add_text(HistoryMemory(
+                previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt(),
+                PromptAssembler.GROWING)
             # if status_description != "":
-            #     self.prompt_user += \
-            #         f"Task completion description is {status_description}"
+            #     assembler.add_text(
+            #         f"Task completion description is {status_description}")
             if feedback != "":
-                self.prompt_user += f"An invalid action description is below:\n {feedback}\n"
-            self.prompt_user += f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}"
+                assembler.add_text(f"An invalid action description is below:\n {feedback}\n")
+            assembler.add_text(f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}")
             if vision_disc_response:
-                self.prompt_user += "\n\nHere is a visual analysis of the webpage's screenshot:\n" + \
-                    vision_disc_response
-        messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": self.prompt_user}]
-        return messages
+                assembler.add_text("\n\nHere is a visual analysis of the webpage's screenshot:\n" +
+                                   vision_disc_response)
+        return assembler.build()
 
     # Convert previous thought and action into formatted string
     def stringfy_thought_and_action(self, input_list: list) -> str:
@@ -154,29 +157,24 @@ class ObservationVisionActPromptConstructor(BasePromptConstructor):
             feedback: str = "",
             status_description: str = ""
     ) -> list:
-        rendered_prompt = Template(self.prompt_user).render(
-            user_request=user_request)
-        prompt_elements = [{"type": "text", "text": rendered_prompt}]
+        assembler = PromptAssembler(self.prompt_system)
+        assembler.add_text(compile_template(self.prompt_user).render(
+            user_request=user_request), PromptAssembler.STABLE)
         if len(previous_trace) > 0:
             # history_memory = HistoryMemory(previous_trace=previous_trace)
             # trace_prompt = history_memory.construct_previous_trace_prompt()
             trace_prompt = HistoryMemory(
                 previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt()
-            prompt_elements.append({"type": "text", "text": trace_prompt})
+            assembler.add_text(trace_prompt, PromptAssembler.GROWING)
             # if status_description != "":
-            #     prompt_elements.append({"type": "text", "text": f"Task completion description is {status_description}"})
+            #     assembler.add_text(f"Task completion description is {status_description}")
             if feedback != "":
-                prompt_elements.append(
-                    {"type": "text", "text": f"An invalid action description is below:\n {feedback}\n"})
-            # prompt_elements.append({"type": "text", "text": f"The current webpage's URL is {url}"})
+                assembler.add_text(f"An invalid action description is below:\n {feedback}\n")
+            # assembler.add_text(f"The current webpage's URL is {url}")
             if observation_vision:
-                prompt_elements.append(
-                    {"type": "text", "text": "The current webpage's screenshot is:"})
-                prompt_elements.append(
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{observation_vision}"}})
-        messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": prompt_elements}]
-        # print(prompt_elements)
+                assembler.add_text("The current webpage's screenshot is:")
+                assembler.add_image(observation_vision)
+        messages = assembler.build()
         print("messages finished!\n")
         return messages
 
@@ -194,13 +192,13 @@ class VisionToDomPromptConstructor(BasePromptConstructor):
             action_description: str,
             observation: str
     ) -> list:
-        # self.prompt_user = Template(self.prompt_user).render(user_request=user_request)
-        self.prompt_user += f"Target Element Description: {target_element}\n"
+        # prompt_user = compile_template(self.prompt_user).render(user_request=user_request)
+        prompt_user = self.prompt_user + f"Target Element Description: {target_element}\n"
         if action_description:
-            self.prompt_user += f"Action Description: {action_description}\n"
-        self.prompt_user += "\nHere is the accessibility tree that you should refer to for this task:\n" + observation
+            prompt_user += f"Action Description: {action_description}\n"
+        prompt_user += "\nHere is the accessibility tree that you should refer to for this task:\n" + observation
         messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": self.prompt_user}]
+                    {"role": "user", "content": prompt_user}]
         return messages
 
 
@@ -222,37 +220,31 @@ class D_VObservationPromptConstructor(BasePromptConstructor):
         is_valid, message = is_valid_base64(
             observation_VforD)
         print("prompt_constructor.py D_VObservationPromptConstructor:", message, "\n")
-        rendered_prompt = Template(self.prompt_user).render(
-            user_request=user_request)
-        prompt_elements = [{"type": "text", "text": rendered_prompt}]
+        assembler = PromptAssembler(self.prompt_system)
+        assembler.add_text(compile_template(self.prompt_user).render(
+            user_request=user_request), PromptAssembler.STABLE)
         if len(previous_trace) > 0:
             # history_memory = HistoryMemory(previous_trace=previous_trace)
             trace_prompt = HistoryMemory(
                 previous_trace=previous_trace, reflection=status_description).construct_previous_trace_prompt()
             # trace_prompt = history_memory.construct_previous_trace_prompt()
-            prompt_elements.append({"type": "text", "text": trace_prompt})
+            assembler.add_text(trace_prompt, PromptAssembler.GROWING)
             # if status_description != "":
-            #     prompt_elements.append({"type": "text", "text": f"Task completion description is {status_description}"})
+            #     assembler.add_text(f"Task completion description is {status_description}")
             if feedback != "":
-                prompt_elements.append(
-                    {"type": "text", "text": f"There an invalid action description is below:\n {feedback}\n"})
-            prompt_elements.append(
-                {"type": "text", "text": f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}"})
-            prompt_elements.append(
-                {"type": "text", "text": "current screenshot is:"})
+                assembler.add_text(f"There an invalid action description is below:\n {feedback}\n")
+            assembler.add_text(f"\nHere is the accessibility tree that you should refer to for this task:\n{observation}")
+            assembler.add_text("current screenshot is:")
             print("len of prompt_elements before observation_VforD:",
-                  len(prompt_elements))
-            prompt_elements_str = json5.dumps(prompt_elements)
+                  len(assembler.sections))
+            prompt_elements_str = json5.dumps([element for _, element in assembler.sections])
             print("len of prompt_elements_str before observation_VforD:", len(
                 prompt_elements_str)) # This will print the length of prompt_elements converted into JSON string
             print("len of about gpt token of prompt_elements_str before observation_VforD:", len(
                 prompt_elements_str) / 5.42, "\n")
-            prompt_elements.append(
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{observation_VforD}"}})
+            assembler.add_image(observation_VforD)
         # Construct the final message payload
-        messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": prompt_elements}]
-        # print(prompt_elements)
+        messages = assembler.build()
         print("messages finished!\n")
         return messages
 
@@ -272,23 +264,19 @@ class VisionObservationPromptConstructor(BasePromptConstructor):
         self.prompt_user = VisionPrompts.vision_prompt_user
 
     def construct(self, user_request: str, previous_trace: str, base64_image: str) -> list:
-        rendered_prompt = Template(self.prompt_user).render(
-            user_request=user_request)
-        prompt_elements = [{"type": "text", "text": rendered_prompt}]
+        assembler = PromptAssembler(self.prompt_system)
+        assembler.add_text(compile_template(self.prompt_user).render(
+            user_request=user_request), PromptAssembler.STABLE)
 
         if len(previous_trace) > 0:
             history_memory = HistoryMemory(previous_trace=[previous_trace])
             trace_prompt = history_memory.construct_previous_trace_prompt()
-            prompt_elements.append({"type": "text", "text": trace_prompt})
+            assembler.add_text(trace_prompt, PromptAssembler.GROWING)
 
-            prompt_elements.append(
-                {"type": "text", "text": "The current observation is:"})
-            prompt_elements.append(
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
+            assembler.add_text("The current observation is:")
+            assembler.add_image(base64_image)
 
-        messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": prompt_elements}]
-        return messages
+        return assembler.build()
 
     def stringfy_thought_and_action(self, input_list: list) -> str:
         input_list = json5.loads(input_list, encoding="utf-8")
@@ -315,33 +303,29 @@ class RewardPromptConstructor(BasePromptConstructor):
             current_info=None,
             instruction: str = ""
     ) -> list:
+        prompt_system = self.prompt_system
         if ground_truth_mode:
-            self.prompt_system = BasePrompts.global_reward_with_GroundTruth_prompt_system
-        rendered_prompt = Template(self.prompt_user).render(
+            prompt_system = BasePrompts.global_reward_with_GroundTruth_prompt_system
+        assembler = PromptAssembler(prompt_system)
+        # The reference guide is fixed for a task, so it is placed in the stable prefix ahead of the trace
+        if ground_truth_mode:
+            assembler.add_text(
+                f"Here is the Reference Guide for the target task:\n\n{instruction}\n\n", PromptAssembler.STABLE)
+        rendered_prompt = compile_template(self.prompt_user).render(
             user_request=user_request, stringfy_thought_and_action_output=stringfy_thought_and_action_output)
-        prompt_elements = [{"type": "text", "text": rendered_prompt}]
+        assembler.add_text(rendered_prompt, PromptAssembler.GROWING)
         if 'current_url' in current_info:
             current_url = current_info.get('current_url', 'not available')
-            prompt_elements.append(
-                {"type": "text", "text": f"The current url is {current_url}"})
-        prompt_elements.append(
-            {"type": "text", "text": f"Here is the current accessibility tree that you should refer to:\n{observation}"})
+            assembler.add_text(f"The current url is {current_url}")
+        assembler.add_text(f"Here is the current accessibility tree that you should refer to:\n{observation}")
         if "vision" in global_reward_mode:
             if "vision_reward" in current_info and current_info['vision_reward']:
-                prompt_elements.append(
-                    {"type": "text", "text": "The current screenshot is:"})
-                prompt_elements.append(
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{current_info['vision_reward']}"}})
+                assembler.add_text("The current screenshot is:")
+                assembler.add_image(current_info['vision_reward'])
             else:
-                prompt_elements.append(
-                    {"type": "text", "text": "The current screenshot is not available."})
+                assembler.add_text("The current screenshot is not available.")
                 print("The current screenshot for vision reward is not available.")
-        if ground_truth_mode:
-            prompt_elements.append(
-                {"type": "text", "text": f"Here is the Reference Guide for the target task:\n\n{instruction}"})
-        messages = [{"role": "system", "content": self.prompt_system},
-                    {"role": "user", "content": prompt_elements}]
-        return messages
+        return assembler.build()
 
 
 # Construct prompt for textual reward
@@ -357,12 +341,12 @@ class CurrentRewardPromptConstructor(BasePromptConstructor):
             stringfy_current_trace_output: str,
             observation: str
     ) -> list:
-        self.prompt_user = Template(self.prompt_user).render(
+        prompt_user = compile_template(self.prompt_user).render(
             user_request=user_request, stringfy_previous_trace_output=stringfy_previous_trace_output,
             stringfy_current_trace_output=stringfy_current_trace_output)
-        self.prompt_user += f"\nHere is the accessibility tree that you should refer to:\n{observation}"
+        prompt_user += f"\nHere is the accessibility tree that you should refer to:\n{observation}"
         messages = [{"role": "system", "content": self.prompt_system}, {
-            "role": "user", "content": self.prompt_user}]
+            "role": "user", "content": prompt_user}]
         return messages
 
 
@@ -383,16 +367,16 @@ class VisionRewardPromptConstructor(BasePromptConstructor):
         if not is_valid_base64(observation_VforD):
             print("The observation_VforD provided is not a valid Base64 encoding")
 
-        self.prompt_user = Template(self.prompt_user).render(
+        prompt_user = compile_template(self.prompt_user).render(
             user_request=user_request, stringfy_previous_trace_output=stringfy_previous_trace_output,
             stringfy_current_trace_output=stringfy_current_trace_output)
-        self.prompt_user += f"the key information of current web page is: {observation}"
-        prompt_elements = [{"type": "text", "text": self.prompt_user}]
+        prompt_user += f"the key information of current web page is: {observation}"
+        prompt_elements = [{"type": "text", "text": prompt_user}]
 
         prompt_elements.append(
             {"type": "text", "text": "the screenshot of current web page is :"})
         prompt_elements.append(
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{observation_VforD}"}})
+            {"type": "image_url", "image_url": {"url": image_data_url(observation_VforD)}})
 
         messages = [{"role": "system", "content": self.prompt_system},
                     {"role": "user", "content": prompt_elements}]
@@ -408,11 +392,11 @@ class JudgeSearchbarPromptConstructor(BasePromptConstructor):
     # Build a prompt to determine whether it is a search box, and output a format that can be parsed by openai
     # TODO decoded_result
     def construct(self, input_element, planning_response_action) -> list:
-        self.prompt_user = Template(self.prompt_user).render(input_element=str(
+        prompt_user = compile_template(self.prompt_user).render(input_element=str(
             input_element), element_id=planning_response_action['element_id'],
             action_input=planning_response_action['action_input'])
         messages = [{"role": "system", "content": self.prompt_system}, {
-            "role": "user", "content": self.prompt_user}]
+            "role": "user", "content": prompt_user}]
         return messages
 
 
@@ -422,8 +406,8 @@ class SemanticMatchPromptConstructor(BasePromptConstructor):
         self.prompt_user = BasePrompts.semantic_match_prompt_user
 
     def construct(self, input_answer, semantic_method) -> list:
-        self.prompt_user = Template(self.prompt_user).render(
+        prompt_user = compile_template(self.prompt_user).render(
             semantic_method=semantic_method, input_answer=input_answer)
         messages = [{"role": "system", "content": self.prompt_system}, {
-            "role": "user", "content": self.prompt_user}]
+            "role": "user", "content": prompt_user}]
         return messages
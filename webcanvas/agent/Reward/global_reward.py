@@ -8,16 +8,20 @@ from webcanvas.logs import logger
 
 
 class InteractionMode:
-    def __init__(self, text_model=None, visual_model=None):
+    def __init__(self, text_model=None, visual_model=None, vision_cache: VisionResponseCache = None):
         self.text_model = text_model
         self.visual_model = visual_model
+        self.vision_cache = vision_cache
 
     async def get_global_reward(self, user_request, previous_trace, observation, current_info, ground_truth_mode,
                                 global_reward_mode, ground_truth_data=None, task_name_id=None):
         reward_response = None
         reward_input_token_count = 0
         reward_output_token_count = 0
-        reward_token_count = [reward_input_token_count, reward_output_token_count]
+        reward_image_token_count = 0
+        reward_cached_input_token_count = 0
+        reward_token_count = [reward_input_token_count, reward_output_token_count, reward_image_token_count,
+                              reward_cached_input_token_count]
         if len(previous_trace) > 0:
             stringfy_thought_and_action_output = PlanningPromptConstructor().stringfy_thought_and_action(
                 previous_trace)
@@ -30,18 +34,17 @@ class InteractionMode:
                     observation=observation,
                     current_info=current_info)
             elif ground_truth_mode:
-                for item in ground_truth_data:
-                    if item.get("index") == task_name_id:
-                        instruction = item["instruction"]
-                        reward_request = RewardPromptConstructor().construct(
-                            ground_truth_mode=ground_truth_mode,
-                            global_reward_mode=global_reward_mode,
-                            user_request=user_request,
-                            stringfy_thought_and_action_output=stringfy_thought_and_action_output,
-                            observation=observation,
-                            current_info=current_info,
-                            instruction=instruction)
-                        break
+                # Human-labeled references are indexed by task index, see dataset_bundle.load_ground_truth
+                instruction = ground_truth_data.get(task_name_id) if ground_truth_data else None
+                if instruction is not None:
+                    reward_request = RewardPromptConstructor().construct(
+                        ground_truth_mode=ground_truth_mode,
+                        global_reward_mode=global_reward_mode,
+                        user_request=user_request,
+                        stringfy_thought_and_action_output=stringfy_thought_and_action_output,
+                        observation=observation,
+                        current_info=current_info,
+                        instruction=instruction)
                 else:
                     logger.info("Running reward modeling without human-labeled reference.")
                     reward_request = RewardPromptConstructor().construct(
@@ -54,22 +57,34 @@ class InteractionMode:
             print_info(
                 f"Global_Reward_Request:\n{print_limited_json(reward_request, limit=1000)}", "\033[32m")  # green
             response_str = ""
-            for i in range(3):
+            screenshot = current_info.get("vision_reward") if "vision" in global_reward_mode else None
+            if self.vision_cache is not None and screenshot:
+                # The same trace on a visually unchanged page was already rewarded
+                response_str = await self.vision_cache.get(screenshot, reward_request) or ""
+                if response_str:
+                    reward_response = ActionParser().extract_status_and_description(response_str)
+            for i in range(3 if not response_str else 0):
                 try:
                     if "vision" in global_reward_mode:
                         # TODO
-                        response_str, error_message = await self.visual_model.request(reward_request)
+                        reward_model = self.visual_model
                     else:
                         print_info(
                             f"using gpt_global_reward_text: {self.text_model.model}", "purple")
-                        response_str, error_message = await self.text_model.request(reward_request)
+                        reward_model = self.text_model
+                    response_str, error_message = await reward_model.request(reward_request)
                     reward_response = ActionParser().extract_status_and_description(
                         response_str)
-                    input_token_count = calculation_of_token(reward_request, model=self.text_model.model)
-                    output_token_count = calculation_of_token(response_str, model=self.text_model.model)
+                    input_token_count, output_token_count, image_token_count, cached_input_token_count = await get_token_count(
+                        reward_model, reward_request, response_str)
                     reward_input_token_count += input_token_count
                     reward_output_token_count += output_token_count
-                    reward_token_count = [reward_input_token_count, reward_output_token_count]
+                    reward_image_token_count += image_token_count
+                    reward_cached_input_token_count += cached_input_token_count
+                    reward_token_count = [reward_input_token_count, reward_output_token_count, reward_image_token_count,
+                                          reward_cached_input_token_count]
+                    if self.vision_cache is not None and screenshot and not error_message:
+                        await self.vision_cache.put(screenshot, reward_request, response_str)
                     break
                 except Exception as e:
                     logger.error(traceback.format_exc())
@@ -101,15 +116,19 @@ class GlobalReward:
         ground_truth_data,
     ):
 
-        gpt4v = GPTGenerator(model="gpt-4-turbo")
+        base_url = config["model"].get("base_url")
+        gpt4v = GPTGenerator(model="gpt-4-turbo", base_url=base_url)
 
         all_json_models = config["model"]["json_models"]
         is_json_response = config["model"]["json_model_response"]
 
         llm_global_reward_text = create_llm_instance(
-            model_name, is_json_response, all_json_models)
+            model_name, is_json_response, all_json_models, base_url)
         
-        _, reward_response, reward_token_count = await InteractionMode(text_model=llm_global_reward_text, visual_model=gpt4v).get_global_reward(
+        vision_cache = VisionResponseCache.shared(config.get("vision_cache", {})) \
+            if "vision" in global_reward_mode else None
+        _, reward_response, reward_token_count = await InteractionMode(
+            text_model=llm_global_reward_text, visual_model=gpt4v, vision_cache=vision_cache).get_global_reward(
             user_request=user_request, previous_trace=previous_trace, observation=observation,
             current_info=current_info, ground_truth_mode=ground_truth_mode, global_reward_mode=global_reward_mode,
             ground_truth_data=ground_truth_data, task_name_id=task_name_id)
@@ -1,10 +1,10 @@
 import json5
+import re
 import base64
 # used for save_screenshot
 import os
-from PIL import Image
-from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 # used for download_data and upload_result
 import requests
 import json
@@ -54,8 +54,21 @@ def read_json_file(file_path):
         return f"File not found: {file_path}"
 
 
+# Screenshots are written to disk off the event loop
+SCREENSHOT_WRITER = ThreadPoolExecutor(max_workers=2, thread_name_prefix="screenshot_writer")
+
+
+def _write_screenshot(screenshot_filename: str, screenshot_base64: str):
+    raw_bytes = getattr(screenshot_base64, "raw_bytes", None) or base64.b64decode(screenshot_base64)
+    with open(screenshot_filename, "wb") as file:
+        file.write(raw_bytes)
+
+
 def save_screenshot(mode: str, record_time: str, task_name: str, step_number: int, description: str,
                     screenshot_base64: str, task_name_id: str = None):
+    """Queue a screenshot to be written as it was encoded, without decoding the image, and return at once"""
+    if not screenshot_base64:
+        return None
 
     timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
     invalid_chars = '<>:"/\\|?*'
@@ -69,12 +82,10 @@ def save_screenshot(mode: str, record_time: str, task_name: str, step_number: in
     if not os.path.exists(task_folder):
         os.makedirs(task_folder)
 
-    image_data = base64.b64decode(screenshot_base64)
-    image = Image.open(BytesIO(image_data))
+    extension = image_mime_type(screenshot_base64).split("/")[-1]
+    screenshot_filename = f'{task_folder}/Step{step_number}_{timestamp}_{description}.{extension}'
 
-    screenshot_filename = f'{task_folder}/Step{step_number}_{timestamp}_{description}.png'
-
-    image.save(screenshot_filename)
+    return SCREENSHOT_WRITER.submit(_write_screenshot, screenshot_filename, screenshot_base64)
 
 
 def print_limited_json(obj, limit=500, indent=0):
@@ -124,6 +135,9 @@ def print_info(info, color):
         print(f"{color}{info}\033[0m")  # \033[0m
 
 
+BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+
 def is_valid_base64(s):
     """
     Validate if a given string is a valid Base64 encoded string.
@@ -144,11 +158,29 @@ def is_valid_base64(s):
     if len(s) == 0:
         return False, "The string is empty."
 
-    try:
-        base64.b64decode(s, validate=True)
+    # Check the alphabet and padding instead of decoding the whole image
+    if len(s) % 4 == 0 and BASE64_PATTERN.fullmatch(s):
         return True, "The string is a valid Base64 encoded string."
-    except ValueError:
-        return False, "The string is NOT a valid Base64 encoded string."
+    return False, "The string is NOT a valid Base64 encoded string."
+
+
+# Leading base64 characters of the magic numbers of each image format
+IMAGE_SIGNATURES = {"iVBORw0KGgo": "image/png", "/9j/": "image/jpeg", "UklGR": "image/webp", "R0lGOD": "image/gif"}
+
+
+def image_mime_type(base64_image: str) -> str:
+    """The MIME type of a base64 encoded image, from the screenshot that carries it or from its leading bytes"""
+    mime_type = getattr(base64_image, "mime_type", None)
+    if mime_type:
+        return mime_type
+    for signature, mime_type in IMAGE_SIGNATURES.items():
+        if base64_image.startswith(signature):
+            return mime_type
+    return "image/png"
+
+
+def image_data_url(base64_image: str) -> str:
+    return f"data:{image_mime_type(base64_image)};base64,{base64_image}"
 
 
 def extract_longest_substring(s):
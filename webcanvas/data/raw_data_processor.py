@@ -1,192 +1,283 @@
 import argparse
+import os
 import re
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import unquote, parse_qs, urlparse
-import json5
-import ujson as json
 
 def is_url(string):
     parsed = urlparse(string)
     return bool(parsed.scheme) and bool(parsed.netloc)
 
-def process_file(input_file, output_file):
-    with open(input_file, "r", encoding="utf-8") as f:
-        json_file = json.load(f)
-
-    print("JSON file loaded")
-
-    output = []
-
-    for index, task in enumerate(json_file):
-        task_name = task["title"]
-        evaluation = []
-        print("task_name:", task_name)
-        steps = task["steps"]
-        reference_steps = len(steps)
-        print("reference_steps:", reference_steps)
-        for step in steps:
-            if "rewardFunction" in step.keys() and len(step["rewardFunction"]) > 0:
-
-                # hack: put url in description in href
-                if "description" in step.keys() and is_url(step["description"]):
-                    step["href"] = step["description"]
-
-                # hack: combine element value and element path
-                flag_value = False
-                flag_path = False
-                for func in step["rewardFunction"]:
+def convert_reward_function(step, func):
+    """Convert a reward function recorded on a step into an evaluation spec"""
+    temp = {}
+    temp["match_function_name"] = func["name"]
+    # element match
+    if "element" in temp["match_function_name"]:
+        url = urlparse(step["href"])
+        if url.netloc.startswith("www"):
+            netloc = re.findall(".*?\.(.*?)\..*?", url.netloc)[0]
+        else:
+            netloc = re.findall("(.*?)\..*?", url.netloc)[0]
+
+        # element path match
+        if "element_path_exact" in temp["match_function_name"]:
+            temp["method"] = "selector"
+            temp["content"] = {
+                "reference_answer": step["selector"], "netloc": netloc, "url": step["href"]
+            }
+
+        # element value match
+        elif "element_value_exact" in temp["match_function_name"]:
+            if "path" in temp["match_function_name"]:
+                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
+                temp["content"] = {
+                    "reference_answer": step["value"], "netloc": netloc, "path": step["selector"], "url": step["href"]
+                }
+            else:
+                temp["content"] = {
+                    "reference_answer": step["value"], "netloc": netloc, "url": step["href"]
+                }
+        elif "element_value_include" in temp["match_function_name"]:
+            if "path" in temp["match_function_name"]:
+                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
+                temp["content"] = {
+                    "reference_answer": func["required"], "netloc": netloc, "path": step["selector"], "url": step["href"]
+                }
+            else:
+                temp["content"] = {
+                    "reference_answer": func["required"], "netloc": netloc, "url": step["href"]
+                }
+        elif "element_value_semantic" in temp["match_function_name"]:
+            if "path" in temp["match_function_name"]:
+                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
+                temp["content"] = {
+                    "reference_answer": func["optional"], "netloc": netloc, "path": step["selector"], "url": step["href"]
+                }
+            else:
+                temp["content"] = {
+                    "reference_answer": func["optional"], "netloc": netloc, "url": step["href"]
+                }
+
+    # url match
+    elif "url_include" in temp["match_function_name"]:
+        key = func["key"] if "key" in func.keys() else ""
+        temp["content"] = {
+            "key": unquote(key),
+            "reference_answer": unquote(func["required"]),
+            "url": step["href"]
+        }
+    elif "url_exact" in temp["match_function_name"]:
+        key = func["key"] if "key" in func.keys() else ""
+        if "optional" in func.keys():
+            reference_answer = func["optional"]
+        elif len(key) > 0:
+            try:
+                parsed_url = urlparse(step["href"])
+                url_params = parse_qs(parsed_url.query)
+                reference_answer = url_params[unquote(key)][0]
+            except Exception:
+                raise ValueError(f"key {key} is not in the recorded url {step['href']}")
+        else:
+            reference_answer = step["href"]
+        key = unquote(key)
+        reference_answer = unquote(reference_answer)
+
+        temp["content"] = {
+            "key": key,
+            "reference_answer": reference_answer,
+            "url": step["href"]
+        }
+    elif "url_semantic" in temp["match_function_name"]:
+        key = func["key"] if "key" in func.keys() else ""
+        temp["content"] = {
+            "key": key,
+            "reference_answer": func["optional"],
+            "url": step["href"]
+        }
+        key = unquote(key)
+    elif "cache_data_exact" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": step["value"],
+            "url": step["href"]
+        }
+    elif "cache_data_include" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": unquote(func["required"]),
+            "url": step["href"]
+        }
+    elif "cache_data_semantic" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": unquote(func["optional"]),
+            "url": step["href"]
+        }
+    elif "final_answer_exact" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": step["value"],
+            "url": step["href"]
+        }
+    elif "final_answer_semantic" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": unquote(func["optional"]),
+            "url": step["href"]
+        }
+    elif "final_answer_include" in temp["match_function_name"]:
+        temp["content"] = {
+            "reference_answer": unquote(func["required"]),
+            "url": step["href"]
+        }
+    else:
+        raise ValueError("other match function, coming soon!")
+    return temp
+
+
+def convert_task(index, task):
+    """
+    Convert a task of the exported atom-flow file into a task of the evaluation dataset.
+    :return: (converted task, errors), reward functions that fail to convert are left out and reported
+    """
+    errors = []
+    task_name = task["title"]
+    evaluation = []
+    steps = task["steps"]
+    reference_steps = len(steps)
+    for step_index, step in enumerate(steps):
+        if "rewardFunction" in step.keys() and len(step["rewardFunction"]) > 0:
+
+            # hack: put url in description in href
+            if "description" in step.keys() and is_url(step["description"]):
+                step["href"] = step["description"]
+
+            # hack: combine element value and element path
+            flag_value = False
+            flag_path = False
+            for func in step["rewardFunction"]:
+                if "element_value" in func["name"]:
+                    flag_value = True
+                if "element_path" in func["name"]:
+                    flag_path = True
+            if flag_value and flag_path:
+                for idx, func in enumerate(step["rewardFunction"]):
                     if "element_value" in func["name"]:
-                        flag_value = True
+                        func["name"] = f'{func["name"]}_path'
                     if "element_path" in func["name"]:
-                        flag_path = True
-                if flag_value and flag_path:
-                    for idx, func in enumerate(step["rewardFunction"]):
-                        if "element_value" in func["name"]:
-                            func["name"] = f'{func["name"]}_path'
-                        if "element_path" in func["name"]:
-                            del_idx = idx
-                    del step["rewardFunction"][del_idx]
-                for func in step["rewardFunction"]:
-                    if len(func) == 0:
-                        break
-                    temp = {}
-                    temp["match_function_name"] = func["name"]
-                    # element match
-                    if "element" in temp["match_function_name"]:
-                        url = urlparse(step["href"])
-                        if url.netloc.startswith("www"):
-                            netloc = re.findall(".*?\.(.*?)\..*?", url.netloc)[0]
-                        else:
-                            netloc = re.findall("(.*?)\..*?", url.netloc)[0]
-
-                        # element path match
-                        if "element_path_exact" in temp["match_function_name"]:
-                            temp["method"] = "selector"
-                            temp["content"] = {
-                                "reference_answer": step["selector"], "netloc": netloc, "url": step["href"]
-                            }
-
-                        # element value match
-                        elif "element_value_exact" in temp["match_function_name"]:
-                            if "path" in temp["match_function_name"]:
-                                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
-                                temp["content"] = {
-                                    "reference_answer": step["value"], "netloc": netloc, "path": step["selector"], "url": step["href"]
-                                }
-                            else:
-                                temp["content"] = {
-                                    "reference_answer": step["value"], "netloc": netloc, "url": step["href"]
-                                }
-                        elif "element_value_include" in temp["match_function_name"]:
-                            if "path" in temp["match_function_name"]:
-                                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
-                                temp["content"] = {
-                                    "reference_answer": func["required"], "netloc": netloc, "path": step["selector"], "url": step["href"]
-                                }
-                            else:
-                                temp["content"] = {
-                                    "reference_answer": func["required"], "netloc": netloc, "url": step["href"]
-                                }
-                        elif "element_value_semantic" in temp["match_function_name"]:
-                            if "path" in temp["match_function_name"]:
-                                temp["match_function_name"] = temp["match_function_name"].replace("_path", "")
-                                temp["content"] = {
-                                    "reference_answer": func["optional"], "netloc": netloc, "path": step["selector"], "url": step["href"]
-                                }
-                            else:
-                                temp["content"] = {
-                                    "reference_answer": func["optional"], "netloc": netloc, "url": step["href"]
-                                }
-
-                    # url match
-                    elif "url_include" in temp["match_function_name"]:
-                        key = func["key"] if "key" in func.keys() else ""
-                        temp["content"] = {
-                            "key": unquote(key),
-                            "reference_answer": unquote(func["required"]),
-                            "url": step["href"]
-                        }
-                    elif "url_exact" in temp["match_function_name"]:
-                        key = func["key"] if "key" in func.keys() else ""
-                        if "optional" in func.keys():
-                            reference_answer = func["optional"]
-                        elif len(key) > 0:
-                            try:
-                                parsed_url = urlparse(step["href"])
-                                url_params = parse_qs(parsed_url.query)
-                                reference_answer = url_params[unquote(key)][0]
-                            except:
-                                print("\nError in parsing URL!")
-                                print("key to be parsed: ", key)
-                                print("recorded url: ", step["href"])
-                                input("\nPress Enter to ignore and continue processing.")
-                        else:
-                            reference_answer = step["href"]
-                        key = unquote(key)
-                        reference_answer = unquote(reference_answer)
-
-                        temp["content"] = {
-                            "key": key,
-                            "reference_answer": reference_answer,
-                            "url": step["href"]
-                        }
-                    elif "url_semantic" in temp["match_function_name"]:
-                        key = func["key"] if "key" in func.keys() else ""
-                        temp["content"] = {
-                            "key": key,
-                            "reference_answer": func["optional"],
-                            "url": step["href"]
-                        }
-                        key = unquote(key)
-                    elif "cache_data_exact" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": step["value"],
-                            "url": step["href"]
-                        }
-                    elif "cache_data_include" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": unquote(func["required"]),
-                            "url": step["href"]
-                        }
-                    elif "cache_data_semantic" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": unquote(func["optional"]),
-                            "url": step["href"]
-                        }
-                    elif "final_answer_exact" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": step["value"],
-                            "url": step["href"]
-                        }
-                    elif "final_answer_semantic" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": unquote(func["optional"]),
-                            "url": step["href"]
-                        }
-                    elif "final_answer_include" in temp["match_function_name"]:
-                        temp["content"] = {
-                            "reference_answer": unquote(func["required"]),
-                            "url": step["href"]
-                        }
-                    else:
-                        print("*" * 50, "\n", "other match function, coming soon!")
-                    evaluation.append(temp)
-        output.append({
-            "index": index,
-            "task": task_name,
-            "reference_task_length": reference_steps,
-            "evaluation": evaluation
-        })
-
-    with open(output_file, "w", encoding="utf-8") as f_out:
-        json5.dump(output, fp=f_out, ensure_ascii=False, indent=4, quote_keys=True, trailing_commas=False)
+                        del_idx = idx
+                del step["rewardFunction"][del_idx]
+            for func in step["rewardFunction"]:
+                if len(func) == 0:
+                    break
+                try:
+                    evaluation.append(convert_reward_function(step, func))
+                except Exception as e:
+                    errors.append(f"step {step_index}, {func.get('name')}: {e!r}")
+    return {
+        "index": index,
+        "task": task_name,
+        "reference_task_length": reference_steps,
+        "evaluation": evaluation
+    }, errors
+
+
+def convert_task_entry(entry):
+    index, task = entry
+    try:
+        return convert_task(index, task)
+    except Exception as e:
+        return None, [f"{e!r}"]
+
+
+ARRAY_SEPARATOR_PATTERN = re.compile(r"[\s,]*")
+
+
+def iter_json_array(input_file, chunk_size=1 << 20):
+    """
+    Yield the items of the top-level JSON array of a file one at a time, reading it in chunks.
+    Items are decoded in place at an offset of the buffer, which is only compacted when more input is read. The read
+    size doubles while an item spans several reads, so a large item is decoded a logarithmic number of times.
+    """
+    decoder = json.JSONDecoder()
+    with open(input_file, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{input_file} is not a JSON array")
+        position = 1
+        eof = False
+        read_size = chunk_size
+        while True:
+            position = ARRAY_SEPARATOR_PATTERN.match(buffer, position).end()
+            if position < len(buffer):
+                if buffer[position] == "]":
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    # An item ending with the buffer may be cut short, e.g. a number split across reads
+                    if end < len(buffer) or eof:
+                        yield item
+                        position = end
+                        read_size = chunk_size
+                        continue
+            elif eof:
+                raise ValueError(f"{input_file} ends before its JSON array is closed")
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            read_size *= 2
+
+
+def bounded_map(executor, function, iterable, max_pending):
+    """executor.map that keeps at most max_pending items in flight, so the input is not read ahead in full"""
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def process_file(input_file, output_file, error_report_file=None, workers=None):
+    """
+    Convert the tasks of the input file in a process pool, writing each converted task as soon as it is ready.
+    Errors are collected into the error report instead of stopping the conversion.
+    """
+    error_report_file = error_report_file or output_file + ".errors.json"
+    workers = workers or os.cpu_count() or 1
+    report = []
+    task_count = 0
+    with open(output_file, "w", encoding="utf-8") as f_out, ProcessPoolExecutor(max_workers=workers) as executor:
+        f_out.write("[")
+        for index, (output, errors) in enumerate(
+                bounded_map(executor, convert_task_entry, enumerate(iter_json_array(input_file)), workers * 4)):
+            report.extend({"index": index, "error": error} for error in errors)
+            if output is None:
+                continue
+            item = json.dumps(output, ensure_ascii=False, indent=4).replace("\n", "\n    ")
+            f_out.write(("," if task_count else "") + "\n    " + item)
+            task_count += 1
+        f_out.write("\n]" if task_count else "]")
+
+    with open(error_report_file, "w", encoding="utf-8") as f_report:
+        json.dump(report, f_report, ensure_ascii=False, indent=4)
+    print(f"{task_count} tasks written to {output_file}, {len(report)} errors reported in {error_report_file}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Process JSON file and generate output.")
     parser.add_argument("--input-file", required=True, help="Input JSON file")
     parser.add_argument("--output-file", required=True, help="Output JSON file")
+    parser.add_argument("--error-report-file", default=None,
+                        help="JSON file to report conversion errors in, defaults to <output file>.errors.json")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
     args = parser.parse_args()
 
-    process_file(args.input_file, args.output_file)
+    process_file(args.input_file, args.output_file, args.error_report_file, args.workers)
 
 if __name__ == "__main__":
     main()
@@ -12,7 +12,11 @@ import logging
 from webcanvas.agent.Utils.utils import *
 # evaluate tools
 from webcanvas.evaluate.evaluate_utils import run_task, read_config, read_file
-from webcanvas.experiment_results import get_evaluate_result
+from webcanvas.agent.Environment.html_env.context import BrowserContextConfig, RequestBlockingStats
+from webcanvas.agent.Environment.html_env.context_pool import BrowserContextPool
+from webcanvas.evaluate.snapshot_archive import SnapshotArchive
+from webcanvas.evaluate.dataset_bundle import load_ground_truth, DatasetError
+from webcanvas.experiment_results import get_evaluate_result, LiveScoreboard
 
 logger = logging.getLogger(__name__)
 
@@ -94,24 +98,80 @@ def load_ground_truth_data(config, ground_truth_mode):
         if not os.path.exists(ground_truth_file_path):
             logger.error("ground_truth_file_path not exist!")
             exit()
-        return read_json_file(ground_truth_file_path)
+        try:
+            return load_ground_truth(ground_truth_file_path)
+        except DatasetError as e:
+            for error in e.errors:
+                logger.error(error)
+            logger.error(f"{len(e.errors)} errors in {ground_truth_file_path}")
+            exit()
     return None
 
 
-def create_html_environment(mode):
+# Browser settings shared by the per-task environments and the context pool, so both launch the same browser
+BROWSER_LAUNCH_SETTINGS = {
+    "headless": False,
+    "slow_mo": 1000,
+    "viewport_size": {"width": 1080, "height": 720},
+    # "proxy_server": "socks5://127.0.0.1:7890",
+}
+
+
+def create_context_pool(config):
+    """The pool of pre-warmed browser contexts of the run, None when disabled"""
+    browser_config = config.get("browser", {})
+    if browser_config.get("context_pool_size", 0) <= 0:
+        return None
+    if browser_config.get("har_mode"):
+        logger.info("The browser context pool is not used with HAR record or replay")
+        return None
+    return BrowserContextPool(
+        size=browser_config["context_pool_size"],
+        max_uses=browser_config.get("context_max_uses", 1),
+        max_js_heap_mb=browser_config.get("context_max_js_heap_mb", 512),
+        health_check_interval=browser_config.get("context_health_check_interval", 30),
+        warm_url=browser_config.get("context_warm_url", "about:blank"),
+        **BROWSER_LAUNCH_SETTINGS,
+    )
+
+
+def create_html_environment(mode, config, task_file_name="", context_pool=None):
+    """
+    :param task_file_name: <task index>_<task uuid>, the name of the HAR archive of the task
+    """
+    screenshot_config = config.get("screenshot", {})
+    browser_config = config.get("browser", {})
+    har_mode = browser_config.get("har_mode", "")
+    har_path = os.path.join(browser_config.get("har_path", "./har"), f"{task_file_name}.zip") if har_mode else ""
+    context_config = BrowserContextConfig(
+        block_trackers=browser_config.get("block_trackers", False),
+        block_resource_types=list(browser_config.get("block_resource_types", [])))
     return AsyncHTMLEnvironment(
         mode=mode,
         max_page_length=8192,
-        headless=False,
-        slow_mo=1000,
         current_viewport_only=False,
-        viewport_size={"width": 1080, "height": 720},
         save_trace_enabled=False,
-        # proxy_server="socks5://127.0.0.1:7890"
+        screenshot_format=screenshot_config.get("format", "png"),
+        screenshot_quality=screenshot_config.get("quality", 80),
+        screenshot_width=screenshot_config.get("width", 1080),
+        context_config=context_config,
+        har_mode=har_mode,
+        har_path=har_path,
+        har_not_found=browser_config.get("har_not_found", "abort"),
+        context_pool=context_pool,
+        **BROWSER_LAUNCH_SETTINGS,
     )
 
 
 async def run_experiment(task_range, experiment_config):
+    snapshot_archive_path = experiment_config.config['files'].get('snapshot_archive_path')
+    snapshot_archive = SnapshotArchive(snapshot_archive_path) if snapshot_archive_path else None
+    scoreboard = LiveScoreboard(experiment_config.config["files"]["out_file_path"],
+                                print_progress=experiment_config.config["basic"].get("print_progress", True))
+    request_blocking_stats = RequestBlockingStats()
+    context_pool = create_context_pool(experiment_config.config)
+    if context_pool is not None:
+        await context_pool.start()
     for task_index in task_range:
         task_uuid = None
         if experiment_config.config['basic']['task_mode'] == "batch_tasks":
@@ -128,35 +188,49 @@ async def run_experiment(task_range, experiment_config):
             reference_evaluate_steps = None
             logger.info(f"task_name: {task_name}")
 
-        env = create_html_environment(experiment_config.mode)
+        env = create_html_environment(experiment_config.mode, experiment_config.config,
+                                      task_file_name=f"{task_index}_{task_uuid}", context_pool=context_pool)
 
         if not os.path.exists("./token_results"):
             os.makedirs("./token_results")
         token_counts_filename = f"./token_results/token_counts_{experiment_config.record_time}_{experiment_config.planning_text_model}_{experiment_config.global_reward_text_model}.json"
 
-        await run_task(mode=experiment_config.mode,
-                       task_mode=experiment_config.config['basic']['task_mode'],
-                       task_name=task_name,
-                       task_uuid=task_uuid,
-                       config=experiment_config.config,
-                       write_result_file_path=experiment_config.write_result_file_path,
-                       reference_task_length=reference_task_length,
-                       evaluate_steps=evaluate_steps,
-                       reference_evaluate_steps=reference_evaluate_steps,
-                       env=env,
-                       global_reward_mode=experiment_config.global_reward_mode,
-                       global_reward_text_model=experiment_config.global_reward_text_model,
-                       planning_text_model=experiment_config.planning_text_model,
-                       ground_truth_mode=experiment_config.ground_truth_mode,
-                       ground_truth_data=experiment_config.ground_truth_data,
-                       interaction_mode=experiment_config.config['steps']['interaction_mode'],
-                       task_index=task_index,
-                       record_time=experiment_config.record_time,
-                       token_pricing=experiment_config.config['token_pricing'])
+        task_result, total_token_cost = await run_task(mode=experiment_config.mode,
+                                                       task_mode=experiment_config.config['basic']['task_mode'],
+                                                       task_name=task_name,
+                                                       task_uuid=task_uuid,
+                                                       config=experiment_config.config,
+                                                       write_result_file_path=experiment_config.write_result_file_path,
+                                                       reference_task_length=reference_task_length,
+                                                       evaluate_steps=evaluate_steps,
+                                                       reference_evaluate_steps=reference_evaluate_steps,
+                                                       env=env,
+                                                       global_reward_mode=experiment_config.global_reward_mode,
+                                                       global_reward_text_model=experiment_config.global_reward_text_model,
+                                                       planning_text_model=experiment_config.planning_text_model,
+                                                       ground_truth_mode=experiment_config.ground_truth_mode,
+                                                       ground_truth_data=experiment_config.ground_truth_data,
+                                                       interaction_mode=experiment_config.config['steps']['interaction_mode'],
+                                                       task_index=task_index,
+                                                       record_time=experiment_config.record_time,
+                                                       token_pricing=experiment_config.config['token_pricing'],
+                                                       snapshot_archive=snapshot_archive)
+        if experiment_config.config['basic']['task_mode'] == "batch_tasks":
+            scoreboard.update(task_index, task_result, total_token_cost)
 
+        request_blocking_stats.merge(env.browser_context.request_blocking_stats)
         await env.close()
         del env
 
+    if context_pool is not None:
+        await context_pool.close()
+
+    if request_blocking_stats.blocked_requests:
+        logger.info(f"Blocked requests of the run: {request_blocking_stats.as_dict()}")
+
+    if snapshot_archive is not None:
+        await snapshot_archive.close()
+
     with open(token_counts_filename, 'r') as file:
         data = json.load(file)
     total_token_cost = data.get("total_token_cost", 0)
@@ -0,0 +1,209 @@
+"""
+Compiled dataset bundles.
+
+A challenge file or a human-labeled ground-truth file is parsed and validated once, and the result is pickled into
+a bundle keyed by the sha256 of the source file. Later launches, and every worker of a parallel run, load the bundle
+instead of parsing the source with json5 again. Bundles are kept in the user cache directory, $WEBCANVAS_CACHE_DIR or
+~/.cache/webcanvas/bundles, and only the bundle of the current content of a source file is kept.
+
+Usage:
+    python -m webcanvas.evaluate.dataset_bundle compile \
+        --batch-tasks-file ./webcanvas/data/challenges/processed_dev.json \
+        --ground-truth-file ./webcanvas/data/human_labeled_reward_reference/GT_instructions.json
+"""
+import os
+import sys
+import glob
+import json
+import pickle
+import hashlib
+import argparse
+from pathlib import Path
+
+import json5
+
+BUNDLE_VERSION = 1
+
+# Required fields of each family of match functions, as (section, field); section None is the evaluation itself
+MATCH_FUNCTION_FIELDS = {
+    "url": [("content", "key"), ("content", "reference_answer")],
+    "element_path": [("content", "reference_answer"), (None, "method"), ("content", "netloc")],
+    "element_value": [("content", "reference_answer"), ("content", "netloc")],
+    "final_answer": [("content", "reference_answer")],
+    "cache_data": [("content", "reference_answer")],
+}
+MATCH_FUNCTIONS = {
+    "url_exactly_match", "url_included_match", "url_semantic_match",
+    "element_path_exactly_match", "element_path_included_match",
+    "element_value_exactly_match", "element_value_included_match", "element_value_semantic_match",
+    "cache_data_exact_match", "cache_data_included_match", "cache_data_semantic_match",
+    "final_answer_exact_match", "final_answer_included_match", "final_answer_semantic_match",
+}
+
+
+class DatasetError(Exception):
+    """A dataset file failed validation, with every error found in it"""
+
+    def __init__(self, file_path: str, errors: list):
+        self.file_path = file_path
+        self.errors = errors
+        super().__init__(f"{len(errors)} errors in {file_path}")
+
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_json_file(file_path: str):
+    """Parse with the C json parser, and only fall back to json5 for files that are not strict JSON"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json5.loads(text)
+
+
+def compile_evaluation(evaluation: dict):
+    """
+    Validate an evaluation spec of the dataset and turn it into the dict a KeyNodeEvaluator is compiled from.
+    :return: (spec, None) when valid, (None, error message) otherwise
+    """
+    match_function = evaluation.get("match_function_name")
+    if match_function not in MATCH_FUNCTIONS:
+        return None, f"unknown match_function: {match_function}"
+    family = next(family for family in MATCH_FUNCTION_FIELDS if family in match_function)
+    spec = {"match_function": match_function}
+    for section, field in MATCH_FUNCTION_FIELDS[family]:
+        source = evaluation if section is None else evaluation.get(section) or {}
+        if field not in source:
+            return None, f"{family} error, missing {field}, match_function: {match_function}"
+        spec[field] = source[field]
+    if family == "element_value" and "path" in evaluation["content"]:
+        spec["path"] = evaluation["content"]["path"]
+    spec["score"] = 0
+    return spec, None
+
+
+def compile_tasks(file_path: str) -> list:
+    """
+    Validate every task of a challenge file.
+    :return: [task name, task index, reference task length, evaluation specs] of every task
+    :raise DatasetError: with all the errors of the file
+    """
+    tasks = []
+    errors = []
+    for position, task in enumerate(parse_json_file(file_path)):
+        task_name_id = task.get("index", position)
+        missing = [field for field in ["task", "evaluation", "reference_task_length", "index"] if field not in task]
+        if missing:
+            errors.append(f"task {task_name_id}: missing {', '.join(missing)}")
+            continue
+        reference_evaluate_steps = []
+        for i, evaluation in enumerate(task["evaluation"]):
+            spec, error = compile_evaluation(evaluation)
+            if error:
+                errors.append(f"task {task_name_id}, step {i}: {error}")
+            else:
+                reference_evaluate_steps.append(spec)
+        tasks.append([task["task"], task_name_id, task["reference_task_length"], reference_evaluate_steps])
+    if errors:
+        raise DatasetError(file_path, errors)
+    return tasks
+
+
+def compile_ground_truth(file_path: str) -> dict:
+    """
+    Index the human-labeled reward references by task index.
+    :raise DatasetError: with all the errors of the file
+    """
+    ground_truth = {}
+    errors = []
+    for position, item in enumerate(parse_json_file(file_path)):
+        if "index" not in item or "instruction" not in item:
+            errors.append(f"item {position}: missing index or instruction")
+            continue
+        ground_truth.setdefault(item["index"], item["instruction"])
+    if errors:
+        raise DatasetError(file_path, errors)
+    return ground_truth
+
+
+def bundle_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("WEBCANVAS_CACHE_DIR") or os.path.join(cache_home, "webcanvas", "bundles")
+
+
+def bundle_prefix(file_path: str, kind: str) -> str:
+    """Bundles of a source file start with its name and a hash of its absolute path, whatever its content"""
+    path_hash = hashlib.sha256(os.path.abspath(file_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(bundle_dir(), f"{os.path.basename(file_path)}.{path_hash}.{kind}")
+
+
+def bundle_path(file_path: str, kind: str, digest: str) -> str:
+    return f"{bundle_prefix(file_path, kind)}.{digest[:16]}.pkl"
+
+
+def prune_bundles(file_path: str, kind: str, keep: str):
+    """Delete the bundles compiled from earlier contents of a source file"""
+    for path in glob.glob(glob.escape(bundle_prefix(file_path, kind)) + ".*.pkl"):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_bundle(file_path: str, kind: str, compile_function):
+    """Load the bundle of a source file, compiling and writing it first when the source changed"""
+    digest = file_hash(file_path)
+    path = bundle_path(file_path, kind, digest)
+    if os.path.isfile(path):
+        bundle = pickle.loads(Path(path).read_bytes())
+        if bundle.get("version") == BUNDLE_VERSION and bundle.get("source_hash") == digest:
+            return bundle["data"]
+    data = compile_function(file_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump({"version": BUNDLE_VERSION, "source_hash": digest, "data": data}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    prune_bundles(file_path, kind, keep=path)
+    return data
+
+
+def load_tasks(file_path: str) -> list:
+    return load_bundle(file_path, "tasks", compile_tasks)
+
+
+def load_ground_truth(file_path: str) -> dict:
+    return load_bundle(file_path, "ground_truth", compile_ground_truth)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate dataset files and compile them into bundles.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="Validate and compile dataset files.")
+    compile_parser.add_argument("--batch-tasks-file", type=str, default=None, help="Challenge file to compile.")
+    compile_parser.add_argument("--ground-truth-file", type=str, default=None,
+                                help="Human-labeled ground-truth file to compile.")
+
+    args = parser.parse_args()
+
+    failed = False
+    for file_path, loader in [(args.batch_tasks_file, load_tasks), (args.ground_truth_file, load_ground_truth)]:
+        if not file_path:
+            continue
+        try:
+            data = loader(file_path)
+            print(f"Compiled {file_path}: {len(data)} entries")
+        except DatasetError as e:
+            failed = True
+            print(f"{e}:")
+            for error in e.errors:
+                print(f"  {error}")
+    sys.exit(1 if failed else 0)
@@ -1,98 +1,38 @@
 import re
+import time
 import toml
 import json
+import asyncio
 import traceback
 import os
-import json5
 from urllib.parse import urlparse
 from playwright.async_api import Page
 
 from webcanvas.agent.Environment.html_env.async_env import AsyncHTMLEnvironment, ActionExecutionError
 from webcanvas.agent.Environment import create_action
 from webcanvas.agent.Plan import Planning
+from webcanvas.agent.Memory.short_memory.history import TraceHistory
 from webcanvas.agent.LLM.token_calculation import save_token_count_to_file
 from webcanvas.agent.Utils.utils import save_screenshot, is_valid_base64
 from webcanvas.agent.Reward.global_reward import GlobalReward
 from webcanvas.evaluate.task_score import FinishTaskEvaluator, TaskLengthEvaluator
-from webcanvas.evaluate.step_score import URLEvaluator, ElementEvaluator, TextEvaluator
+from webcanvas.evaluate.step_score import StepEvaluationContext
+from webcanvas.evaluate.key_node import KeyNodeEvaluatorSet
+from webcanvas.evaluate.dataset_bundle import load_tasks, DatasetError
 from webcanvas.logs import logger
 
 
 def read_file(file_path="./data/example/example_130.json"):
-    """Read labeled data"""
-    return_list = []
-    with open(file_path, encoding='utf-8') as f:
-        test_data = json5.load(f)
-    for task in test_data:
-        task_name = task["task"]
-        evaluation_data = task["evaluation"]
-        reference_task_length = task["reference_task_length"]
-        task_name_id = task["index"]
-        reference_evaluate_steps = []
-        for i, evaluation in enumerate(evaluation_data):
-            match_function = evaluation["match_function_name"]
-            if "url" in match_function:
-                try:
-                    key = evaluation["content"]["key"]
-                    reference_answer = evaluation["content"]["reference_answer"]
-                    reference_evaluate_steps.append({"match_function": match_function,
-                                                     "key": key, "reference_answer": reference_answer, "score": 0})
-                except:
-                    logger.error(
-                        f"url error in task {task_name_id}, step {i}, match_function: {match_function}")
-                    exit(1)
-            elif "element_path" in match_function:
-                try:
-                    reference_answer = evaluation["content"]["reference_answer"]
-                    method = evaluation["method"]
-                    netloc = evaluation["content"]["netloc"]
-                    reference_evaluate_steps.append({"match_function": match_function, "method": method,
-                                                     "reference_answer": reference_answer, "netloc": netloc,
-                                                     "score": 0})
-                except:
-                    logger.error(
-                        f"element_path error in task {task_name_id}, step {i}, match_function: {match_function}")
-                    exit(1)
-            elif "element_value" in match_function:
-                try:
-                    reference_answer = evaluation["content"]["reference_answer"]
-                    netloc = evaluation["content"]["netloc"]
-                    if "path" in evaluation["content"].keys():
-                        path = evaluation["content"]["path"]
-                        reference_evaluate_steps.append({"match_function": match_function,
-                                                         "reference_answer": reference_answer, "netloc": netloc,
-                                                         "path": path, "score": 0})
-                    else:
-                        reference_evaluate_steps.append({"match_function": match_function,
-                                                         "reference_answer": reference_answer, "netloc": netloc,
-                                                         "score": 0})
-                except:
-                    logger.error(
-                        f"element_value error in task {task_name_id}, step {i}, match_function: {match_function}")
-                    exit(1)
-            elif "final_answer" in match_function:
-                try:
-                    reference_answer = evaluation["content"]["reference_answer"]
-                    reference_evaluate_steps.append({"match_function": match_function,
-                                                     "reference_answer": reference_answer, "score": 0})
-                except:
-                    logger.error(
-                        f"element_value error in task {task_name_id}, step {i}, match_function: {match_function}")
-                    exit(1)
-            elif "cache_data" in match_function:
-                try:
-                    reference_answer = evaluation["content"]["reference_answer"]
-                    reference_evaluate_steps.append({"match_function": match_function,
-                                                     "reference_answer": reference_answer, "score": 0})
-                except:
-                    logger.error(
-                        f"element_value error in task {task_name_id}, step {i}, match_function: {match_function}")
-                    exit(1)
-
-        return_list.append(
-            [task_name, task_name_id, reference_task_length, reference_evaluate_steps])
-
-    return return_list
+    """Read labeled data, from its compiled bundle when the file did not change"""
+    try:
+        tasks = load_tasks(file_path)
+    except DatasetError as e:
+        for error in e.errors:
+            logger.error(error)
+        logger.error(f"{len(e.errors)} errors in {file_path}")
+        exit(1)
+    return [[task_name, task_name_id, reference_task_length, KeyNodeEvaluatorSet(reference_evaluate_steps)]
+            for task_name, task_name_id, reference_task_length, reference_evaluate_steps in tasks]
 
 
 async def adjust_max_action_step(conditions, current_info, encountered_errors, increase_step):
@@ -120,133 +60,20 @@ def get_netloc(url: str) -> str:
     return netloc
 
 
-async def step_evaluate(page: Page, evaluate_steps=[], input_path=None, element_value=None, text_content=None):
+async def step_evaluate(page: Page, evaluate_steps=[], input_path=None, element_value=None, text_content=None,
+                        element_path_backend="page", html_content=None):
     """Evaluate step score"""
-    step_score = 0
-    match_result = []
-    for evaluate in evaluate_steps:
-        score = 0
-        if evaluate["score"] != 1:
-            match_function = evaluate["match_function"]
-            if match_function == "url_exactly_match":
-                score = URLEvaluator.url_exact_match(
-                    page.url, evaluate["reference_answer"], evaluate["key"])
-            elif match_function == "url_included_match":
-                score = URLEvaluator.url_include_match(
-                    page.url, evaluate["reference_answer"], evaluate["key"])
-            elif match_function == "url_semantic_match":
-                score = await URLEvaluator.url_semantic_match(
-                    page.url, evaluate["reference_answer"], evaluate["key"])
-                # print(score, "url_semantic_match")
-            elif match_function == "element_path_exactly_match":
-                input_netloc = get_netloc(page.url)
-                method = evaluate["method"]
-                score = ElementEvaluator.path_exact_match(
-                    input_path, evaluate["reference_answer"], method, await page.content(), input_netloc,
-                    evaluate["netloc"])
-                # print(score, "path_exact_match:", input_path,
-                #       "***", evaluate["reference_answer"])
-            elif match_function == "element_path_included_match":
-                pass
-                # * Temporarily not doing
-
-            elif match_function == "element_value_exactly_match":
-                if input_path is not None and element_value is not None:
-                    input_netloc = get_netloc(page.url)
-
-                    # print(element_value)
-                    # print(await page.locator(input_path).input_value())
-                    if "path" in evaluate.keys():
-                        path_score = ElementEvaluator.path_exact_match(input_path, evaluate["path"], "selector",
-                                                                       await page.content(), input_netloc,
-                                                                       evaluate["netloc"])
-                        if path_score == 0:
-                            # print("Path mismatch in value evaluation")
-                            score = 0
-                        else:
-                            score = ElementEvaluator.element_value_exact_match(
-                                element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                    else:
-                        score = ElementEvaluator.element_value_exact_match(
-                            element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                    # print(score, "element_value_exactly_match",
-                    #       element_value, "*", evaluate["reference_answer"])
-                else:
-                    score = 0
-            elif match_function == "element_value_included_match":
-                if input_path is not None and element_value is not None:
-                    input_netloc = get_netloc(page.url)
-                    if "path" in evaluate.keys():
-                        path_score = ElementEvaluator.path_exact_match(input_path, evaluate["path"], "selector",
-                                                                       await page.content(), input_netloc,
-                                                                       evaluate["netloc"])
-                        if path_score == 0:
-                            # print("Path mismatch in value evaluation")
-                            score = 0
-                        else:
-                            score = ElementEvaluator.element_value_include_match(
-                                element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                    else:
-                        score = ElementEvaluator.element_value_include_match(
-                            element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                    # print(score, "element_value_included_match",
-                    #       element_value, "*", evaluate["reference_answer"])
-                else:
-                    score = 0
-            elif match_function == "element_value_semantic_match":
-                if input_path is not None and element_value is not None:
-                    input_netloc = get_netloc(page.url)
-
-                    if len(element_value) > 0:
-                        if "path" in evaluate.keys():
-                            path_score = ElementEvaluator.path_exact_match(input_path, evaluate["path"], "selector",
-                                                                           await page.content(), input_netloc,
-                                                                           evaluate["netloc"])
-                            if path_score == 0:
-                                # print("Path mismatch in value evaluation")
-                                score = 0
-                            else:
-                                score = await ElementEvaluator.element_value_semantic_match(
-                                    element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                        else:
-                            score = await ElementEvaluator.element_value_semantic_match(
-                                element_value, evaluate["reference_answer"], input_netloc, evaluate["netloc"])
-                        # print(score, "element_value_semantic_match",
-                        #       element_value, "*", evaluate["reference_answer"])
-                else:
-                    score = 0
-            elif match_function == "cache_data_exact_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_exact_match(
-                        text_content, evaluate["reference_answer"])
-            elif match_function == "cache_data_included_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_included_match(
-                        text_content, evaluate["reference_answer"])
-            elif match_function == "cache_data_semantic_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_semantic_match(
-                        text_content, evaluate["reference_answer"])
-            elif match_function == "final_answer_exact_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_exact_match(
-                        text_content, evaluate["reference_answer"])
-            elif match_function == "final_answer_included_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_included_match(
-                        text_content, evaluate["reference_answer"])
-            elif match_function == "final_answer_semantic_match":
-                if text_content is not None and text_content != "":
-                    score = TextEvaluator.text_semantic_match(
-                        text_content, evaluate["reference_answer"])
-
-            evaluate["score"] = max(evaluate["score"], score)
-        if evaluate["score"] >= 1:
-            match_result.append(
-                {evaluate["match_function"]: evaluate["reference_answer"]})
-        step_score += evaluate["score"]
-
-    return evaluate_steps, match_result
+    if not isinstance(evaluate_steps, KeyNodeEvaluatorSet):
+        evaluate_steps = KeyNodeEvaluatorSet(evaluate_steps)
+    context = StepEvaluationContext(page, get_netloc(page.url), element_path_backend, html_content)
+    return await evaluate_key_nodes(context, evaluate_steps, input_path, element_value, text_content)
+
+
+async def evaluate_key_nodes(context, evaluate_steps, input_path=None, element_value=None, text_content=None):
+    """Evaluate the key nodes that can fire in the page state of the context, live or recorded"""
+    for evaluator in evaluate_steps.candidates(context.netloc):
+        await evaluator.evaluate(context, input_path, element_value, text_content)
+    return evaluate_steps, evaluate_steps.match_result()
 
 
 def parse_current_trace(response: dict, env: AsyncHTMLEnvironment, step_reward: dict):
@@ -338,7 +165,8 @@ async def run_task(
         interaction_mode,
         task_index,
         record_time=None,
-        token_pricing=None
+        token_pricing=None,
+        snapshot_archive=None
 ):
     await env.reset("about:blank")
 
@@ -350,7 +178,7 @@ async def run_task(
     observation = ""
     observation_VforD = ""
     error_description = ""
-    previous_trace = []
+    previous_trace = TraceHistory(max_tokens=config["steps"].get("history_max_tokens") or None)
 
     # Related to response
     out_put = None
@@ -380,6 +208,8 @@ async def run_task(
     task_result["task_name"] = task_name
     task_result["id"] = task_uuid
     task_result["reference_task_length"] = reference_task_length
+    task_result["planning_text_model"] = planning_text_model
+    task_result["global_reward_text_model"] = global_reward_text_model
     steps_list = []
 
     # Store the token counts of each step
@@ -389,24 +219,68 @@ async def run_task(
     steps_reward_input_token_counts = 0
     steps_planning_output_token_counts = 0
     steps_reward_output_token_counts = 0
+    steps_planning_image_token_counts = 0
+    steps_reward_image_token_counts = 0
+    steps_planning_cached_input_token_counts = 0
+    steps_reward_cached_input_token_counts = 0
     steps_input_token_counts = 0
     steps_output_token_counts = 0
+    steps_image_token_counts = 0
+    steps_cached_input_token_counts = 0
     token_counts_filename = f"./token_results/token_counts_{record_time}_{planning_text_model}_{global_reward_text_model}.json"
+    task_file_name = str(task_index) + "_" + str(task_uuid) + ".json"
+
+    # Whether the global reward and the planning of a step are requested concurrently
+    pipelined_global_reward = config["steps"].get("pipelined_global_reward", False)
+    previous_status_description = ""
+
+    async def plan_with_retry(status_description):
+        nonlocal response_total_count, response_error_count
+        out_put = None
+        for _ in range(3):
+            response_total_count += 1
+            try:
+                out_put = await Planning.plan(
+                    config=config,
+                    user_request=task_name,
+                    text_model_name=planning_text_model,
+                    previous_trace=previous_trace,
+                    observation=observation,
+                    feedback=error_description,
+                    mode=mode,
+                    observation_VforD=observation_VforD,
+                    status_description=status_description,
+                    tree=env.tree,
+                    current_url=env.page.url
+                )
+
+                if out_put is not None:
+                    break
+            except Exception as e:
+                out_put = None
+                response_error_count += 1
+                traceback.print_exc()
+                continue
+        return out_put
 
     while num_steps < max_steps + additional_steps:
+        step_started = time.perf_counter()
         error_message = ""
         total_step_score = 0
         step_reward = {}
         status_description = ""
         planning_input_token_count = 0
         planning_output_token_count = 0
-        reward_token_count = [0, 0]
+        planning_image_token_count = 0
+        planning_cached_input_token_count = 0
+        reward_token_count = [0, 0, 0, 0]
+        discarded_planning_token_count = [0, 0, 0, 0]
 
         logger.info(
             "**🤖 The agent is in the process of starting planning 🤖**")
 
         if global_reward_mode != 'no_global_reward' and len(previous_trace) > 0:
-            step_reward, status_description, reward_token_count = await GlobalReward.evaluate(
+            global_reward = GlobalReward.evaluate(
                 config=config,
                 model_name=global_reward_text_model,
                 user_request=task_name,
@@ -418,33 +292,41 @@ async def run_task(
                 ground_truth_mode=ground_truth_mode,
                 ground_truth_data=ground_truth_data,
             )
+            if pipelined_global_reward:
+                # Plan with the reflection of the previous step while the reward is being reasoned,
+                # and only re-plan when the reward says the task is finished
+                planning = asyncio.create_task(plan_with_retry(previous_status_description))
+                step_reward, status_description, reward_token_count = await global_reward
+                if step_reward and step_reward.get("status") == "finished":
+                    logger.info("-- Global reward reports the task as finished, re-planning with its description")
+                    if planning.done():
+                        discarded_out_put = planning.result()
+                        if discarded_out_put:
+                            discarded_planning_token_count = discarded_out_put.get(
+                                "planning_token_count", [0, 0, 0, 0])
+                    else:
+                        planning.cancel()
+                    out_put = await plan_with_retry(status_description)
+                else:
+                    out_put = await planning
+            else:
+                step_reward, status_description, reward_token_count = await global_reward
+                out_put = await plan_with_retry(status_description)
+            previous_status_description = status_description
+        else:
+            out_put = await plan_with_retry(status_description)
 
-        for _ in range(3):
-            response_total_count += 1
-            try:
-                out_put = await Planning.plan(
-                    config=config,
-                    user_request=task_name,
-                    text_model_name=planning_text_model,
-                    previous_trace=previous_trace,
-                    observation=observation,
-                    feedback=error_description,
-                    mode=mode,
-                    observation_VforD=observation_VforD,
-                    status_description=status_description
-                )
-
-                if out_put is not None:
-                    break
-            except Exception as e:
-                out_put = None
-                response_error_count += 1
-                traceback.print_exc()
-                continue
+        # Tokens of a plan discarded after the global reward finished the task are still paid for
+        planning_input_token_count += discarded_planning_token_count[0]
+        planning_output_token_count += discarded_planning_token_count[1]
+        planning_image_token_count += discarded_planning_token_count[2]
+        planning_cached_input_token_count += discarded_planning_token_count[3]
 
         if out_put:
-            planning_input_token_count += out_put.get("planning_token_count", [0, 0])[0]
-            planning_output_token_count += out_put.get("planning_token_count", [0, 0])[1]
+            planning_input_token_count += out_put.get("planning_token_count", [0, 0, 0, 0])[0]
+            planning_output_token_count += out_put.get("planning_token_count", [0, 0, 0, 0])[1]
+            planning_image_token_count += out_put.get("planning_token_count", [0, 0, 0, 0])[2]
+            planning_cached_input_token_count += out_put.get("planning_token_count", [0, 0, 0, 0])[3]
             each_step_dict = {}
             each_step_dict["step_index"] = step_index
             each_step_dict["dict_result"] = out_put
@@ -465,12 +347,26 @@ async def run_task(
             logger.info(f"-- Selector: {selector}")
             logger.info(f"-- Element value: {element_value}")
 
+            # Archive the page state the step is evaluated in, before its action is executed
+            html_content = None
+            if snapshot_archive is not None:
+                try:
+                    html_content = await env.page.content()
+                    snapshot_archive.add_step(task_file_name, step_index, env.page.url, html_content, observation,
+                                              observation_VforD or None)
+                except Exception as e:
+                    logger.warning(f"Failed to archive the snapshot of step {step_index}: {e}")
+
             logger.info(
                 "**🤖 The agent is in the process of starting evaluation 🤖**")
             if task_mode == "batch_tasks":
+                # A step whose evaluation fails matches nothing, rather than reporting the result of an earlier step
+                match_result = []
                 try:
                     evaluate_steps, match_result = await step_evaluate(page=env.page, evaluate_steps=evaluate_steps,
-                                                                       input_path=selector, element_value=element_value, text_content=text_content)
+                                                                       input_path=selector, element_value=element_value, text_content=text_content,
+                                                                       element_path_backend=config["basic"].get("element_path_backend", "page"),
+                                                                       html_content=html_content)
                 except Exception as ee:
                     logger.info(f"Current step evaluate error :{ee}")
 
@@ -530,10 +426,11 @@ async def run_task(
                 f"-- The URL is: {env.page.url}")
 
             if "vision" in global_reward_mode:
-                vision_reward = await env.capture()
+                # The observation screenshot of the vision modes was taken in the same page state
+                vision_reward = observation_VforD if observation_VforD else await env.capture()
                 save_screenshot(mode=mode, record_time=record_time, task_name=task_name,
                                 step_number=num_steps, description="reward",
-                                screenshot_base64=vision_reward, task_uuid=task_uuid)
+                                screenshot_base64=vision_reward, task_name_id=task_uuid)
                 is_valid, message = is_valid_base64(vision_reward)
                 if not is_valid:
                     invalid_vision_reward_num += 1
@@ -548,6 +445,7 @@ async def run_task(
             step_increase, encountered_errors = await adjust_max_action_step(
                 conditions, current_info, encountered_errors, increase_step)
             additional_steps += step_increase
+            each_step_dict["step_duration"] = time.perf_counter() - step_started
             steps_list.append(each_step_dict)
             step_index += 1
             if num_steps >= 25 or task_global_status == "finished" or task_finished:
@@ -566,16 +464,24 @@ async def run_task(
         reward_token_count_number = reward_token_count[0] + reward_token_count[1]
         step_input_token_count = planning_input_token_count + reward_token_count[0]
         step_output_token_count = planning_output_token_count + reward_token_count[1]
+        step_image_token_count = planning_image_token_count + reward_token_count[2]
+        step_cached_input_token_count = planning_cached_input_token_count + reward_token_count[3]
         step_token_count = planning_token_count_number + reward_token_count_number
         single_step_tokens = {
             "planning_input_token_count": planning_input_token_count,
             "planning_output_token_count": planning_output_token_count,
+            "planning_image_token_count": planning_image_token_count,
+            "planning_cached_input_token_count": planning_cached_input_token_count,
             "planning_token_count": planning_token_count_number,
             "reward_input_token_count": reward_token_count[0],
             "reward_output_token_count": reward_token_count[1],
+            "reward_image_token_count": reward_token_count[2],
+            "reward_cached_input_token_count": reward_token_count[3],
             "reward_token_count": reward_token_count_number,
             "input_token_count": step_input_token_count,
             "output_token_count": step_output_token_count,
+            "image_token_count": step_image_token_count,
+            "cached_input_token_count": step_cached_input_token_count,
             "token_count": step_token_count
         }
 
@@ -585,20 +491,32 @@ async def run_task(
         steps_planning_output_token_counts += planning_output_token_count
         steps_reward_input_token_counts += reward_token_count[0]
         steps_reward_output_token_counts += reward_token_count[1]
+        steps_planning_image_token_counts += planning_image_token_count
+        steps_reward_image_token_counts += reward_token_count[2]
+        steps_planning_cached_input_token_counts += planning_cached_input_token_count
+        steps_reward_cached_input_token_counts += reward_token_count[3]
         steps_input_token_counts += step_input_token_count
         steps_output_token_counts += step_output_token_count
+        steps_image_token_counts += step_image_token_count
+        steps_cached_input_token_counts += step_cached_input_token_count
         steps_token_counts += step_token_count
 
     step_tokens["steps_planning_input_token_counts"] = steps_planning_input_token_counts
     step_tokens["steps_planning_output_token_counts"] = steps_planning_output_token_counts
     step_tokens["steps_reward_input_token_counts"] = steps_reward_input_token_counts
     step_tokens["steps_reward_output_token_counts"] = steps_reward_output_token_counts
+    step_tokens["steps_planning_image_token_counts"] = steps_planning_image_token_counts
+    step_tokens["steps_reward_image_token_counts"] = steps_reward_image_token_counts
+    step_tokens["steps_planning_cached_input_token_counts"] = steps_planning_cached_input_token_counts
+    step_tokens["steps_reward_cached_input_token_counts"] = steps_reward_cached_input_token_counts
     step_tokens["steps_input_token_counts"] = steps_input_token_counts
     step_tokens["steps_output_token_counts"] = steps_output_token_counts
+    step_tokens["steps_image_token_counts"] = steps_image_token_counts
+    step_tokens["steps_cached_input_token_counts"] = steps_cached_input_token_counts
     step_tokens["steps_token_counts"] = steps_token_counts
 
-    save_token_count_to_file(token_counts_filename, step_tokens, task_name, global_reward_text_model,
-                             planning_text_model, config["token_pricing"])
+    token_count_data = save_token_count_to_file(token_counts_filename, step_tokens, task_name, global_reward_text_model,
+                                                planning_text_model, config["token_pricing"])
 
     # ! 3. Task evaluation and scoring
     if task_mode == "batch_tasks":
@@ -637,13 +555,15 @@ async def run_task(
             response_error_count / response_total_count)
         task_result["step_list"] = steps_list
         task_result["evaluate_steps"] = reference_evaluate_steps
+        task_result["token_counts"] = step_tokens
+        task_result["request_blocking"] = env.browser_context.request_blocking_stats.as_dict()
 
         json_result_folder = write_result_file_path
         if not os.path.exists(json_result_folder):
             os.makedirs(json_result_folder)
-        json_out_file_path = os.path.join(
-            json_result_folder, str(task_index) + "_" + str(task_result["id"]) + ".json")
+        json_out_file_path = os.path.join(json_result_folder, task_file_name)
         logger.info(f"Write results to json file: {json_out_file_path}")
         with open(json_out_file_path, 'w') as json_file:
             json.dump(task_result, json_file)
 
+    return task_result, token_count_data.get("total_token_cost", 0)
@@ -0,0 +1,117 @@
+from webcanvas.evaluate.step_score import URLEvaluator, TextEvaluator, ElementEvaluator
+
+
+class KeyNodeEvaluator(dict):
+    """
+    A compiled key node of the reference trajectory.
+    The dict holds the evaluation spec and its score exactly as read from the dataset, so it is still written to the
+    result files as is; the match function is resolved to its evaluation method once, when the spec is compiled.
+    """
+
+    def __init__(self, spec: dict):
+        super().__init__(spec)
+        self.setdefault("score", 0)
+        self.match_function = self["match_function"]
+        self.reference_answer = self["reference_answer"]
+        self.key = self.get("key")
+        # Evaluators without a netloc (url, cache_data, final_answer) can fire on any domain
+        self.netloc = self.get("netloc")
+        self.evaluate_function = getattr(self, f"_{self.match_function}", self._not_evaluated)
+
+    @property
+    def satisfied(self) -> bool:
+        return self["score"] >= 1
+
+    async def evaluate(self, context, input_path=None, element_value=None, text_content=None):
+        """Evaluate the key node on the current step and keep the best score reached so far"""
+        score = await self.evaluate_function(context, input_path, element_value, text_content)
+        self["score"] = max(self["score"], score)
+        return self["score"]
+
+    async def _not_evaluated(self, context, input_path, element_value, text_content):
+        # element_path_included_match is temporarily not evaluated
+        return 0
+
+    async def _url_exactly_match(self, context, input_path, element_value, text_content):
+        return URLEvaluator.url_exact_match(context.url, self.reference_answer, self.key)
+
+    async def _url_included_match(self, context, input_path, element_value, text_content):
+        return URLEvaluator.url_include_match(context.url, self.reference_answer, self.key)
+
+    async def _url_semantic_match(self, context, input_path, element_value, text_content):
+        return await URLEvaluator.url_semantic_match(context.url, self.reference_answer, self.key)
+
+    async def _element_path_exactly_match(self, context, input_path, element_value, text_content):
+        return await context.path_exact_match(input_path, self.reference_answer, self["method"], self.netloc)
+
+    async def _element_path_matches(self, context, input_path) -> bool:
+        if "path" not in self:
+            return True
+        return await context.path_exact_match(input_path, self["path"], "selector", self.netloc) != 0
+
+    async def _element_value_exactly_match(self, context, input_path, element_value, text_content):
+        if input_path is None or element_value is None:
+            return 0
+        if not await self._element_path_matches(context, input_path):
+            return 0
+        return ElementEvaluator.element_value_exact_match(
+            element_value, self.reference_answer, context.netloc, self.netloc)
+
+    async def _element_value_included_match(self, context, input_path, element_value, text_content):
+        if input_path is None or element_value is None:
+            return 0
+        if not await self._element_path_matches(context, input_path):
+            return 0
+        return ElementEvaluator.element_value_include_match(
+            element_value, self.reference_answer, context.netloc, self.netloc)
+
+    async def _element_value_semantic_match(self, context, input_path, element_value, text_content):
+        if input_path is None or not element_value:
+            return 0
+        if not await self._element_path_matches(context, input_path):
+            return 0
+        return await ElementEvaluator.element_value_semantic_match(
+            element_value, self.reference_answer, context.netloc, self.netloc)
+
+    async def _cache_data_exact_match(self, context, input_path, element_value, text_content):
+        if not text_content:
+            return 0
+        return TextEvaluator.text_exact_match(text_content, self.reference_answer)
+
+    async def _cache_data_included_match(self, context, input_path, element_value, text_content):
+        if not text_content:
+            return 0
+        return TextEvaluator.text_included_match(text_content, self.reference_answer)
+
+    async def _cache_data_semantic_match(self, context, input_path, element_value, text_content):
+        if not text_content:
+            return 0
+        return await TextEvaluator.text_semantic_match(text_content, self.reference_answer)
+
+    _final_answer_exact_match = _cache_data_exact_match
+    _final_answer_included_match = _cache_data_included_match
+    _final_answer_semantic_match = _cache_data_semantic_match
+
+
+class KeyNodeEvaluatorSet(list):
+    """
+    The compiled key nodes of a task, in dataset order, indexed by the netloc they are bound to.
+    """
+
+    def __init__(self, specs=()):
+        super().__init__(spec if isinstance(spec, KeyNodeEvaluator) else KeyNodeEvaluator(spec) for spec in specs)
+        self.domain_free = []
+        self.by_netloc = {}
+        for evaluator in self:
+            if evaluator.netloc is None:
+                self.domain_free.append(evaluator)
+            else:
+                self.by_netloc.setdefault(evaluator.netloc, []).append(evaluator)
+
+    def candidates(self, netloc: str) -> list:
+        """The unsatisfied key nodes that can fire on a page of the given netloc"""
+        return [evaluator for evaluator in self.domain_free + self.by_netloc.get(netloc, [])
+                if not evaluator.satisfied]
+
+    def match_result(self) -> list:
+        return [{evaluator.match_function: evaluator.reference_answer} for evaluator in self if evaluator.satisfied]
@@ -0,0 +1,74 @@
+(
+    args
+) => {
+    const { inputPath, referencePath, method, mapTagNames } = args;
+
+    // Find the first node matching the path in the document, then in open shadow roots and same-origin iframes
+    function findInRoot(root, path) {
+        if (method === "xpath") {
+            const doc = root.ownerDocument || root;
+            try {
+                return doc.evaluate(path, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+            } catch (e) {
+                return null;
+            }
+        }
+        try {
+            return root.querySelector(path);
+        } catch (e) {
+            return null;
+        }
+    }
+
+    function findDeep(root, path) {
+        const found = findInRoot(root, path);
+        if (found) {
+            return found;
+        }
+        const walker = (root.ownerDocument || root).createTreeWalker(root, NodeFilter.SHOW_ELEMENT);
+        let node = walker.currentNode;
+        while (node) {
+            if (node.shadowRoot) {
+                const inShadow = findDeep(node.shadowRoot, path);
+                if (inShadow) {
+                    return inShadow;
+                }
+            }
+            if (node.tagName === "IFRAME" || node.tagName === "FRAME") {
+                try {
+                    const frameDocument = node.contentDocument;
+                    if (frameDocument) {
+                        const inFrame = findDeep(frameDocument, path);
+                        if (inFrame) {
+                            return inFrame;
+                        }
+                    }
+                } catch (e) {
+                    // Cross-origin frames are not accessible
+                }
+            }
+            node = walker.nextNode();
+        }
+        return null;
+    }
+
+    const inputElement = findDeep(document, inputPath);
+    const referenceElement = findDeep(document, referencePath);
+    if (!inputElement || !referenceElement) {
+        return 0;
+    }
+    if (inputElement === referenceElement) {
+        return 1;
+    }
+    // Text containers are matched when the input element is one of their 3 nearest ancestors
+    if (mapTagNames.includes(referenceElement.tagName.toLowerCase())) {
+        let current = referenceElement;
+        for (let traceUpCount = 0; traceUpCount < 3 && current; traceUpCount++) {
+            current = current.parentElement || (current.parentNode && current.parentNode.host) || null;
+            if (current === inputElement) {
+                return 1;
+            }
+        }
+    }
+    return 0;
+}
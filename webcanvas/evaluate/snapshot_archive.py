@@ -0,0 +1,126 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import zstandard
+
+from webcanvas.logs import logger
+
+
+class SnapshotArchive:
+    """
+    Page state of every evaluated step: the page HTML, the observation string and the screenshot.
+    Each content is zstd-compressed and stored once under its sha256, and each task has a manifest mapping its steps
+    to the stored contents:
+
+        <root>/objects/<sha256[:2]>/<sha256>.zst
+        <root>/manifests/<task file name>.json   {"steps": {"<step index>": {"url": ..., "html": <sha256>, ...}}}
+
+    Steps are written by a single background thread, so add_step returns without blocking the step loop.
+    A read_only archive only reads steps: it creates no directories and starts no writer thread.
+    Failed writes are logged as they happen and counted in failed_steps.
+    """
+
+    def __init__(self, root: str, level: int = 10, read_only: bool = False):
+        self.root = root
+        self.read_only = read_only
+        self.objects_path = os.path.join(root, "objects")
+        self.manifests_path = os.path.join(root, "manifests")
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.manifests = {}
+        self.pending = set()
+        self.failed_steps = 0
+        self.compressor = None
+        self.executor = None
+        if not read_only:
+            os.makedirs(self.objects_path, exist_ok=True)
+            os.makedirs(self.manifests_path, exist_ok=True)
+            self.compressor = zstandard.ZstdCompressor(level=level)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def add_step(self, task_file_name: str, step_index: int, url: str, html: str = None, observation: str = None,
+                 screenshot_base64: str = None):
+        """Queue the page state of a step for writing and return at once"""
+        if self.read_only:
+            raise ValueError(f"Snapshot archive {self.root} is read-only")
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self._write_step, task_file_name, step_index, url, html, observation, screenshot_base64)
+        self.pending.add(future)
+        future.add_done_callback(lambda done: self._step_written(done, task_file_name, step_index))
+
+    def _step_written(self, future, task_file_name: str, step_index: int):
+        self.pending.discard(future)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.failed_steps += 1
+            logger.error(f"Failed to archive the snapshot of step {step_index} of {task_file_name}: {error!r}")
+
+    async def flush(self):
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.failed_steps:
+            logger.warning(f"{self.failed_steps} step snapshots failed to be archived in {self.root}")
+
+    async def close(self):
+        await self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_path, digest[:2], digest + ".zst")
+
+    def _put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            temp_path = object_path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(self.compressor.compress(data))
+            os.replace(temp_path, object_path)
+        return digest
+
+    def _manifest_path(self, task_file_name: str) -> str:
+        return os.path.join(self.manifests_path, os.path.splitext(task_file_name)[0] + ".json")
+
+    def _write_step(self, task_file_name, step_index, url, html, observation, screenshot_base64):
+        step = {"url": url}
+        if html is not None:
+            step["html"] = self._put(html.encode("utf-8"))
+        if observation:
+            step["observation"] = self._put(str(observation).encode("utf-8"))
+        if screenshot_base64:
+            raw_bytes = getattr(screenshot_base64, "raw_bytes", None) or base64.b64decode(screenshot_base64)
+            step["screenshot"] = self._put(raw_bytes)
+        manifest = self.manifests.setdefault(task_file_name, {"steps": {}})
+        manifest["steps"][str(step_index)] = step
+        manifest_path = self._manifest_path(task_file_name)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def read_manifest(self, task_file_name: str) -> dict:
+        if task_file_name not in self.manifests:
+            manifest_path = self._manifest_path(task_file_name)
+            if not os.path.isfile(manifest_path):
+                return {"steps": {}}
+            with open(manifest_path, "r") as f:
+                self.manifests[task_file_name] = json.load(f)
+        return self.manifests[task_file_name]
+
+    def read_step(self, task_file_name: str, step_index: int, kind: str = "html"):
+        """
+        The archived content of a step, None when it was not archived.
+        :param kind: "html" or "observation" for a string, "screenshot" for the image bytes
+        """
+        digest = self.read_manifest(task_file_name)["steps"].get(str(step_index), {}).get(kind)
+        if digest is None:
+            return None
+        with open(self._object_path(digest), "rb") as f:
+            data = self.decompressor.decompress(f.read())
+        return data if kind == "screenshot" else data.decode("utf-8")
@@ -1,6 +1,7 @@
 import re
+from functools import lru_cache
+from importlib import resources
 from urllib.parse import parse_qs, urlparse, unquote
-from bs4 import BeautifulSoup
 
 import requests
 from lxml import html
@@ -9,6 +10,78 @@ from webcanvas.agent.Prompt import *
 from webcanvas.agent.Environment.html_env.utils import MapTagNameList
 from webcanvas.logs import logger
 
+@lru_cache(maxsize=None)
+def get_same_element_js() -> str:
+    return resources.read_text('webcanvas.evaluate', 'sameElement.js')
+
+
+class StepEvaluationContext:
+    """
+    Page state shared by all evaluators of a step.
+    Element paths are matched in the live page by default ("page" backend). With the "html" backend, or when the
+    page cannot be evaluated, the page HTML is fetched and parsed with lxml once per step and shared instead.
+    :param html_content: Page HTML already fetched for the step, e.g. for the snapshot archive
+    """
+
+    def __init__(self, page, netloc: str, element_path_backend: str = "page", html_content: str = None):
+        self.page = page
+        self.url = page.url if page is not None else ""
+        self.netloc = netloc
+        self.element_path_backend = element_path_backend
+        self.html_content = html_content
+        self._html_tree = None
+
+    async def get_html_tree(self):
+        """The parsed page HTML, None when it cannot be parsed, e.g. XHTML with an encoding declaration"""
+        if self._html_tree is None:
+            if self.html_content is None:
+                self.html_content = await self.page.content()
+            try:
+                self._html_tree = html.fromstring(self.html_content)
+            except Exception as e:
+                logger.warning(f"Failed to parse the page HTML, element paths of the step do not match: {e}")
+                return None
+        return self._html_tree
+
+    async def path_exact_match(self, input_answer, reference_answer, method, reference_netloc):
+        if reference_netloc != self.netloc:
+            return 0
+        if self.element_path_backend == "page":
+            try:
+                return await ElementEvaluator.path_exact_match_in_page(
+                    self.page, input_answer, reference_answer, method, self.netloc, reference_netloc)
+            except Exception as e:
+                logger.warning(f"Element path matching in the page failed, falling back to the page HTML: {e}")
+        html_tree = await self.get_html_tree()
+        if html_tree is None:
+            return 0
+        return ElementEvaluator.path_exact_match(
+            input_answer, reference_answer, method, html_tree, self.netloc, reference_netloc)
+
+
+class SnapshotEvaluationContext(StepEvaluationContext):
+    """
+    Page state of a recorded step, for re-scoring without a browser.
+    Element paths are matched in the archived page HTML of the step. Without a snapshot, only a selector that is
+    literally the reference selector is counted as a match.
+    """
+
+    def __init__(self, url: str, netloc: str, html_content: str = None):
+        super().__init__(None, netloc, element_path_backend="html", html_content=html_content)
+        self.url = url
+
+    async def path_exact_match(self, input_answer, reference_answer, method, reference_netloc):
+        if reference_netloc != self.netloc:
+            return 0
+        if self.html_content:
+            html_tree = await self.get_html_tree()
+            if html_tree is None:
+                return 0
+            return ElementEvaluator.path_exact_match(
+                input_answer, reference_answer, method, html_tree, self.netloc, reference_netloc)
+        return int(method == "selector" and input_answer is not None and input_answer.strip() == reference_answer.strip())
+
+
 class StepEvaluator():
     def __init__(self):
         pass
@@ -78,66 +151,60 @@ class URLEvaluator(StepEvaluator):
 class ElementEvaluator(StepEvaluator):
     '''Element evaluation and scoring'''
     @staticmethod
-    def path_exact_match(input_answer, reference_answer, method, html_content, input_netloc, reference_netloc):
-        score = 0
-        if method == "xpath":
-            if reference_netloc != input_netloc:
-                # print("reference_netloc:", reference_netloc,
-                #       "input_netloc:", input_netloc)
-                return 0
-            try:
-                tree = html.fromstring(html_content)
-                input_elements = tree.xpath(input_answer)
-                reference_elements = tree.xpath(reference_answer)
-            except:
-                score = 0
-            if (input_elements is not None) and (reference_elements is not None):
-                score = input_elements[0] is reference_elements[0]
-                try:
-                    if reference_elements[0].tag in MapTagNameList:
-                        trace_up_count = 0
-                        current_element = reference_elements[0]
-                        while trace_up_count < 3 and score == 0:
-                            trace_up_count += 1
-                            current_element = current_element.getparent()
-                            score_parent = input_elements[0] is current_element
-                            score = max(score, score_parent)
-                except:
-                    pass
+    def path_exact_match(input_answer, reference_answer, method, html_tree, input_netloc, reference_netloc):
+        """
+        Check whether the input path selects the same element as the reference path, or one of the 3 ancestors of
+        the reference element when it is a text container (MapTagNameList).
+        :param html_tree: Page HTML parsed with lxml, see StepEvaluationContext.get_html_tree
+        """
+        if reference_netloc != input_netloc:
+            # print("reference_netloc:", reference_netloc,
+            #       "input_netloc:", input_netloc)
+            return 0
+        try:
+            if method == "xpath":
+                input_elements = html_tree.xpath(input_answer)
+                reference_elements = html_tree.xpath(reference_answer)
+            elif method == "selector":
+                input_elements = html_tree.cssselect(input_answer)
+                reference_elements = html_tree.cssselect(reference_answer)
             else:
-                score = 0
-        elif method == "selector":
-            if reference_netloc != input_netloc:
-                # print("reference_netloc:", reference_netloc,
-                #       "input_netloc:", input_netloc)
                 return 0
-            try:
-                soup = BeautifulSoup(html_content, 'html.parser')
-                input_element = soup.select_one(input_answer)
-                reference_element = soup.select_one(reference_answer)
-                if (input_element is not None) and (reference_element is not None):
-                    score = input_element is reference_element
-
-                    try:
-                        if reference_element.name in MapTagNameList:
-                            # parent_elements = reference_element.parent
-                            # score_parent = input_element is parent_elements
-                            # score = max(score, score_parent)
-                            trace_up_count = 0
-                            current_element = reference_element
-                            while trace_up_count < 3 and score == 0:
-                                trace_up_count += 1
-                                current_element = current_element.parent
-                                score_parent = input_element is current_element
-                                score = max(score, score_parent)
-                    except:
-                        pass
-            except:
-                score = 0
+        except Exception:
+            return 0
+        if not input_elements or not reference_elements:
+            return 0
+        input_element = input_elements[0]
+        reference_element = reference_elements[0]
+        score = int(input_element is reference_element)
+        if reference_element.tag in MapTagNameList:
+            trace_up_count = 0
+            current_element = reference_element
+            while trace_up_count < 3 and score == 0 and current_element is not None:
+                trace_up_count += 1
+                current_element = current_element.getparent()
+                score = int(input_element is current_element)
         # result_score = MatchFunction.include_match(
         #     input_answer, reference_answer)
         return score
 
+    @staticmethod
+    async def path_exact_match_in_page(page, input_answer, reference_answer, method, input_netloc, reference_netloc):
+        """
+        Same as path_exact_match, but resolved in the live DOM with a single page.evaluate,
+        looking into open shadow roots and same-origin iframes as well.
+        """
+        if reference_netloc != input_netloc:
+            return 0
+        if method not in ["xpath", "selector"] or not input_answer or not reference_answer:
+            return 0
+        return await page.evaluate(get_same_element_js(), {
+            "inputPath": input_answer,
+            "referencePath": reference_answer,
+            "method": method,
+            "mapTagNames": MapTagNameList
+        })
+
     @staticmethod
     def path_included_match(input_answer, reference_answer, method, html_content):
         # TODO Add path inclusion matching method
@@ -196,8 +263,8 @@ class TextEvaluator(StepEvaluator):
         return result_score
 
     @staticmethod
-    def text_semantic_match(input_answer, semantic_method):
-        result_score = MatchFunction.semantic_match(
+    async def text_semantic_match(input_answer, semantic_method):
+        result_score = await MatchFunction.semantic_match(
             input_answer, semantic_method)
         return result_score
 
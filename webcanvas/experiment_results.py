@@ -1,24 +1,8 @@
-import pandas as pd
-from pandas import json_normalize
-import json5
 import json
-import re
 import os
 from logs import logger
 
 
-def parse_thought_action(dict_str):
-    thought_action = {}
-    thought_match = re.search(r"'thought':\s*(.+?)\s*,\s*'action'", dict_str)
-    action_match = re.search(r"'action':\s*(.+?)\s*}", dict_str)
-    thought = thought_match.group(1) if thought_match else None
-    thought = thought.replace("\\", "").replace("\"", "").replace("\'", "")
-    action = action_match.group(1) if action_match else None
-    action = action.replace("\\", "").replace("\"", "").replace("\'", "")
-    thought_action = {"thought": thought, "action": action}
-    return thought_action
-
-
 def enum_to_action_str():
     action_types = [
         ("NONE", 0),
@@ -41,240 +25,199 @@ def enum_to_action_str():
     return action_dict
 
 
-def to_dict(input_string):
-    pattern = r"('action_type'|'element_id'|'url'|'fill_text'):\s*(<[^>]+>|\d+|'[^']+'|\"[^\"]+\")"
-    matches = re.findall(pattern, input_string)
-    extracted_fields = {}
-    for match in matches:
-        field_name, field_value = match
-        if field_value.startswith('<') and field_value.endswith('>'):
-            enum_name = field_value.split('.')[-1].strip('<> ')
-            extracted_fields[field_name.strip("'")] = enum_name
-        else:
-            extracted_fields[field_name.strip("'")] = field_value.strip("'")
-    action_dict = enum_to_action_str()
-    extracted_fields["action_type"] = action_dict[str(
-        extracted_fields["action_type"])].lower()
-    extracted_fields["fill_text"] = extracted_fields["fill_text"] if extracted_fields.get(
-        "fill_text") else ""
+ACTION_NAMES = enum_to_action_str()
+
+
+def action_to_str(execute_action):
+    """Format a recorded action, e.g. click[12] or fill_search[3,text]"""
+    if not isinstance(execute_action, dict):
+        return ""
+    action_type = ACTION_NAMES.get(str(execute_action.get("action_type")), "NONE").lower()
+    element_id = str(execute_action.get("element_id"))
+    fill_text = execute_action.get("fill_text") or ""
     action = ""
-    if "google_search" in extracted_fields["action_type"].lower():
-        action = "google_search" + "[" + extracted_fields["fill_text"] + "]"
-    elif "fill_search" in extracted_fields["action_type"].lower():
-        action = "fill_search" + \
-                 "[" + str(extracted_fields["element_id"]) + "," + \
-                 extracted_fields["fill_text"] + "]"
-    elif "fill_form" in extracted_fields["action_type"].lower():
-        action = "fill_search" + \
-                 "[" + str(extracted_fields["element_id"]) + "," + \
-                 extracted_fields["fill_text"] + "]"
-    elif "select_option" in extracted_fields["action_type"].lower():
-        action = "select_option" + \
-                 "[" + str(extracted_fields["element_id"]) + "," + \
-                 extracted_fields["fill_text"] + "]"
-    elif "goto" in extracted_fields["action_type"].lower() and extracted_fields.get('url'):
-        action = "goto" + "[" + extracted_fields["url"] + "]"
-    elif "click" in extracted_fields["action_type"].lower():
-        action = "click" + "[" + str(extracted_fields["element_id"]) + "]"
-    elif "go_back" in extracted_fields["action_type"].lower():
-        action = "go_back" + "[" + str(extracted_fields["element_id"]) + "]"
-    elif "none" in extracted_fields["action_type"].lower():
+    if "google_search" in action_type:
+        action = "google_search" + "[" + fill_text + "]"
+    elif "fill_search" in action_type or "fill_form" in action_type:
+        action = "fill_search" + "[" + element_id + "," + fill_text + "]"
+    elif "select_option" in action_type:
+        action = "select_option" + "[" + element_id + "," + fill_text + "]"
+    elif "goto" in action_type and execute_action.get("url"):
+        action = "goto" + "[" + execute_action["url"] + "]"
+    elif "click" in action_type:
+        action = "click" + "[" + element_id + "]"
+    elif "go_back" in action_type:
+        action = "go_back" + "[" + element_id + "]"
+    elif "none" in action_type:
         action = "None"
-    elif "cache_data" in extracted_fields["action_type"].lower():
-        action = "cache_data" + "[" + extracted_fields["fill_text"] + "]"
-    elif "final_answer" in extracted_fields["action_type"].lower():
-        action = "get_final_answer" + "[" + extracted_fields["fill_text"] + "]"
+    elif "cache_data" in action_type:
+        action = "cache_data" + "[" + fill_text + "]"
+    elif "final_answer" in action_type:
+        action = "get_final_answer" + "[" + fill_text + "]"
     return action
 
 
-def score_rate(score):
-    first, second = score.split("/")
-    return float(first) / float(second)
-
-
-def parse_step_reward(dict_str):
-    score_description = {}
-    score_match = re.search(r"'score':\s*(.+?)\s*,\s*'description'", dict_str)
-    description_match = re.search(r"'description':\s*(.+?)\s*}", dict_str)
-    score = score_match.group(1) if score_match else None
-    score = score.replace("\\", "").replace("\"", "").replace("\'", "")
-    description = description_match.group(1) if description_match else None
-    description = description.replace(
-        "\\", "").replace("\"", "").replace("\'", "")
-    score_description = {"score": score, "description": description}
-    return score_description
-
-
-def process_step_reward(dict_str):
-    if dict_str.lower() == "{}":
-        dict_str = {}
-    elif dict_str.lower() == "finished":
-        dict_str = {"score:": 10, "description": "finished"}
-    else:
-        dict_str = parse_step_reward(dict_str)
-    return dict_str
-
-
-def write_task_result_to_df(each_task_json_file_path):
-    with open(each_task_json_file_path) as f:
-        data = json.load(f)
-    step_list = data["step_list"]
-    task_name = data["task_name"]
-    task_status = data["status"]
-    reference_task_length = data["reference_task_length"]
-    evaluate_steps = data["evaluate_steps"]
-    for idx, item in enumerate(step_list):
-        for key in item:
-            step_list[idx][key] = str(step_list[idx][key])
-    data_df = json_normalize(step_list, errors='ignore')
-    return task_name, task_status, reference_task_length, evaluate_steps, data_df
-
-
-def write_to_json(df):
-    df["step_index"] = df["step_index"].apply(lambda x: int(x))
-    df["trace_to_dict"] = df["current_trace"].apply(
-        lambda x: parse_thought_action(x))
-    df["action_to_str"] = df["execute_action"].apply(lambda x: to_dict(x))
-    df["score_rate"] = df["score"].apply(lambda x: score_rate(x))
-    df["step_reward"] = df["step_reward"].apply(
-        lambda x: process_step_reward(x))
-    df["selector"] = df["selector"].fillna("None")
-    df["match_result"] = df["match_func_result"]
-    df["element_value"] = df["element_value"].fillna("None")
-    df["error"] = df["error_message"].fillna("None")
-    df["step_url"] = df["step_url"].fillna("None")
-    df_copy = df[
-        [
-            "step_index",
-            "trace_to_dict",
-            "selector",
-            "action_to_str",
-            "score",
-            "score_rate",
-            "step_reward",
-            "step_url",
-            "match_result",
-            "element_value",
-            "error"
-        ]
-    ]
-
-    def summary(x):
-        dic = {
-            "step_index": x["step_index"],
-            "trace_description": x["trace_to_dict"] if x["trace_to_dict"] else {},
-            "selector": x["selector"] if x["selector"] != "None" else "",
-            "element_value": x["element_value"] if x["element_value"] != "None" else "",
-            "action": x["action_to_str"] if x["action_to_str"] else "",
-            "task_score": x["score"],
-            "task_score_rate": x["score_rate"],
-            "current_reward_score_description": x["step_reward"],
-            "url": x["step_url"],
-            "match_result": x["match_result"],
-            "error": x["error"] if x["error"] != "None" else ""
-        }
-        # print(dic["match_result"])
-        return dic
-
-    step_list = []
-    df_copy.apply(lambda x: step_list.append(summary(x)), axis=1)
-    return step_list
-
-
-def get_result(input_json_path):
+def parse_score(score):
+    """Split a step score "1 / 3" into its numerator and denominator"""
+    first, second = str(score).split("/")
+    return float(first), float(second)
+
+
+def step_reward_to_dict(step_reward):
+    if not step_reward:
+        return {}
+    if not isinstance(step_reward, dict):
+        return {"score:": 10, "description": "finished"} if str(step_reward).lower() == "finished" else {}
+    return {"score": str(step_reward.get("score")), "description": str(step_reward.get("description"))}
+
+
+def step_summary(step: dict) -> dict:
+    trace = step.get("current_trace") or {}
+    numerator, denominator = parse_score(step["score"])
+    return {
+        "step_index": int(step["step_index"]),
+        "trace_description": {"thought": trace.get("thought"), "action": trace.get("action")} if trace else {},
+        "selector": step.get("selector") or "",
+        "element_value": step.get("element_value") or "",
+        "action": action_to_str(step.get("execute_action")),
+        "task_score": str(step["score"]),
+        "task_score_rate": numerator / denominator,
+        "current_reward_score_description": step_reward_to_dict(step.get("step_reward")),
+        "url": step.get("step_url") or "None",
+        "match_result": str(step.get("match_func_result")),
+        "error": step.get("error_message") or ""
+    }
+
+
+def task_summary(task_id: int, task_result: dict) -> dict:
+    return {
+        "task_id": task_id,
+        "task_name": task_result["task_name"],
+        "task_status": task_result["status"],
+        "step_list": [step_summary(step) for step in task_result["step_list"]],
+        "evaluation": task_result["evaluate_steps"]
+    }
+
+
+class ResultAccumulator:
+    """
+    Metrics of a run accumulated one task at a time, in constant memory.
+    """
+
+    def __init__(self):
+        self.task_counts = 0
+        self.finished_counts = 0
+        self.near_success_counts = 0
+        self.step_score_rate_sum = 0
+        self.efficiency_score_sum = 0
+        self.key_node_completion_sum = 0
+        self.key_node_reference_sum = 0
+
+    def add(self, out_json: dict):
+        if not out_json["step_list"]:
+            logger.warning(f"Task {out_json['task_id']} has no steps and is not counted")
+            return
+        last_step = out_json["step_list"][-1]
+        steps = last_step["step_index"] + 1
+        step_score, reference_score = parse_score(last_step["task_score"])
+        self.task_counts += 1
+        self.finished_counts += out_json["task_status"] == "finished"
+        # The agent is only one key node away from completing the task
+        self.near_success_counts += reference_score - step_score == 1.0
+        self.step_score_rate_sum += last_step["task_score_rate"]
+        self.efficiency_score_sum += steps / step_score if step_score != 0 else 0
+        self.key_node_completion_sum += step_score
+        self.key_node_reference_sum += reference_score
+
+    def result(self, total_token_cost=0) -> dict:
+        result_dict = {}
+        result_dict["task_counts"] = self.task_counts
+        result_dict["average_step_score_rate"] = self.step_score_rate_sum / self.task_counts
+        result_dict["average_efficiency_score"] = self.efficiency_score_sum / self.task_counts
+        if total_token_cost != 0 and self.key_node_completion_sum != 0:
+            result_dict["usd_efficiency_score"] = total_token_cost / self.key_node_completion_sum
+        result_dict["key_node_completion_rate"] = self.key_node_completion_sum / self.key_node_reference_sum \
+            if self.key_node_reference_sum else 0
+        result_dict["task_success_rate"] = self.finished_counts / self.task_counts
+        result_dict["task_near_success_rate"] = self.near_success_counts / self.task_counts
+        return result_dict
+
+
+def get_result(input_json_path, accumulator: ResultAccumulator = None):
+    """
+    Summarize every json_result file of a run into result/out.json, reading each file once and writing
+    the summaries as they are made.
+    """
     json_result_path = input_json_path + "/json_result"
     out_file_path = input_json_path + "/result"
-    task_list = []
-    for _, filename in enumerate(os.listdir(json_result_path)):
-        file_path = os.path.join(json_result_path, filename)
-        out_json = {}
-        task_name, task_status, reference_task_length, evaluate_steps, data_df = write_task_result_to_df(
-            file_path)
-        out_json["task_id"] = int(filename.split("_")[0])
-        out_json["task_name"] = task_name
-        out_json["task_status"] = task_status
-        if os.path.isfile(file_path):
-            task_step_list = write_to_json(data_df)
-            out_json["step_list"] = task_step_list
-            out_json["evaluation"] = evaluate_steps
-            task_list.append(out_json)
-
-    task_list = sorted(task_list, key=lambda x: x['task_id'])
+    # json_result files are named <task index>_<task uuid>.json
+    filenames = sorted((filename for filename in os.listdir(json_result_path)
+                        if os.path.isfile(os.path.join(json_result_path, filename))),
+                       key=lambda filename: int(filename.split("_")[0]))
 
     if not os.path.exists(out_file_path):
         os.makedirs(out_file_path)
     out_json_file_path = out_file_path + '/out.json'
     with open(out_json_file_path, 'w') as json_file:
-        json.dump(task_list, json_file)
+        json_file.write("[")
+        for i, filename in enumerate(filenames):
+            with open(os.path.join(json_result_path, filename)) as f:
+                out_json = task_summary(int(filename.split("_")[0]), json.load(f))
+            if accumulator is not None:
+                accumulator.add(out_json)
+            json_file.write((", " if i else "") + json.dumps(out_json))
+        json_file.write("]")
     return out_file_path
 
 
-def read_json_result(file_path):
-    with open(file_path) as f:
-        data = json.load(f)
-    last_action_result_list = []
-    for items in data:
-        data_dic = {}
-        data_dic["task_id"] = items["task_id"]
-        data_dic["task_name"] = items["task_name"]
-        data_dic["status"] = items["task_status"]
-        data_dic["steps"] = items["step_list"][-1]["step_index"] + 1
-        data_dic["task_score"] = items["step_list"][-1]["task_score"]
-        data_dic["task_score_rate"] = items["step_list"][-1]["task_score_rate"]
-        data_dic["reward_count"] = len(items["evaluation"])
-        last_action_result_list.append(data_dic)
-    return last_action_result_list
-
-
-def calculate_total_score(scores):
-    molecular_sum = sum(float(x.split('/')[0]) for x in scores)
-    denominator_sum = sum(float(x.split('/')[1]) for x in scores)
-    final_score = molecular_sum / denominator_sum
-    return final_score
-
-
-def evaluate(file_path, total_token_cost):
-    input_file_path = file_path + "/out.json"
+def write_result(file_path, result_dict):
     result_file_path = file_path + "/result.json"
-    all_data = read_json_result(input_file_path)
-    df = pd.DataFrame(all_data)
-    df["step_score"] = df["task_score"].apply(lambda x: float(x.split("/")[0]))
-    df["efficiency_score"] = [s / sc if sc != 0 else 0 for s, sc in zip(df['steps'], df['step_score'])]
-    # The agent is only one key node away from completing the task
-    df["task_near_success"] = df["task_score"].apply(lambda x: float(
-        x.split("/")[1]) - float(x.split("/")[0]) == 1.0)
-
-    df_evaluate = df[["task_name", "status", "steps", "task_score",
-                      "task_score_rate", "step_score", "efficiency_score", "task_near_success"]]
-
-    key_node_completion_rate = calculate_total_score(df_evaluate['task_score'])
-    key_node_completion_sum = df_evaluate['step_score'].sum()
-    task_success_rate = df_evaluate[df_evaluate["status"]
-                                    == "finished"].shape[0] / df_evaluate.shape[0]
-    task_near_success_rate = df_evaluate[df_evaluate["task_near_success"]
-                                         == True].shape[0] / df_evaluate.shape[0]
-
-    average_step_score_rate = df_evaluate["task_score_rate"].mean()
-    average_efficiency_score = df_evaluate["efficiency_score"].mean()
-    if total_token_cost != 0:
-        usd_efficiency_score = total_token_cost / key_node_completion_sum
-
-    result_dict = {}
-    result_dict["task_counts"] = df_evaluate.shape[0]
-    result_dict["average_step_score_rate"] = average_step_score_rate
-    result_dict["average_efficiency_score"] = average_efficiency_score
-    if total_token_cost != 0:
-        result_dict["usd_efficiency_score"] = usd_efficiency_score
-    result_dict["key_node_completion_rate"] = key_node_completion_rate
-    result_dict["task_success_rate"] = task_success_rate
-    result_dict["task_near_success_rate"] = task_near_success_rate
-
-    with open(result_file_path, 'w') as json_file:
+    if not os.path.exists(file_path):
+        os.makedirs(file_path)
+    # Replace the file at once, so a rolling result.json is never read half written
+    with open(result_file_path + ".tmp", 'w') as json_file:
         json.dump(result_dict, json_file)
+    os.replace(result_file_path + ".tmp", result_file_path)
+    return result_file_path
+
+
+class LiveScoreboard:
+    """
+    Rolling result.json of a run in progress, updated as each task finishes.
+    """
+
+    def __init__(self, input_result_path, print_progress=True):
+        self.out_file_path = input_result_path + "/result"
+        self.print_progress = print_progress
+        self.accumulator = ResultAccumulator()
+
+    def update(self, task_id: int, task_result: dict, total_token_cost=0):
+        self.accumulator.add(task_summary(task_id, task_result))
+        if self.accumulator.task_counts == 0:
+            return
+        result_dict = self.accumulator.result(total_token_cost)
+        write_result(self.out_file_path, result_dict)
+        if self.print_progress:
+            logger.info(
+                f"[{result_dict['task_counts']} tasks] "
+                f"key node completion rate: {result_dict['key_node_completion_rate']:.3f}, "
+                f"task success rate: {result_dict['task_success_rate']:.3f}, "
+                f"usd efficiency score: {result_dict.get('usd_efficiency_score', 0):.4f}")
 
+
+def evaluate(file_path, total_token_cost):
+    """Compute result.json from an existing out.json"""
+    with open(file_path + "/out.json") as f:
+        task_list = json.load(f)
+    accumulator = ResultAccumulator()
+    for out_json in task_list:
+        accumulator.add(out_json)
+    result_file_path = write_result(file_path, accumulator.result(total_token_cost))
     logger.info(f'\033[31mAll results write to {result_file_path} !\033[0m')
 
 
 def get_evaluate_result(input_result_path, total_token_cost):
-    out_file_path = get_result(input_result_path)
-    evaluate(file_path=out_file_path, total_token_cost=total_token_cost)
+    accumulator = ResultAccumulator()
+    out_file_path = get_result(input_result_path, accumulator)
+    result_file_path = write_result(out_file_path, accumulator.result(total_token_cost))
+    logger.info(f'\033[31mAll results write to {result_file_path} !\033[0m')
@@ -0,0 +1,151 @@
+"""
+Re-score recorded runs offline, without a browser.
+
+Every json_result file of an output directory records the selector, element value, text content and resulting URL
+of each step. The key node evaluators of the task are replayed over these steps in the page state each step was
+evaluated in: the URL the step started from and, when a snapshot was archived, the page HTML of the step.
+Tasks are re-scored in parallel across processes. Semantic match functions still ask the LLM.
+
+Usage:
+    python webcanvas/rescore.py --result_path ./batch_tasks_results/challenge_dev \
+        --batch_tasks_file_path ./webcanvas/data/challenges/processed_dev.json --snapshot_path ./snapshots
+"""
+import os
+import json
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from webcanvas.evaluate.evaluate_utils import read_file, get_netloc, evaluate_key_nodes
+from webcanvas.evaluate.key_node import KeyNodeEvaluatorSet
+from webcanvas.evaluate.step_score import SnapshotEvaluationContext
+from webcanvas.evaluate.snapshot_archive import SnapshotArchive
+from webcanvas.experiment_results import get_evaluate_result
+from webcanvas.logs import logger
+
+
+def load_snapshot(snapshot_archive, task_file_name: str, step_index: int):
+    """The page HTML archived for a step, if any"""
+    if snapshot_archive is None:
+        return None
+    return snapshot_archive.read_step(task_file_name, step_index, "html")
+
+
+def task_status(task_result: dict, task_finished: bool) -> str:
+    if task_finished:
+        return "finished"
+    if task_result.get("status") in ["llm_finished", "early_stop"]:
+        return task_result["status"]
+    last_step_reward = task_result["step_list"][-1].get("step_reward") if task_result["step_list"] else None
+    if isinstance(last_step_reward, dict) and last_step_reward.get("status") == "finished":
+        return "llm_finished"
+    return "step_limit"
+
+
+async def rescore_task(task_result: dict, reference_evaluate_steps: list, task_file_name: str,
+                       snapshot_archive: SnapshotArchive = None) -> dict:
+    """Replay the key node evaluators of a task over its recorded steps and rewrite its scores"""
+    evaluate_steps = KeyNodeEvaluatorSet(dict(evaluate, score=0) for evaluate in reference_evaluate_steps)
+    total_step_score = 0
+    snapshot_steps = 0
+    # Steps are evaluated before their action is executed, in the page the previous step ended on
+    url = "about:blank"
+    for step in task_result["step_list"]:
+        html_content = load_snapshot(snapshot_archive, task_file_name, step["step_index"])
+        snapshot_steps += html_content is not None
+        context = SnapshotEvaluationContext(url, get_netloc(url), html_content)
+        try:
+            evaluate_steps, match_result = await evaluate_key_nodes(
+                context, evaluate_steps, input_path=step.get("selector"), element_value=step.get("element_value"),
+                text_content=step.get("text_content"))
+        except Exception as e:
+            logger.info(f"Step evaluate error in {task_file_name}, step {step['step_index']}: {e}")
+            match_result = evaluate_steps.match_result()
+        total_step_score = sum(evaluate["score"] for evaluate in evaluate_steps)
+        step["score"] = str(total_step_score) + " / " + str(len(evaluate_steps))
+        step["match_func_result"] = match_result
+        url = step.get("step_url") or url
+
+    task_result["status"] = task_status(task_result, total_step_score == len(evaluate_steps))
+    task_result["evaluate_steps"] = evaluate_steps
+    task_result["rescored_snapshot_steps"] = snapshot_steps
+    return task_result
+
+
+def rescore_task_file(task_file_path: str, out_json_result_path: str, reference_evaluate_steps: list = None,
+                      snapshot_path: str = None):
+    """Worker entry: re-score one json_result file and write it under out_json_result_path"""
+    task_file_name = os.path.basename(task_file_path)
+    with open(task_file_path, "r", encoding="utf-8") as f:
+        task_result = json.load(f)
+    if reference_evaluate_steps is None:
+        reference_evaluate_steps = task_result.get("evaluate_steps")
+    if not reference_evaluate_steps:
+        return task_file_name, None
+    snapshot_archive = SnapshotArchive(snapshot_path, read_only=True) if snapshot_path else None
+    task_result = asyncio.run(rescore_task(task_result, reference_evaluate_steps, task_file_name, snapshot_archive))
+    with open(os.path.join(out_json_result_path, task_file_name), "w") as f:
+        json.dump(task_result, f)
+    return task_file_name, task_result["status"]
+
+
+def rescore(result_path: str, out_path: str = None, batch_tasks_file_path: str = None, snapshot_path: str = None,
+            processes: int = None, total_token_cost: float = 0):
+    """
+    Re-score every task of result_path/json_result into out_path/json_result and aggregate the results.
+    :param batch_tasks_file_path: Dataset to take the reference key nodes from, e.g. after fixing an annotation.
+        Defaults to the key nodes recorded in each json_result file.
+    """
+    json_result_path = os.path.join(result_path, "json_result")
+    out_path = out_path or os.path.join(result_path, "rescored")
+    out_json_result_path = os.path.join(out_path, "json_result")
+    if not os.path.exists(out_json_result_path):
+        os.makedirs(out_json_result_path)
+
+    reference_tasks = {}
+    if batch_tasks_file_path:
+        for _, task_uuid, _, reference_evaluate_steps in read_file(file_path=batch_tasks_file_path):
+            reference_tasks[task_uuid] = [dict(evaluate) for evaluate in reference_evaluate_steps]
+
+    task_files = sorted(filename for filename in os.listdir(json_result_path) if filename.endswith(".json"))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = []
+        for filename in task_files:
+            # json_result files are named <task index>_<task uuid>.json
+            task_uuid = os.path.splitext(filename)[0].split("_", 1)[-1]
+            reference_evaluate_steps = reference_tasks.get(task_uuid) if batch_tasks_file_path else None
+            if batch_tasks_file_path and reference_evaluate_steps is None:
+                logger.warning(f"Task {task_uuid} is not in {batch_tasks_file_path}, using its recorded key nodes")
+            futures.append(executor.submit(
+                rescore_task_file, os.path.join(json_result_path, filename), out_json_result_path,
+                reference_evaluate_steps, snapshot_path))
+        for future in futures:
+            task_file_name, status = future.result()
+            if status is None:
+                logger.warning(f"Skip {task_file_name}: no key nodes to evaluate")
+            else:
+                logger.info(f"Rescored {task_file_name}: {status}")
+
+    get_evaluate_result(out_path, total_token_cost)
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-score the recorded steps of a run without a browser.")
+    parser.add_argument("--result_path", type=str, required=True,
+                        help="Output directory of a run, containing json_result.")
+    parser.add_argument("--out_path", type=str, default=None,
+                        help="Directory to write the re-scored results to. Defaults to <result_path>/rescored.")
+    parser.add_argument("--batch_tasks_file_path", type=str, default=None,
+                        help="Dataset to take the reference key nodes from. Defaults to the recorded key nodes.")
+    parser.add_argument("--snapshot_path", type=str, default=None,
+                        help="Snapshot archive of the run, see snapshot_archive_path in setting.toml.")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--total_token_cost", type=float, default=0,
+                        help="Token cost of the run, for the usd efficiency score.")
+
+    args = parser.parse_args()
+
+    rescore(result_path=args.result_path, out_path=args.out_path, batch_tasks_file_path=args.batch_tasks_file_path,
+            snapshot_path=args.snapshot_path, processes=args.processes, total_token_cost=args.total_token_cost)
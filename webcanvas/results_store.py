@@ -0,0 +1,238 @@
+"""
+Columnar store of evaluation runs for cross-run analytics.
+
+Runs are exported from their json_result files into four Parquet datasets partitioned by run id:
+
+- tasks: one row per task, with its status, key node score, domain and token cost
+- steps: one row per step, with its action, score, URL and duration
+- key_nodes: one row per key node of a task and whether it was hit
+- tokens: one row per step with the planning and reward token counts and cost
+
+ResultsStore answers the common comparisons with vectorized Arrow group-bys.
+
+Usage:
+    python webcanvas/results_store.py export --result_path ./batch_tasks_results/challenge_dev --store_path ./results_store
+    python webcanvas/results_store.py query --store_path ./results_store --query per_domain_success
+"""
+import os
+import json
+import argparse
+from urllib.parse import urlparse
+
+import toml
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from webcanvas.agent.LLM.token_calculation import input_token_cost
+
+TABLES = ["tasks", "steps", "key_nodes", "tokens"]
+TOKEN_FIELDS = ["planning_input_token_count", "planning_output_token_count", "planning_image_token_count",
+                "planning_cached_input_token_count", "reward_input_token_count", "reward_output_token_count",
+                "reward_image_token_count", "reward_cached_input_token_count"]
+
+
+def get_domain(url: str) -> str:
+    netloc = urlparse(url or "").netloc
+    return netloc[4:] if netloc.startswith("www.") else netloc
+
+
+def step_cost(step_tokens: dict, planning_text_model: str, global_reward_text_model: str, token_pricing: dict):
+    """Cost of the tokens of a step, 0 for models without pricing"""
+    cost = 0
+    for prefix, model in [("planning", planning_text_model), ("reward", global_reward_text_model)]:
+        if model in token_pricing.get("pricing_models", []):
+            cost += input_token_cost(step_tokens.get(f"{prefix}_input_token_count", 0),
+                                     step_tokens.get(f"{prefix}_cached_input_token_count", 0), model, token_pricing)
+            cost += step_tokens.get(f"{prefix}_output_token_count", 0) * token_pricing[f"{model}_output_price"]
+    return cost
+
+
+def parse_score(score) -> tuple:
+    first, second = str(score).split("/")
+    return float(first), float(second)
+
+
+def task_rows(run_id: str, task_index: int, task_result: dict, token_pricing: dict, default_models: dict) -> dict:
+    """The rows of every table for one json_result file"""
+    planning_text_model = task_result.get("planning_text_model") or default_models.get("planning_text_model", "")
+    global_reward_text_model = task_result.get("global_reward_text_model") or default_models.get(
+        "global_reward_text_model", "")
+    step_list = task_result.get("step_list") or []
+    rows = {name: [] for name in TABLES}
+
+    domain = ""
+    for step in step_list:
+        domain = get_domain(step.get("step_url"))
+        if domain:
+            break
+    for step in step_list:
+        key_node_score, _ = parse_score(step.get("score", "0 / 0"))
+        rows["steps"].append({
+            "run_id": run_id,
+            "task_index": task_index,
+            "step_index": int(step["step_index"]),
+            "action_type": int((step.get("execute_action") or {}).get("action_type", 0)),
+            "selector": step.get("selector") or "",
+            "element_value": str(step.get("element_value") or ""),
+            "url": step.get("step_url") or "",
+            "domain": get_domain(step.get("step_url")),
+            "key_node_score": key_node_score,
+            "error": step.get("error_message") or "",
+            "duration": step.get("step_duration"),
+        })
+
+    token_records = (task_result.get("token_counts") or {}).get("steps_tokens_record", [])
+    task_cost = 0
+    for step_index, step_tokens in enumerate(token_records):
+        cost = step_cost(step_tokens, planning_text_model, global_reward_text_model, token_pricing)
+        task_cost += cost
+        row = {"run_id": run_id, "task_index": task_index, "step_index": step_index}
+        row.update({field: int(step_tokens.get(field, 0)) for field in TOKEN_FIELDS})
+        row["cost"] = cost
+        rows["tokens"].append(row)
+
+    evaluate_steps = task_result.get("evaluate_steps") or []
+    for position, evaluate in enumerate(evaluate_steps):
+        rows["key_nodes"].append({
+            "run_id": run_id,
+            "task_index": task_index,
+            "position": position,
+            "match_function": evaluate.get("match_function", ""),
+            "reference_answer": str(evaluate.get("reference_answer", "")),
+            "netloc": evaluate.get("netloc") or "",
+            "score": float(evaluate.get("score", 0)),
+            "hit": evaluate.get("score", 0) >= 1,
+        })
+
+    key_node_score = sum(float(evaluate.get("score", 0)) for evaluate in evaluate_steps)
+    rows["tasks"].append({
+        "run_id": run_id,
+        "planning_text_model": planning_text_model,
+        "global_reward_text_model": global_reward_text_model,
+        "task_index": task_index,
+        "task_id": str(task_result.get("id")),
+        "task_name": task_result.get("task_name", ""),
+        "domain": domain,
+        "status": task_result.get("status", ""),
+        "finished": task_result.get("status") == "finished",
+        "reference_task_length": int(task_result.get("reference_task_length") or 0),
+        "steps": len(step_list),
+        "key_node_score": key_node_score,
+        "key_node_count": len(evaluate_steps),
+        "llm_error_rate": float(task_result.get("LLM_error_rate") or 0),
+        "token_cost": task_cost,
+    })
+    return rows
+
+
+def export_run(result_path: str, store_path: str, run_id: str = None, toml_path: str = None,
+               planning_text_model: str = "", global_reward_text_model: str = "") -> str:
+    """
+    Export the json_result files of a run into the store, replacing a previous export of the same run id.
+    :param run_id: Defaults to the name of the result directory
+    :param planning_text_model: Model of runs recorded before the models were saved with each task
+    """
+    run_id = run_id or os.path.basename(os.path.normpath(result_path))
+    token_pricing = {}
+    if toml_path and os.path.exists(toml_path):
+        token_pricing = toml.load(toml_path).get("token_pricing", {})
+    default_models = {"planning_text_model": planning_text_model,
+                      "global_reward_text_model": global_reward_text_model}
+
+    rows = {name: [] for name in TABLES}
+    json_result_path = os.path.join(result_path, "json_result")
+    for filename in os.listdir(json_result_path):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(json_result_path, filename)) as f:
+            task_result = json.load(f)
+        # json_result files are named <task index>_<task uuid>.json
+        task_rows_of_file = task_rows(run_id, int(filename.split("_")[0]), task_result, token_pricing,
+                                      default_models)
+        for name in TABLES:
+            rows[name].extend(task_rows_of_file[name])
+
+    for name in TABLES:
+        if rows[name]:
+            pq.write_to_dataset(pa.Table.from_pylist(rows[name]), root_path=os.path.join(store_path, name),
+                                partition_cols=["run_id"], existing_data_behavior="delete_matching")
+    return run_id
+
+
+class ResultsStore:
+    """
+    Read access to an exported store, with the comparisons between runs that come up most often.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+
+    def table(self, name: str, run_ids: list = None) -> pa.Table:
+        filters = [("run_id", "in", run_ids)] if run_ids else None
+        table = pq.read_table(os.path.join(self.store_path, name), filters=filters)
+        # Partition columns are read back as dictionaries
+        return table.set_column(table.schema.get_field_index("run_id"), "run_id",
+                                pc.cast(table["run_id"], pa.string()))
+
+    def per_domain_success(self, run_ids: list = None) -> pa.Table:
+        """Task success rate and key node completion rate of every run on every domain"""
+        tasks = self.table("tasks", run_ids)
+        result = tasks.group_by(["run_id", "domain"]).aggregate([
+            ("finished", "mean"), ("key_node_score", "sum"), ("key_node_count", "sum"), ("task_index", "count")])
+        return result.append_column("key_node_completion_rate", pc.divide(
+            result["key_node_score_sum"], pc.cast(result["key_node_count_sum"], pa.float64())))
+
+    def cost_per_key_node(self, run_ids: list = None) -> pa.Table:
+        """Token cost per completed key node of every run and model pair, the usd efficiency score"""
+        tasks = self.table("tasks", run_ids)
+        result = tasks.group_by(["run_id", "planning_text_model", "global_reward_text_model"]).aggregate([
+            ("token_cost", "sum"), ("key_node_score", "sum"), ("finished", "mean")])
+        return result.append_column("cost_per_key_node", pc.divide(
+            result["token_cost_sum"], pc.if_else(pc.equal(result["key_node_score_sum"], 0),
+                                                 pa.scalar(None, pa.float64()), result["key_node_score_sum"])))
+
+    def step_latency(self, run_ids: list = None) -> pa.Table:
+        """Mean, median and maximum step duration in seconds of every run"""
+        steps = self.table("steps", run_ids).filter(pc.is_valid(pc.field("duration")))
+        return steps.group_by("run_id").aggregate([
+            ("duration", "mean"), ("duration", "approximate_median"), ("duration", "max"), ("duration", "count")])
+
+    def evaluator_hit_rate(self, run_ids: list = None) -> pa.Table:
+        """Hit rate of every match function in every run"""
+        key_nodes = self.table("key_nodes", run_ids)
+        return key_nodes.group_by(["run_id", "match_function"]).aggregate([("hit", "mean"), ("hit", "count")])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export runs to a columnar store and compare them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the json_result files of runs.")
+    export_parser.add_argument("--result_path", type=str, nargs="+", required=True,
+                               help="Output directories of runs, containing json_result.")
+    export_parser.add_argument("--store_path", type=str, default="./results_store")
+    export_parser.add_argument("--run_id", type=str, default=None,
+                               help="Run id of a single exported run. Defaults to the result directory name.")
+    export_parser.add_argument("--toml_path", type=str, default="./webcanvas/configs/setting.toml",
+                               help="Configuration with the token pricing.")
+    export_parser.add_argument("--planning_text_model", type=str, default="")
+    export_parser.add_argument("--global_reward_text_model", type=str, default="")
+
+    query_parser = subparsers.add_parser("query", help="Compare the exported runs.")
+    query_parser.add_argument("--store_path", type=str, default="./results_store")
+    query_parser.add_argument("--query", choices=["per_domain_success", "cost_per_key_node", "step_latency",
+                                                  "evaluator_hit_rate"], default="per_domain_success")
+    query_parser.add_argument("--run_ids", type=str, nargs="*", default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        for result_path in args.result_path:
+            run_id = export_run(result_path, args.store_path, args.run_id if len(args.result_path) == 1 else None,
+                                args.toml_path, args.planning_text_model, args.global_reward_text_model)
+            print(f"Exported {result_path} as run {run_id}")
+    else:
+        store = ResultsStore(args.store_path)
+        for row in getattr(store, args.query)(args.run_ids).to_pylist():
+            print(row)